@@ -0,0 +1,232 @@
+import asyncio
+import functools
+import time
+import weakref
+from collections import deque
+from typing import AsyncIterator, Callable, Deque, Dict
+
+from fastapi import HTTPException, status
+from fastapi.responses import StreamingResponse
+
+from .changes import SSE_MEDIA_TYPE
+from .config import Settings, settings
+from .metrics import InstrumentedRoute, current_timings
+
+# Admission control. Rather than letting requests pile up waiting on the
+# database until clients time out, each request takes a slot from a budget
+# before its endpoint runs, and gives it back when the endpoint returns, or
+# for a streamed body (exports, NDJSON lists), when the body ends: those
+# read the database as they stream. Watch streams are the exception, as
+# they stay open indefinitely and are fed from the change feed's memory,
+# so they give their slot back on return. Reads and writes have separate
+# budgets, so a write storm can't starve reads, and some operations have a
+# tighter limit of their own on top. When every slot is taken a request
+# queues, up to a bound on the queue and on how long it waits; past either,
+# it gets a 503 straight away, with Retry-After.
+#
+# The read and write limits adapt to how long admitted requests spend
+# waiting on the database: SQL statements (including SQLite lock waits)
+# and the write queue. Over the target a limit is cut by a quarter, at most
+# once per target interval; under it, and while the limit is what holds
+# requests back, it grows by one every limit requests (AIMD).
+
+READ = "read"
+WRITE = "write"
+
+DECREASE_FACTOR = 0.75
+
+
+class Overloaded(Exception):
+    pass
+
+
+class Limiter:
+    """A concurrency limit with a bounded, time-limited queue."""
+
+    def __init__(self, limit: float, max_queue: int, queue_timeout_seconds: float):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout_seconds = queue_timeout_seconds
+        self.active = 0
+        self.rejected = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    async def acquire(self):
+        if self.active < int(self.limit) and not self._waiters:
+            self.active += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            raise Overloaded()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            # The slot is handed over by release(), already counted in active.
+            await asyncio.wait_for(waiter, self.queue_timeout_seconds)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise Overloaded()
+        except asyncio.CancelledError:
+            # Cancelled just after being handed a slot: give it back.
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def release(self):
+        self.active -= 1
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self.active < int(self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.active += 1
+                waiter.set_result(None)
+
+
+class AdaptiveLimiter(Limiter):
+    """A Limiter whose limit follows how long admitted requests wait on the database."""
+
+    def __init__(self, limit: int, min_limit: int, max_queue: int, queue_timeout_seconds: float, target_seconds: float):
+        super().__init__(limit, max_queue, queue_timeout_seconds)
+        self.max_limit = limit
+        self.min_limit = min_limit
+        self.target_seconds = target_seconds
+        self._last_decrease = 0.0
+
+    def observe(self, db_wait_seconds: float, saturated: bool):
+        if db_wait_seconds > self.target_seconds:
+            now = time.monotonic()
+            # One cut per target interval: the requests finishing right
+            # after it were admitted under the old limit.
+            if now - self._last_decrease >= self.target_seconds:
+                self._last_decrease = now
+                self.limit = max(self.min_limit, self.limit * DECREASE_FACTOR)
+        elif saturated and self.limit < self.max_limit:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._wake()
+
+
+class AdmissionController:
+    def __init__(self, settings: Settings):
+        self.enabled = settings.admission_enabled
+        self.retry_after_seconds = settings.admission_retry_after_seconds
+        queue_timeout = settings.admission_queue_timeout_ms / 1000
+        target = settings.admission_target_db_wait_ms / 1000
+        self.budgets: Dict[str, AdaptiveLimiter] = {
+            READ: AdaptiveLimiter(settings.admission_read_limit, settings.admission_min_limit, settings.admission_max_queue, queue_timeout, target),
+            WRITE: AdaptiveLimiter(settings.admission_write_limit, settings.admission_min_limit, settings.admission_max_queue, queue_timeout, target),
+        }
+        self.operations: Dict[str, Limiter] = {
+            operation: Limiter(limit, settings.admission_max_queue, queue_timeout)
+            for operation, limit in settings.admission_operation_limits.items()
+        }
+
+    def overloaded(self) -> HTTPException:
+        return HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="The server is overloaded, retry later",
+            headers={"Retry-After": str(self.retry_after_seconds)},
+        )
+
+    async def run(self, operation: str, budget: str, call: Callable):
+        if not self.enabled:
+            return await call()
+        release = await self._admit(operation, budget)
+        try:
+            response = await call()
+        except BaseException:
+            release()
+            raise
+        if isinstance(response, StreamingResponse) and response.media_type != SSE_MEDIA_TYPE:
+            response.body_iterator = _release_after(response.body_iterator, release)
+            # A body that is never iterated (the client left before the
+            # response started) gives the slot back once it's collected.
+            weakref.finalize(response.body_iterator, release)
+        else:
+            release()
+        return response
+
+    async def _admit(self, operation: str, budget: str) -> Callable[[], None]:
+        """Take a slot for operation from budget, returning the function that gives it back."""
+        operation_limiter = self.operations.get(operation)
+        limiter = self.budgets[budget]
+        try:
+            if operation_limiter is not None:
+                await operation_limiter.acquire()
+        except Overloaded:
+            raise self.overloaded()
+        try:
+            await limiter.acquire()
+        except BaseException as e:
+            if operation_limiter is not None:
+                operation_limiter.release()
+            if isinstance(e, Overloaded):
+                raise self.overloaded()
+            raise
+        saturated = limiter.active >= int(limiter.limit)
+        timings = current_timings()
+        start = time.perf_counter()
+        waited = timings.db_seconds + timings.write_wait_seconds if timings is not None else 0.0
+        released = False
+
+        def release():
+            nonlocal released
+            if released:
+                return
+            released = True
+            if timings is not None:
+                db_wait = timings.db_seconds + timings.write_wait_seconds - waited
+            else:
+                db_wait = time.perf_counter() - start
+            limiter.observe(db_wait, saturated)
+            limiter.release()
+            if operation_limiter is not None:
+                operation_limiter.release()
+
+        return release
+
+    def metrics(self) -> list:
+        samples = []
+        for name, limiter in self.budgets.items():
+            samples += [
+                (f"aep_admission_{name}_limit", "gauge", f"Current concurrency limit for {name}s.", int(limiter.limit)),
+                (f"aep_admission_{name}_active", "gauge", f"{name.capitalize()}s currently admitted.", limiter.active),
+                (f"aep_admission_{name}_queued", "gauge", f"{name.capitalize()}s waiting for a slot.", len(limiter._waiters)),
+                (f"aep_admission_{name}_rejected_total", "counter", f"{name.capitalize()}s rejected with 503.", limiter.rejected),
+            ]
+        return samples
+
+
+async def _release_after(body: AsyncIterator, release: Callable[[], None]) -> AsyncIterator:
+    try:
+        async for chunk in body:
+            yield chunk
+    finally:
+        release()
+
+
+admission = AdmissionController(settings)
+
+
+class AdmissionRoute(InstrumentedRoute):
+    """Admits each call to the endpoint through the admission controller.
+
+    GETs take a read slot, everything else a write slot.
+    """
+
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        operation = kwargs.get("operation_id") or endpoint.__name__
+        budget = READ if set(kwargs.get("methods") or ()) <= {"GET", "HEAD"} else WRITE
+
+        @functools.wraps(endpoint)
+        async def admitted_endpoint(*args, **kwargs):
+            return await admission.run(operation, budget, lambda: endpoint(*args, **kwargs))
+
+        super().__init__(path, admitted_endpoint, **kwargs)
+        # include_router() copies routes from their endpoint, which would
+        # admit every request twice.
+        self.endpoint = endpoint
@@ -0,0 +1,149 @@
+import asyncio
+
+import pytest
+from fastapi import APIRouter, FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+from starlette.exceptions import HTTPException as StarletteHTTPException
+
+from aep_example import admission as admission_module
+from aep_example.admission import READ, WRITE, AdaptiveLimiter, AdmissionController, AdmissionRoute, Limiter, Overloaded
+from aep_example.config import Settings
+from aep_example.exceptions import http_exception_handler
+
+
+def test_limiter_queues_then_rejects():
+    async def check():
+        limiter = Limiter(1, max_queue=1, queue_timeout_seconds=5)
+        await limiter.acquire()
+        queued = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        # The queue is full: rejected without waiting.
+        with pytest.raises(Overloaded):
+            await limiter.acquire()
+        limiter.release()
+        await queued
+        assert limiter.active == 1
+        assert limiter.rejected == 1
+
+    asyncio.run(check())
+
+
+def test_limiter_queue_timeout():
+    async def check():
+        limiter = Limiter(1, max_queue=10, queue_timeout_seconds=0.01)
+        await limiter.acquire()
+        with pytest.raises(Overloaded):
+            await limiter.acquire()
+        assert not limiter._waiters
+        limiter.release()
+        assert limiter.active == 0
+
+    asyncio.run(check())
+
+
+def test_adaptive_limit():
+    limiter = AdaptiveLimiter(8, min_limit=2, max_queue=0, queue_timeout_seconds=0, target_seconds=0.1)
+    limiter.observe(0.5, saturated=True)
+    assert limiter.limit == 6
+    # Requests admitted before the cut don't cut it again right away.
+    limiter.observe(0.5, saturated=True)
+    assert limiter.limit == 6
+    for _ in range(10):
+        limiter._last_decrease = 0
+        limiter.observe(0.5, saturated=True)
+    assert limiter.limit == 2
+    # Only grows back while the limit holds requests back.
+    limiter.observe(0.01, saturated=False)
+    assert limiter.limit == 2
+    for _ in range(100):
+        limiter.observe(0.01, saturated=True)
+    assert limiter.limit == 8
+
+
+def test_overloaded_route(monkeypatch):
+    controller = AdmissionController(Settings(admission_read_limit=1, admission_max_queue=0, admission_retry_after_seconds=3))
+    monkeypatch.setattr(admission_module, "admission", controller)
+    router = APIRouter(route_class=AdmissionRoute)
+
+    @router.get("/things", operation_id="ListThings")
+    async def list_things():
+        return {"things": [], "active": controller.budgets[READ].active}
+
+    @router.post("/things", operation_id="CreateThing")
+    async def create_thing():
+        raise HTTPException(status_code=409, detail="Exists")
+
+    app = FastAPI()
+    app.add_exception_handler(StarletteHTTPException, http_exception_handler)
+    app.include_router(router)
+    client = TestClient(app)
+
+    assert client.get("/things").json()["active"] == 1
+    assert controller.budgets[READ].active == 0
+    assert client.post("/things").status_code == 409
+    assert controller.budgets[WRITE].active == 0
+
+    controller.budgets[READ].active = 1
+    response = client.get("/things")
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "3"
+    assert response.headers["content-type"] == "application/problem+json"
+    assert controller.budgets[READ].rejected == 1
+    # Writes have a budget of their own.
+    assert client.post("/things").status_code == 409
+
+
+def test_operation_limit():
+    controller = AdmissionController(Settings(admission_max_queue=0, admission_operation_limits={"ExportThings": 1}))
+
+    async def check():
+        release = asyncio.Event()
+
+        async def export():
+            await release.wait()
+
+        first = asyncio.create_task(controller.run("ExportThings", READ, export))
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as e:
+            await controller.run("ExportThings", READ, export)
+        assert e.value.status_code == 503
+        # Other reads still get in.
+        assert await controller.run("ListThings", READ, lambda: asyncio.sleep(0, "ok")) == "ok"
+        release.set()
+        await first
+        assert controller.operations["ExportThings"].active == 0
+
+    asyncio.run(check())
+
+
+def test_streams_hold_their_slot():
+    controller = AdmissionController(Settings(admission_max_queue=0, admission_operation_limits={"ExportThings": 1, "WatchThings": 1}))
+
+    async def body():
+        yield b"a"
+        yield b"b"
+
+    async def check():
+        async def export():
+            return StreamingResponse(body(), media_type="application/x-ndjson")
+
+        response = await controller.run("ExportThings", READ, export)
+        # Exports read as they stream, so the slot is held until the body ends.
+        assert controller.operations["ExportThings"].active == 1
+        assert controller.budgets[READ].active == 1
+        with pytest.raises(HTTPException):
+            await controller.run("ExportThings", READ, export)
+        assert [chunk async for chunk in response.body_iterator] == [b"a", b"b"]
+        assert controller.operations["ExportThings"].active == 0
+        assert controller.budgets[READ].active == 0
+
+        # Watches stay open indefinitely, so they don't.
+        async def watch():
+            return StreamingResponse(body(), media_type="text/event-stream")
+
+        await controller.run("WatchThings", READ, watch)
+        assert controller.operations["WatchThings"].active == 0
+        assert controller.budgets[READ].active == 0
+
+    asyncio.run(check())
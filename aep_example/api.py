@@ -1,206 +1,633 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, BackgroundTasks, Depends, Header, HTTPException, Query, Request, Response, status
+from fastapi.responses import FileResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from sqlalchemy import func
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from typing import List
-
-from .db import get_db, DBShelf, DBBook
-from .db import get_db, DBShelf, DBBook
-from .models import Shelf, Book, ListShelvesResponse, ListBooksResponse, ShelfUpdate, BookUpdate
+from typing import List, Optional
+
+from .admission import AdmissionRoute
+from .cache import ResourceCache, get_cache
+from .changes import SSE_MEDIA_TYPE, interleave
+from .config import settings
+from .db import DBShelf, DBChange, DBOperation
+from .models import Shelf, Book, ListShelvesResponse, ListBooksResponse, ShelfUpdate, BookUpdate, ProblemDetails, Operation
+from .models import (
+    BatchCreateShelvesRequest, BatchCreateShelvesResponse, BatchGetShelvesResponse, BatchDeleteShelvesRequest,
+    BatchCreateBooksRequest, BatchCreateBooksResponse, BatchGetBooksResponse, BatchDeleteBooksRequest,
+)
+from . import etag as etags
+from .filtering import InvalidFilter
+from .pagination import InvalidPageToken, decode_page_token, encode_page_token
+from .streaming import NDJSON_LIST_RESPONSE, NDJSON_MEDIA_TYPE, ndjson_page, wants_ndjson
+from .read_mask import BOOK_FIELDS, SHELF_FIELDS, InvalidReadMask, parse_read_mask
+from .serialization import TrustedJSONResponse, book_dict, masked_dict, shelf_dict, to_json
+from .existence import Existence, get_existence
+from .export import SNAPSHOT_MEDIA_TYPE, export_library, export_snapshot
+from .imports import CSV_MEDIA_TYPE, IMPORT_MEDIA_TYPES, BookImporter, csv_rows, ndjson_rows
+from .operations import create_operation, operation_dict, run_operation
+from .repository import Repository, get_database, get_repository
+from .shards import Shard, Shards
+import asyncio
+import os
+import tempfile
 import uuid
 
-router = APIRouter()
+router = APIRouter(route_class=AdmissionRoute)
+
+# Keeps every batch within SQLite's bound-parameter limit for the IN (...) queries.
+MAX_BATCH_SIZE = 1000
+
+# Stands for every shelf in a collection path (AEP-159), so it can't be a shelf ID.
+WILDCARD = "-"
+
+def _page_token_key(page_token: str, scope: dict) -> str:
+    try:
+        return decode_page_token(page_token, scope)
+    except InvalidPageToken as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def _read_mask(read_mask: Optional[str], fields) -> tuple:
+    try:
+        return parse_read_mask(read_mask, fields)
+    except InvalidReadMask as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+READ_MASK = Query(None, description="Comma separated fields to return, e.g. `path,title`. Defaults to every field.")
+
+DEFAULT_PAGE_SIZE = 10
+MAX_PAGE_SIZE = Query(DEFAULT_PAGE_SIZE, ge=0, description="Most resources to return. 0 means the default.")
+
+def _page_size(max_page_size: int) -> int:
+    # AEP-158: 0 stands for the default, so a page is never empty for lack
+    # of room, and sizes over the maximum are cut to it.
+    return min(max_page_size or DEFAULT_PAGE_SIZE, settings.max_page_size)
+
+def _shelf_to_dict(fields):
+    if fields == SHELF_FIELDS:
+        return lambda s: shelf_dict(s.id, s.theme)
+    return lambda s: masked_dict(fields, f"shelves/{s.id}", s)
+
+def _book_to_dict(shelf_id: Optional[str], fields):
+    """Rows to books on shelf_id, or with shelf_id None, on each row's own shelf."""
+    if shelf_id is None:
+        if fields == BOOK_FIELDS:
+            return lambda b: book_dict(b.shelf_id, b.id, b.title, b.author)
+        return lambda b: masked_dict(fields, f"shelves/{b.shelf_id}/books/{b.id}", b)
+    if fields == BOOK_FIELDS:
+        return lambda b: book_dict(shelf_id, b.id, b.title, b.author)
+    return lambda b: masked_dict(fields, f"shelves/{shelf_id}/books/{b.id}", b)
+
+def _not_modified(etag: str) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etags.quote(etag)})
+
+def _with_etag(content, etag: str, status_code: int = 200) -> TrustedJSONResponse:
+    return TrustedJSONResponse(content, status_code=status_code, headers={"ETag": etags.quote(etag)})
+
+def _if_match_values(if_match: Optional[str]) -> Optional[List[str]]:
+    """The etags an update must match, or None when the update is unconditional."""
+    values = etags.parse(if_match, weak=False)
+    if if_match is None or "*" in values:
+        return None
+    return values
+
+def _check_batch_size(n: int):
+    if n > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"Batch size must not exceed {MAX_BATCH_SIZE}")
+
+def _shelf_id_from_path(path: str) -> str:
+    parts = path.split("/")
+    if len(parts) != 2 or parts[0] != "shelves" or not parts[1]:
+        raise HTTPException(status_code=400, detail=f"Invalid shelf path: {path}")
+    return parts[1]
+
+def _book_id_from_path(path: str, shelf_id: str) -> str:
+    parts = path.split("/")
+    if len(parts) != 4 or parts[0] != "shelves" or parts[2] != "books" or not parts[3]:
+        raise HTTPException(status_code=400, detail=f"Invalid book path: {path}")
+    if parts[1] != shelf_id:
+        raise HTTPException(status_code=400, detail=f"Book path {path} is not under shelves/{shelf_id}")
+    return parts[3]
+
+def _check_shelf_id(shelf_id: str):
+    if shelf_id == WILDCARD:
+        raise HTTPException(status_code=400, detail=f"{WILDCARD!r} is reserved and can't be used as a shelf ID")
+
+def _new_ids(requested_ids, kind: str) -> List[str]:
+    ids = [i or str(uuid.uuid4()) for i in requested_ids]
+    if len(set(ids)) != len(ids):
+        raise HTTPException(status_code=409, detail=f"Duplicate {kind} IDs in batch")
+    return ids
 
 # --- Shelves ---
 
-@router.get("/shelves", response_model=ListShelvesResponse, operation_id="ListShelves", description="List shelves in the library.")
+@router.get("/shelves", response_model=ListShelvesResponse, operation_id="ListShelves", description="List shelves in the library. Send `Accept: application/x-ndjson` to stream the page.", responses={304: {"description": "Not Modified"}, **NDJSON_LIST_RESPONSE})
 async def list_shelves(
-    max_page_size: int = 10,
+    max_page_size: int = MAX_PAGE_SIZE,
     page_token: str = "",
-    db: AsyncSession = Depends(get_db)
+    read_mask: Optional[str] = READ_MASK,
+    if_none_match: Optional[str] = Header(None),
+    accept: Optional[str] = Header(None),
+    repository: Repository = Depends(get_repository)
 ):
-    query = select(DBShelf).order_by(DBShelf.id)
-    if page_token:
-        query = query.where(DBShelf.id >= page_token)
+    max_page_size = _page_size(max_page_size)
+    scope = {"collection": "shelves"}
+    fields = _read_mask(read_mask, SHELF_FIELDS)
+    to_dict = _shelf_to_dict(fields)
+    after = _page_token_key(page_token, scope) if page_token else None
+
+    if wants_ndjson(accept):
+        rows, close = await repository.stream_shelves(after, max_page_size + 1, fields)
+        return ndjson_page(rows, max_page_size, scope, to_dict, close)
 
-    result = await db.execute(query.limit(max_page_size + 1))
-    shelves = result.scalars().all()
+    shelves = await repository.list_shelves(after, max_page_size + 1, fields)
 
     next_token = ""
     if len(shelves) > max_page_size:
-        next_token = shelves[max_page_size].id
         shelves = shelves[:max_page_size]
+        next_token = encode_page_token(shelves[-1].id, scope)
 
-    return ListShelvesResponse(
-        shelves=[Shelf(path=f"shelves/{s.id}", theme=s.theme) for s in shelves],
-        next_page_token=next_token
-    )
+    etag = etags.list_etag(((s.id, s.etag) for s in shelves), next_token)
+    if etags.matches(if_none_match, etag):
+        return _not_modified(etag)
+
+    return _with_etag({
+        "shelves": [to_dict(s) for s in shelves],
+        "next_page_token": next_token,
+    }, etag)
 
 @router.post("/shelves", response_model=Shelf, status_code=status.HTTP_201_CREATED, operation_id="CreateShelf", description="Create a new shelf.")
 async def create_shelf(
     shelf: Shelf,
     id: str = None, # AEP standard query param
-    db: AsyncSession = Depends(get_db)
+    repository: Repository = Depends(get_repository),
+    cache: ResourceCache = Depends(get_cache)
 ):
     # Construct ID
     if id:
         new_id = id
     else:
         new_id = str(uuid.uuid4())
+    _check_shelf_id(new_id)
+    etag = etags.new_etag()
 
-    # Check if exists
-    result = await db.execute(select(DBShelf).where(DBShelf.id == new_id))
-    if result.scalars().first():
-         raise HTTPException(status_code=409, detail="Shelf already exists")
-
-    new_shelf = DBShelf(id=new_id, theme=shelf.theme)
-    db.add(new_shelf)
-    await db.commit()
-    await db.refresh(new_shelf)
+    await repository.create_shelf(new_id, shelf.theme, etag)
+    cache.invalidate(f"shelves/{new_id}")
 
     # Return shelf with populated path
-    return Shelf(path=f"shelves/{new_shelf.id}", theme=new_shelf.theme)
-
-@router.get("/shelves/{shelf_id}", response_model=Shelf, operation_id="GetShelf", description="Get a shelf by ID.")
-async def get_shelf(shelf_id: str, db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(DBShelf).where(DBShelf.id == shelf_id))
-    shelf = result.scalars().first()
-    if not shelf:
-        raise HTTPException(status_code=404, detail="Shelf not found")
-    return Shelf(path=f"shelves/{shelf.id}", theme=shelf.theme)
-
-@router.delete("/shelves/{shelf_id}", status_code=status.HTTP_204_NO_CONTENT, operation_id="DeleteShelf", description="Delete a shelf.")
-async def delete_shelf(shelf_id: str, db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(DBShelf).where(DBShelf.id == shelf_id))
-    shelf = result.scalars().first()
-    if not shelf:
-        raise HTTPException(status_code=404, detail="Shelf not found")
-
-    await db.delete(shelf)
-    await db.commit()
+    return _with_etag(shelf_dict(new_id, shelf.theme), etag, status.HTTP_201_CREATED)
+
+@router.get("/shelves/{shelf_id}", response_model=Shelf, operation_id="GetShelf", description="Get a shelf by ID.", responses={304: {"description": "Not Modified"}})
+async def get_shelf(
+    shelf_id: str,
+    read_mask: Optional[str] = READ_MASK,
+    if_none_match: Optional[str] = Header(None),
+    repository: Repository = Depends(get_repository),
+    cache: ResourceCache = Depends(get_cache)
+):
+    path = f"shelves/{shelf_id}"
+    fields = _read_mask(read_mask, SHELF_FIELDS)
+    cached = cache.get(path)
+    if cached is None:
+        generation = cache.generation
+        row = await repository.get_shelf(shelf_id, fields)
+        if not row:
+            raise HTTPException(status_code=404, detail="Shelf not found")
+        # Checked before encoding the body, so a 304 skips serialization.
+        if etags.matches(if_none_match, row.etag):
+            return _not_modified(row.etag)
+        resource = _shelf_to_dict(fields)(row)
+        if fields != SHELF_FIELDS:
+            # A partial read doesn't fill the cache.
+            return _with_etag(resource, row.etag)
+        # Cached pre-encoded, so full hits skip serialization entirely.
+        cached = (row.etag, resource, to_json(resource))
+        cache.set(path, cached, generation)
+    elif etags.matches(if_none_match, cached[0]):
+        return _not_modified(cached[0])
+
+    etag, resource, body = cached
+    if fields != SHELF_FIELDS:
+        return _with_etag({f: resource[f] for f in fields}, etag)
+    return _with_etag(body, etag)
+
+@router.delete("/shelves/{shelf_id}", status_code=status.HTTP_204_NO_CONTENT, operation_id="DeleteShelf", description="Delete a shelf. A shelf with books can only be deleted with `force=true`, which deletes its books in the background and returns a long-running operation.", responses={202: {"model": Operation, "description": "Deletion started"}, 409: {"model": ProblemDetails, "description": "Shelf is not empty"}})
+async def delete_shelf(
+    shelf_id: str,
+    background_tasks: BackgroundTasks,
+    force: bool = False,
+    repository: Repository = Depends(get_repository),
+    cache: ResourceCache = Depends(get_cache)
+):
+    if force:
+        operation = await repository.force_delete_shelf(shelf_id, cache)
+        if operation is None:
+            return None
+        operation, work = operation
+        background_tasks.add_task(work)
+        return TrustedJSONResponse(operation, status_code=status.HTTP_202_ACCEPTED)
+
+    await repository.delete_shelf(shelf_id)
+    cache.invalidate(f"shelves/{shelf_id}")
     return None
 
-@router.patch("/shelves/{shelf_id}", response_model=Shelf, operation_id="UpdateShelf", description="Update a shelf.")
+@router.patch("/shelves/{shelf_id}", response_model=Shelf, operation_id="UpdateShelf", description="Update a shelf.", responses={412: {"model": ProblemDetails, "description": "Precondition Failed"}})
 async def update_shelf(
     shelf_id: str,
     shelf: ShelfUpdate,
-    db: AsyncSession = Depends(get_db)
+    if_match: Optional[str] = Header(None),
+    repository: Repository = Depends(get_repository),
+    cache: ResourceCache = Depends(get_cache)
+):
+    values = shelf.model_dump(exclude_unset=True, exclude={"path"})
+    updated = await repository.update_shelf(shelf_id, values, etags.new_etag(), _if_match_values(if_match))
+    cache.invalidate(f"shelves/{shelf_id}")
+    return _with_etag(shelf_dict(shelf_id, updated.theme), updated.etag)
+
+@router.post("/shelves:batchCreate", response_model=BatchCreateShelvesResponse, operation_id="BatchCreateShelves", description="Create multiple shelves in a single transaction (one per shard, with sharded storage).")
+async def batch_create_shelves(
+    batch: BatchCreateShelvesRequest,
+    repository: Repository = Depends(get_repository),
+    cache: ResourceCache = Depends(get_cache)
 ):
-    result = await db.execute(select(DBShelf).where(DBShelf.id == shelf_id))
-    existing_shelf = result.scalars().first()
-    if not existing_shelf:
-        raise HTTPException(status_code=404, detail="Shelf not found")
+    _check_batch_size(len(batch.requests))
+    ids = _new_ids([r.id for r in batch.requests], "shelf")
+    for i in ids:
+        _check_shelf_id(i)
+    rows = [{"id": i, "theme": r.shelf.theme, "etag": etags.new_etag()} for i, r in zip(ids, batch.requests)]
+
+    await repository.batch_create_shelves(rows)
+    for i in ids:
+        cache.invalidate(f"shelves/{i}")
+
+    return TrustedJSONResponse({"results": [shelf_dict(row["id"], row["theme"]) for row in rows]})
+
+@router.get("/shelves:batchGet", response_model=BatchGetShelvesResponse, operation_id="BatchGetShelves", description="Get multiple shelves by path.")
+async def batch_get_shelves(
+    paths: List[str] = Query(default=[]),
+    repository: Repository = Depends(get_repository)
+):
+    _check_batch_size(len(paths))
+    ids = [_shelf_id_from_path(p) for p in paths]
+
+    found = await repository.batch_get_shelves(ids)
+    missing = [i for i in ids if i not in found]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Shelf not found: shelves/{missing[0]}")
 
-    update_data = shelf.model_dump(exclude_unset=True)
-    for key, value in update_data.items():
-        setattr(existing_shelf, key, value)
+    return TrustedJSONResponse({"results": [shelf_dict(i, found[i].theme) for i in ids]})
 
-    await db.commit()
-    await db.refresh(existing_shelf)
-    return Shelf(path=f"shelves/{existing_shelf.id}", theme=existing_shelf.theme)
+@router.post("/shelves:batchDelete", status_code=status.HTTP_204_NO_CONTENT, operation_id="BatchDeleteShelves", description="Delete multiple shelves in a single transaction (one per shard, with sharded storage).")
+async def batch_delete_shelves(
+    batch: BatchDeleteShelvesRequest,
+    repository: Repository = Depends(get_repository),
+    cache: ResourceCache = Depends(get_cache)
+):
+    _check_batch_size(len(batch.paths))
+    ids = [_shelf_id_from_path(p) for p in batch.paths]
+
+    await repository.batch_delete_shelves(ids)
+    for i in set(ids):
+        cache.invalidate(f"shelves/{i}")
+    return None
+
+EXPORT_RESPONSE = {
+    200: {
+        "description": "Every shelf, each followed by its books, one per line, then a line with the counts. With `format=sqlite`, a copy of the database.",
+        "content": {NDJSON_MEDIA_TYPE: {"schema": {"type": "string"}}, SNAPSHOT_MEDIA_TYPE: {"schema": {"type": "string", "format": "binary"}}},
+    }
+}
+
+@router.get("/shelves:export", operation_id="ExportShelves", description="Export the whole library from one consistent snapshot (one per shard, with sharded storage), without blocking writers.", responses=EXPORT_RESPONSE)
+async def export_shelves(
+    format: str = Query("ndjson", pattern="^(ndjson|sqlite)$", description="`ndjson`, or `sqlite` for a copy of the database file."),
+    shards: Shards = Depends(get_database)
+):
+    if format == "ndjson":
+        return StreamingResponse(export_library([shard.session_factory for shard in shards]), media_type=NDJSON_MEDIA_TYPE)
+    if len(shards) > 1:
+        raise HTTPException(status_code=400, detail=f"The library is spread over {len(shards)} database files, copy them with `aep-server export --snapshot`")
+
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    try:
+        async with shards[0].session_factory() as db:
+            await export_snapshot(db, path)
+    except ValueError as e:
+        os.remove(path)
+        raise HTTPException(status_code=400, detail=str(e))
+    except BaseException:
+        os.remove(path)
+        raise
+    return FileResponse(path, media_type=SNAPSHOT_MEDIA_TYPE, filename="library.db", background=BackgroundTask(os.remove, path))
+
+WATCH_RESPONSE = {
+    200: {
+        "description": "Server-Sent Events, one per change: `event` is created, updated or deleted, `id` the revision and `data` the change as JSON, with the resource after the change. Reconnect with `Last-Event-ID` to resume. With sharded storage, shelves' event ids hold the revision of every shard, joined with dots.",
+        "content": {SSE_MEDIA_TYPE: {"schema": {"type": "string"}}},
+    },
+    410: {"model": ProblemDetails, "description": "The revision to resume from is no longer in the change log"},
+}
+
+START_REVISION = Query(None, ge=0, description="Stream the changes after this revision. Defaults to the current revision, or to `Last-Event-ID` when reconnecting.")
+
+async def _watch(collection: str, start_revision: Optional[int], last_event_id: Optional[str], shards: List[Shard], parent_id: Optional[str] = None):
+    """Stream a collection spread over shards, resuming from a revision of each."""
+    revisions = None
+    if last_event_id:
+        try:
+            revisions = [int(r) for r in last_event_id.split(".")]
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Last-Event-ID must be a revision")
+        if len(revisions) != len(shards):
+            raise HTTPException(status_code=410, detail="Last-Event-ID is from before the library was resharded, list the collection again and watch from the current revision")
+    elif start_revision is not None:
+        if len(shards) > 1:
+            raise HTTPException(status_code=400, detail="start_revision can't resume a stream over several shards, resume it with Last-Event-ID")
+        revisions = [start_revision]
+
+    async def bounds(shard: Shard):
+        async with shard.session_factory() as db:
+            if parent_id is not None:
+                if not (await db.execute(select(DBShelf.id).where(DBShelf.id == parent_id))).first():
+                    raise HTTPException(status_code=404, detail="Parent shelf not found")
+            return (await db.execute(select(func.min(DBChange.revision), func.max(DBChange.revision)))).one()
+
+    logs = await asyncio.gather(*(bounds(shard) for shard in shards))
+    if revisions is None:
+        revisions = [head or 0 for _, head in logs]
+    for revision, (oldest, head) in zip(revisions, logs):
+        # Past the head, the revision is from a log that has since been
+        # replaced, by a reshard or a restore.
+        if (oldest is not None and revision < oldest - 1) or revision > (head or 0):
+            raise HTTPException(status_code=410, detail=f"Revision {last_event_id or revision} is no longer in the change log, list the collection again and watch from the current revision")
+
+    if len(shards) == 1:
+        events = shards[0].feed.events(collection, revisions[0], shards[0].session_factory)
+    else:
+        def event_id(i: int):
+            def revision_vector(revision: int) -> bytes:
+                revisions[i] = revision
+                return ".".join(map(str, revisions)).encode()
+            return revision_vector
+
+        events = interleave([
+            shard.feed.events(collection, revisions[i], shard.session_factory, event_id(i))
+            for i, shard in enumerate(shards)
+        ])
+    return StreamingResponse(
+        events,
+        media_type=SSE_MEDIA_TYPE,
+        # Stops proxies such as nginx from buffering the stream.
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@router.get("/shelves:watch", operation_id="WatchShelves", description="Stream changes to shelves as Server-Sent Events, instead of polling ListShelves.", responses=WATCH_RESPONSE)
+async def watch_shelves(
+    start_revision: Optional[int] = START_REVISION,
+    last_event_id: Optional[str] = Header(None),
+    shards: Shards = Depends(get_database)
+):
+    return await _watch("shelves", start_revision, last_event_id, list(shards))
 
 # --- Books ---
 
-@router.get("/shelves/{shelf_id}/books", response_model=ListBooksResponse, operation_id="ListBooks", description="List books on a shelf.")
+@router.get("/shelves/{shelf_id}/books", response_model=ListBooksResponse, operation_id="ListBooks", description="List books on a shelf, or on every shelf with `-` as the shelf. Send `Accept: application/x-ndjson` to stream the page.", responses={304: {"description": "Not Modified"}, **NDJSON_LIST_RESPONSE})
 async def list_books(
     shelf_id: str,
-    max_page_size: int = 10,
+    max_page_size: int = MAX_PAGE_SIZE,
     page_token: str = "",
-    db: AsyncSession = Depends(get_db)
+    filter: str = Query("", description='Filter expression, e.g. `author = "Ursula K. Le Guin" AND title:"earthsea"`. `:` searches for a substring.'),
+    read_mask: Optional[str] = READ_MASK,
+    if_none_match: Optional[str] = Header(None),
+    accept: Optional[str] = Header(None),
+    repository: Repository = Depends(get_repository)
 ):
-    # Verify parent exists
-    s_result = await db.execute(select(DBShelf).where(DBShelf.id == shelf_id))
-    if not s_result.scalars().first():
-         raise HTTPException(status_code=404, detail="Parent shelf not found")
-
-    query = select(DBBook).where(DBBook.shelf_id == shelf_id).order_by(DBBook.id)
-    if page_token:
-        query = query.where(DBBook.id >= page_token)
-
-    result = await db.execute(query.limit(max_page_size + 1))
-    books = result.scalars().all()
-
+    # Books on every shelf (AEP-159), with no parent to check.
+    parent_id = None if shelf_id == WILDCARD else shelf_id
+    max_page_size = _page_size(max_page_size)
+    scope = {"collection": f"shelves/{shelf_id}/books"}
+    fields = _read_mask(read_mask, BOOK_FIELDS)
+    to_dict = _book_to_dict(parent_id, fields)
+    if filter.strip():
+        # Page tokens are only valid for the filter they were issued for.
+        scope["filter"] = filter
+    after = _page_token_key(page_token, scope) if page_token else None
+
+    try:
+        if wants_ndjson(accept):
+            page = await repository.stream_books(parent_id, after, max_page_size + 1, fields, filter)
+        else:
+            page = await repository.list_books(parent_id, after, max_page_size + 1, fields, filter)
+    except InvalidFilter as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if page is None:
+        raise HTTPException(status_code=404, detail="Parent shelf not found")
+
+    if wants_ndjson(accept):
+        rows, close = page
+        return ndjson_page(rows, max_page_size, scope, to_dict, close)
+    return _books_page(page, max_page_size, scope, to_dict, if_none_match)
+
+def _books_page(books, max_page_size: int, scope: dict, to_dict, if_none_match: Optional[str]):
     next_token = ""
     if len(books) > max_page_size:
-        next_token = books[max_page_size].id
         books = books[:max_page_size]
+        next_token = encode_page_token(books[-1].id, scope)
 
-    return ListBooksResponse(
-        books=[Book(path=f"shelves/{shelf_id}/books/{b.id}", title=b.title, author=b.author) for b in books],
-        next_page_token=next_token
-    )
+    etag = etags.list_etag(((b.id, b.etag) for b in books), next_token)
+    if etags.matches(if_none_match, etag):
+        return _not_modified(etag)
+
+    return _with_etag({
+        "books": [to_dict(b) for b in books],
+        "next_page_token": next_token,
+    }, etag)
 
 @router.post("/shelves/{shelf_id}/books", response_model=Book, status_code=status.HTTP_201_CREATED, operation_id="CreateBook", description="Create a new book on a shelf.")
 async def create_book(
     shelf_id: str,
     book: Book,
     id: str = None,
-    db: AsyncSession = Depends(get_db)
+    repository: Repository = Depends(get_repository),
+    cache: ResourceCache = Depends(get_cache)
 ):
-    # Verify parent exists
-    s_result = await db.execute(select(DBShelf).where(DBShelf.id == shelf_id))
-    if not s_result.scalars().first():
-         raise HTTPException(status_code=404, detail="Parent shelf not found")
-
     # Construct ID
     if id:
         new_id = id
     else:
         new_id = str(uuid.uuid4())
+    etag = etags.new_etag()
 
-    result = await db.execute(select(DBBook).where(DBBook.id == new_id))
-    if result.scalars().first():
-         raise HTTPException(status_code=409, detail="Book already exists")
-
-    new_book = DBBook(id=new_id, title=book.title, author=book.author, shelf_id=shelf_id)
-    db.add(new_book)
-    await db.commit()
-    await db.refresh(new_book)
+    await repository.create_book(shelf_id, new_id, book.title, book.author, etag)
+    cache.invalidate(f"shelves/{shelf_id}/books/{new_id}")
 
-    return Book(path=f"shelves/{shelf_id}/books/{new_book.id}", title=new_book.title, author=new_book.author)
+    return _with_etag(book_dict(shelf_id, new_id, book.title, book.author), etag, status.HTTP_201_CREATED)
 
-@router.get("/shelves/{shelf_id}/books/{book_id}", response_model=Book, operation_id="GetBook", description="Get a book by ID.")
-async def get_book(shelf_id: str, book_id: str, db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(DBBook).where(DBBook.id == book_id))
-    book = result.scalars().first()
-    if not book:
-        raise HTTPException(status_code=404, detail="Book not found")
-    return Book(path=f"shelves/{shelf_id}/books/{book.id}", title=book.title, author=book.author)
+@router.get("/shelves/{shelf_id}/books/{book_id}", response_model=Book, operation_id="GetBook", description="Get a book by ID.", responses={304: {"description": "Not Modified"}})
+async def get_book(
+    shelf_id: str,
+    book_id: str,
+    read_mask: Optional[str] = READ_MASK,
+    if_none_match: Optional[str] = Header(None),
+    repository: Repository = Depends(get_repository),
+    cache: ResourceCache = Depends(get_cache)
+):
+    path = f"shelves/{shelf_id}/books/{book_id}"
+    fields = _read_mask(read_mask, BOOK_FIELDS)
+    cached = cache.get(path)
+    if cached is None:
+        generation = cache.generation
+        row = await repository.get_book(shelf_id, book_id, fields)
+        if not row:
+            raise HTTPException(status_code=404, detail="Book not found")
+        # Checked before encoding the body, so a 304 skips serialization.
+        if etags.matches(if_none_match, row.etag):
+            return _not_modified(row.etag)
+        resource = _book_to_dict(shelf_id, fields)(row)
+        if fields != BOOK_FIELDS:
+            return _with_etag(resource, row.etag)
+        cached = (row.etag, resource, to_json(resource))
+        cache.set(path, cached, generation)
+    elif etags.matches(if_none_match, cached[0]):
+        return _not_modified(cached[0])
+
+    etag, resource, body = cached
+    if fields != BOOK_FIELDS:
+        return _with_etag({f: resource[f] for f in fields}, etag)
+    return _with_etag(body, etag)
 
 @router.delete("/shelves/{shelf_id}/books/{book_id}", status_code=status.HTTP_204_NO_CONTENT, operation_id="DeleteBook", description="Delete a book.")
-async def delete_book(shelf_id: str, book_id: str, db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(DBBook).where(DBBook.id == book_id))
-    book = result.scalars().first()
-    if not book:
-        raise HTTPException(status_code=404, detail="Book not found")
-
-    await db.delete(book)
-    await db.commit()
+async def delete_book(shelf_id: str, book_id: str, repository: Repository = Depends(get_repository), cache: ResourceCache = Depends(get_cache)):
+    await repository.delete_book(shelf_id, book_id)
+    cache.invalidate(f"shelves/{shelf_id}/books/{book_id}")
     return None
 
-@router.patch("/shelves/{shelf_id}/books/{book_id}", response_model=Book, operation_id="UpdateBook", description="Update a book.")
+@router.patch("/shelves/{shelf_id}/books/{book_id}", response_model=Book, operation_id="UpdateBook", description="Update a book.", responses={412: {"model": ProblemDetails, "description": "Precondition Failed"}})
 async def update_book(
     shelf_id: str,
     book_id: str,
     book: BookUpdate,
-    db: AsyncSession = Depends(get_db)
-):
-    result = await db.execute(select(DBBook).where(DBBook.id == book_id))
-    existing_book = result.scalars().first()
-    if not existing_book:
-        raise HTTPException(status_code=404, detail="Book not found")
-
-    # Optionally verify shelf_id matches
-    if existing_book.shelf_id != shelf_id:
-         # Depending on design, return 404 or verify path consistency
-         # Here we assume the path in URL dictates the resource to find?
-         # But the DBBook stores shelf_id.
-         # If existing_book.shelf_id != shelf_id, technically the resource at URL doesn't exist.
-         raise HTTPException(status_code=404, detail="Book not found in this shelf")
-
-    update_data = book.model_dump(exclude_unset=True)
-    for key, value in update_data.items():
-        setattr(existing_book, key, value)
-
-    await db.commit()
-    await db.refresh(existing_book)
-    return Book(path=f"shelves/{shelf_id}/books/{existing_book.id}", title=existing_book.title, author=existing_book.author)
+    if_match: Optional[str] = Header(None),
+    repository: Repository = Depends(get_repository),
+    cache: ResourceCache = Depends(get_cache)
+):
+    values = book.model_dump(exclude_unset=True, exclude={"path"})
+    updated = await repository.update_book(shelf_id, book_id, values, etags.new_etag(), _if_match_values(if_match))
+    cache.invalidate(f"shelves/{shelf_id}/books/{book_id}")
+    return _with_etag(book_dict(shelf_id, book_id, updated.title, updated.author), updated.etag)
+
+@router.post("/shelves/{shelf_id}/books:batchCreate", response_model=BatchCreateBooksResponse, operation_id="BatchCreateBooks", description="Create multiple books on a shelf in a single transaction.")
+async def batch_create_books(
+    shelf_id: str,
+    batch: BatchCreateBooksRequest,
+    repository: Repository = Depends(get_repository),
+    cache: ResourceCache = Depends(get_cache)
+):
+    _check_batch_size(len(batch.requests))
+    ids = _new_ids([r.id for r in batch.requests], "book")
+    rows = [
+        {"id": i, "title": r.book.title, "author": r.book.author, "etag": etags.new_etag()}
+        for i, r in zip(ids, batch.requests)
+    ]
+
+    await repository.batch_create_books(shelf_id, rows)
+    for i in ids:
+        cache.invalidate(f"shelves/{shelf_id}/books/{i}")
+
+    return TrustedJSONResponse({"results": [book_dict(shelf_id, row["id"], row["title"], row["author"]) for row in rows]})
+
+@router.get("/shelves/{shelf_id}/books:batchGet", response_model=BatchGetBooksResponse, operation_id="BatchGetBooks", description="Get multiple books on a shelf by path.")
+async def batch_get_books(
+    shelf_id: str,
+    paths: List[str] = Query(default=[]),
+    repository: Repository = Depends(get_repository)
+):
+    _check_batch_size(len(paths))
+    ids = [_book_id_from_path(p, shelf_id) for p in paths]
+
+    found = await repository.batch_get_books(shelf_id, ids)
+    missing = [i for i in ids if i not in found]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Book not found: shelves/{shelf_id}/books/{missing[0]}")
+
+    return TrustedJSONResponse({"results": [book_dict(shelf_id, i, found[i].title, found[i].author) for i in ids]})
+
+@router.post("/shelves/{shelf_id}/books:batchDelete", status_code=status.HTTP_204_NO_CONTENT, operation_id="BatchDeleteBooks", description="Delete multiple books on a shelf in a single transaction.")
+async def batch_delete_books(
+    shelf_id: str,
+    batch: BatchDeleteBooksRequest,
+    repository: Repository = Depends(get_repository),
+    cache: ResourceCache = Depends(get_cache)
+):
+    _check_batch_size(len(batch.paths))
+    ids = [_book_id_from_path(p, shelf_id) for p in batch.paths]
+
+    await repository.batch_delete_books(shelf_id, ids)
+    for i in set(ids):
+        cache.invalidate(f"shelves/{shelf_id}/books/{i}")
+    return None
+
+@router.get("/shelves/{shelf_id}/books:watch", operation_id="WatchBooks", description="Stream changes to the books on a shelf as Server-Sent Events, instead of polling ListBooks.", responses={404: {"model": ProblemDetails, "description": "Not Found"}, **WATCH_RESPONSE})
+async def watch_books(
+    shelf_id: str,
+    start_revision: Optional[int] = START_REVISION,
+    last_event_id: Optional[str] = Header(None),
+    shards: Shards = Depends(get_database)
+):
+    return await _watch(f"shelves/{shelf_id}/books", start_revision, last_event_id, [shards.for_shelf(shelf_id)], parent_id=shelf_id)
+
+IMPORT_BOOKS_REQUEST = {
+    "requestBody": {
+        "required": True,
+        "description": "One book per line: NDJSON objects, or CSV with a header row. `id` is optional, `title` and `author` are required.",
+        "content": {media_type: {"schema": {"type": "string"}} for media_type in IMPORT_MEDIA_TYPES},
+    }
+}
+
+@router.post("/shelves/{shelf_id}:importBooks", response_model=Operation, operation_id="ImportBooks", description="Import books onto a shelf from a streamed NDJSON or CSV upload. Rows that fail are reported in the returned operation.", openapi_extra=IMPORT_BOOKS_REQUEST, responses={415: {"model": ProblemDetails, "description": "Unsupported Media Type"}})
+async def import_books(
+    shelf_id: str,
+    request: Request,
+    content_type: Optional[str] = Header(None),
+    shards: Shards = Depends(get_database),
+    cache: ResourceCache = Depends(get_cache),
+    existence: Existence = Depends(get_existence)
+):
+    media_type = (content_type or "").split(";")[0].strip().lower()
+    if media_type not in IMPORT_MEDIA_TYPES:
+        raise HTTPException(status_code=415, detail=f"Content-Type must be one of {', '.join(IMPORT_MEDIA_TYPES)}")
+    parse = csv_rows if media_type == CSV_MEDIA_TYPE else ndjson_rows
+    if not existence.shelves.might_exist(shelf_id):
+        raise HTTPException(status_code=404, detail="Parent shelf not found")
+    shard = shards.for_shelf(shelf_id)
+    writer, feed = shard.writer, shard.feed
+
+    async def start(db: AsyncSession):
+        exists = (await db.execute(select(DBShelf.id).where(DBShelf.id == shelf_id))).first()
+        if not exists:
+            raise HTTPException(status_code=404, detail="Parent shelf not found")
+        return await create_operation(db, {"shelf": f"shelves/{shelf_id}", "books_imported": 0, "rows_failed": 0, "errors": []})
+
+    operation = await writer.run(start)
+    # The body can only be read while the request is open, so the import
+    # runs in the request and the operation is done by the time it's
+    # returned. It records progress as each chunk commits all the same.
+    other_shards = [other for other in shards if other is not shard]
+    importer = BookImporter(shelf_id, operation["path"].split("/")[1], writer, cache, feed, existence.books, settings.operation_chunk_size, other_shards)
+    error = await run_operation(writer, importer.operation_id, lambda: importer.run(parse(request.stream())))
+    return TrustedJSONResponse(importer.operation(error))
+
+# --- Operations ---
+
+@router.get("/operations/{operation_id}", response_model=Operation, operation_id="GetOperation", description="Get the status of a long-running operation.")
+async def get_operation(operation_id: str, shards: Shards = Depends(get_database)):
+    # Operations are recorded on the shard of the shelf they work on.
+    async def get(shard: Shard):
+        async with shard.session_factory() as db:
+            return await db.get(DBOperation, operation_id)
+
+    row = next((row for row in await asyncio.gather(*(get(shard) for shard in shards)) if row), None)
+    if not row:
+        raise HTTPException(status_code=404, detail="Operation not found")
+    return TrustedJSONResponse(operation_dict(row.id, row.done, row.meta, row.error, row.response))
@@ -5,22 +5,22 @@ from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import StaticPool
 import asyncio
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 
+from aep_example.config import Settings, settings
 from aep_example.main import app
-from aep_example.db import get_db, Base
+from aep_example.db import get_session_factory, Base
 from aep_example.models import Shelf, Book
+from aep_example.shards import build_shards, get_shards
 
 TEST_DB_URL = "sqlite+aiosqlite:///./test_api.db"
 
 engine = create_async_engine(TEST_DB_URL, connect_args={"check_same_thread": False}, poolclass=StaticPool)
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine, class_=AsyncSession)
 
-async def override_get_db():
-    async with TestingSessionLocal() as session:
-        yield session
-
-app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_session_factory] = lambda: TestingSessionLocal
 
 client = TestClient(app)
 
@@ -50,8 +50,66 @@ def setup_test_db():
         pass
 
 def test_pagination_flow():
-    # Clear tables first? Or just ignore previous data.
-    pass
+    resp = client.post("/shelves", json={"theme": "Paged"})
+    shelf_id = resp.json()["path"].split("/")[-1]
+    for i in range(5):
+        resp = client.post(f"/shelves/{shelf_id}/books", params={"id": f"page-book-{i}"}, json={"title": f"T{i}", "author": "A"})
+        assert resp.status_code == 201
+
+    seen = []
+    page_token = ""
+    while True:
+        resp = client.get(f"/shelves/{shelf_id}/books", params={"max_page_size": 2, "page_token": page_token})
+        assert resp.status_code == 200
+        data = resp.json()
+        seen.extend(b["path"].split("/")[-1] for b in data["books"])
+        page_token = data["next_page_token"]
+        if not page_token:
+            break
+        # Tokens are opaque rather than the raw next id
+        assert "page-book" not in page_token
+    assert seen == [f"page-book-{i}" for i in range(5)]
+
+    # A token is bound to the collection it was issued for
+    resp = client.get(f"/shelves/{shelf_id}/books", params={"max_page_size": 2})
+    token = resp.json()["next_page_token"]
+    resp = client.post("/shelves", json={"theme": "Other"})
+    other_id = resp.json()["path"].split("/")[-1]
+    assert client.get(f"/shelves/{other_id}/books", params={"page_token": token}).status_code == 400
+    assert client.get(f"/shelves/{shelf_id}/books", params={"page_token": token + "x"}).status_code == 400
+
+    # Empty shelves list fine, missing ones are still 404
+    resp = client.get(f"/shelves/{other_id}/books")
+    assert resp.status_code == 200
+    assert resp.json() == {"books": [], "next_page_token": ""}
+    assert client.get("/shelves/missing/books").status_code == 404
+
+def test_list_shelves_pagination():
+    resp = client.get("/shelves", params={"max_page_size": 1})
+    assert resp.status_code == 200
+    token = resp.json()["next_page_token"]
+    assert token
+    resp = client.get("/shelves", params={"max_page_size": 1, "page_token": token})
+    assert resp.status_code == 200
+    assert client.get("/shelves", params={"page_token": "garbage"}).status_code == 400
+    assert client.get("/shelves", params={"page_token": "YQ.\u00e9"}).status_code == 400
+
+    # 0 means the default page size, and negative sizes are rejected.
+    resp = client.get("/shelves", params={"max_page_size": 0})
+    assert resp.status_code == 200
+    assert resp.json()["shelves"]
+    lines = client.get("/shelves", params={"max_page_size": 0}, headers={"Accept": "application/x-ndjson"}).text.splitlines()
+    assert json.loads(lines[-1])["next_page_token"] is not None
+    assert client.get("/shelves/missing/books", params={"max_page_size": -1}).status_code == 422
+
+def test_max_page_size_is_capped(monkeypatch):
+    for i in range(2):
+        client.post("/shelves", json={"theme": f"Capped {i}"})
+    monkeypatch.setattr(settings, "max_page_size", 1)
+    resp = client.get("/shelves", params={"max_page_size": 100000000})
+    assert resp.status_code == 200
+    assert len(resp.json()["shelves"]) == 1
+    assert resp.json()["next_page_token"]
 
 def test_update_shelf():
     # Create shelf
@@ -100,3 +158,463 @@ def test_update_book():
     data = resp.json()
     assert data["title"] == "Updated Title"
     assert data["author"] == "Updated Author"
+
+def test_batch_shelves():
+    resp = client.post("/shelves:batchCreate", json={"requests": [
+        {"id": "batch-shelf-1", "shelf": {"theme": "One"}},
+        {"id": "batch-shelf-2", "shelf": {"theme": "Two"}},
+    ]})
+    assert resp.status_code == 200
+    assert [s["path"] for s in resp.json()["results"]] == ["shelves/batch-shelf-1", "shelves/batch-shelf-2"]
+
+    # A collision rejects the whole batch
+    resp = client.post("/shelves:batchCreate", json={"requests": [
+        {"id": "batch-shelf-3", "shelf": {"theme": "Three"}},
+        {"id": "batch-shelf-1", "shelf": {"theme": "Again"}},
+    ]})
+    assert resp.status_code == 409
+    assert client.get("/shelves/batch-shelf-3").status_code == 404
+
+    resp = client.get("/shelves:batchGet", params={"paths": ["shelves/batch-shelf-2", "shelves/batch-shelf-1"]})
+    assert resp.status_code == 200
+    assert [s["theme"] for s in resp.json()["results"]] == ["Two", "One"]
+
+    resp = client.get("/shelves:batchGet", params={"paths": ["shelves/batch-shelf-1", "shelves/missing"]})
+    assert resp.status_code == 404
+
+    resp = client.post("/shelves:batchDelete", json={"paths": ["shelves/batch-shelf-1", "shelves/batch-shelf-2"]})
+    assert resp.status_code == 204
+    assert client.get("/shelves/batch-shelf-1").status_code == 404
+
+def test_batch_books():
+    resp = client.post("/shelves", json={"theme": "Batch Books"})
+    shelf_id = resp.json()["path"].split("/")[-1]
+
+    resp = client.post(f"/shelves/{shelf_id}/books:batchCreate", json={"requests": [
+        {"id": "batch-book-1", "book": {"title": "T1", "author": "A1"}},
+        {"book": {"title": "T2", "author": "A2"}},
+    ]})
+    assert resp.status_code == 200
+    results = resp.json()["results"]
+    assert results[0]["path"] == f"shelves/{shelf_id}/books/batch-book-1"
+    paths = [b["path"] for b in results]
+
+    resp = client.post(f"/shelves/{shelf_id}/books:batchCreate", json={"requests": [
+        {"id": "dup", "book": {"title": "T", "author": "A"}},
+        {"id": "dup", "book": {"title": "T", "author": "A"}},
+    ]})
+    assert resp.status_code == 409
+
+    resp = client.post("/shelves/missing/books:batchCreate", json={"requests": []})
+    assert resp.status_code == 404
+
+    resp = client.get(f"/shelves/{shelf_id}/books:batchGet", params={"paths": paths})
+    assert resp.status_code == 200
+    assert [b["title"] for b in resp.json()["results"]] == ["T1", "T2"]
+
+    resp = client.get(f"/shelves/{shelf_id}/books:batchGet", params={"paths": ["shelves/other/books/batch-book-1"]})
+    assert resp.status_code == 400
+
+    resp = client.post(f"/shelves/{shelf_id}/books:batchDelete", json={"paths": paths})
+    assert resp.status_code == 204
+    assert client.get(f"/shelves/{shelf_id}/books:batchGet", params={"paths": paths[:1]}).status_code == 404
+
+def test_get_cache_invalidation():
+    resp = client.post("/shelves", params={"id": "cached-shelf"}, json={"theme": "Before"})
+    assert resp.status_code == 201
+
+    before = client.get("/_stats/cache").json()
+    assert client.get("/shelves/cached-shelf").json()["theme"] == "Before"
+    assert client.get("/shelves/cached-shelf").json()["theme"] == "Before"
+    after = client.get("/_stats/cache").json()
+    assert after["hits"] == before["hits"] + 1
+
+    client.patch("/shelves/cached-shelf", json={"theme": "After"})
+    assert client.get("/shelves/cached-shelf").json()["theme"] == "After"
+
+    client.post("/shelves/cached-shelf/books", params={"id": "cached-book"}, json={"title": "T", "author": "A"})
+    assert client.get("/shelves/cached-shelf/books/cached-book").status_code == 200
+    # Books are only visible under their own shelf
+    assert client.get("/shelves/other/books/cached-book").status_code == 404
+    client.delete("/shelves/cached-shelf/books/cached-book")
+    assert client.get("/shelves/cached-shelf/books/cached-book").status_code == 404
+
+    client.delete("/shelves/cached-shelf")
+    assert client.get("/shelves/cached-shelf").status_code == 404
+
+def test_etags():
+    resp = client.post("/shelves", params={"id": "etag-shelf"}, json={"theme": "Etag"})
+    assert resp.status_code == 201
+    etag = resp.headers["ETag"]
+
+    resp = client.get("/shelves/etag-shelf")
+    assert resp.headers["ETag"] == etag
+    resp = client.get("/shelves/etag-shelf", headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+    assert resp.content == b""
+
+    # A stale If-Match is rejected, the current one applies the update
+    resp = client.patch("/shelves/etag-shelf", json={"theme": "New"}, headers={"If-Match": '"stale"'})
+    assert resp.status_code == 412
+    resp = client.patch("/shelves/etag-shelf", json={"theme": "New"}, headers={"If-Match": etag})
+    assert resp.status_code == 200
+    new_etag = resp.headers["ETag"]
+    assert new_etag != etag
+    assert client.get("/shelves/etag-shelf", headers={"If-None-Match": etag}).status_code == 200
+    assert client.patch("/shelves/missing", json={"theme": "x"}, headers={"If-Match": etag}).status_code == 404
+
+    resp = client.post("/shelves/etag-shelf/books", params={"id": "etag-book"}, json={"title": "T", "author": "A"})
+    book_etag = resp.headers["ETag"]
+    resp = client.get("/shelves/etag-shelf/books/etag-book", headers={"If-None-Match": book_etag})
+    assert resp.status_code == 304
+    resp = client.patch("/shelves/etag-shelf/books/etag-book", json={"title": "T2"}, headers={"If-Match": '"stale"'})
+    assert resp.status_code == 412
+    resp = client.patch("/shelves/etag-shelf/books/etag-book", json={"title": "T2"}, headers={"If-Match": book_etag})
+    assert resp.status_code == 200
+    assert resp.json()["author"] == "A"
+
+    # List pages change etag when any book on them changes
+    resp = client.get("/shelves/etag-shelf/books")
+    list_etag = resp.headers["ETag"]
+    assert client.get("/shelves/etag-shelf/books", headers={"If-None-Match": list_etag}).status_code == 304
+    client.patch("/shelves/etag-shelf/books/etag-book", json={"author": "B"})
+    assert client.get("/shelves/etag-shelf/books", headers={"If-None-Match": list_etag}).status_code == 200
+
+def test_list_ndjson_streaming():
+    client.post("/shelves", params={"id": "stream-shelf"}, json={"theme": "Stream"})
+    for i in range(3):
+        client.post("/shelves/stream-shelf/books", params={"id": f"stream-book-{i}"}, json={"title": f"T{i}", "author": "A"})
+
+    ndjson = {"Accept": "application/x-ndjson"}
+    resp = client.get("/shelves/stream-shelf/books", params={"max_page_size": 2}, headers=ndjson)
+    assert resp.status_code == 200
+    assert resp.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in resp.text.splitlines()]
+    assert [b["path"] for b in lines[:-1]] == ["shelves/stream-shelf/books/stream-book-0", "shelves/stream-shelf/books/stream-book-1"]
+    token = lines[-1]["next_page_token"]
+    assert token
+
+    # Streaming and JSON pages share the same page tokens
+    resp = client.get("/shelves/stream-shelf/books", params={"max_page_size": 2, "page_token": token}, headers=ndjson)
+    lines = [json.loads(line) for line in resp.text.splitlines()]
+    assert lines == [{"path": "shelves/stream-shelf/books/stream-book-2", "title": "T2", "author": "A"}, {"next_page_token": ""}]
+
+    assert client.get("/shelves/missing/books", headers=ndjson).status_code == 404
+
+    client.post("/shelves", params={"id": "stream-empty"}, json={"theme": "Empty"})
+    resp = client.get("/shelves/stream-empty/books", headers=ndjson)
+    assert resp.text == '{"next_page_token":""}\n'
+
+    resp = client.get("/shelves", params={"max_page_size": 1}, headers=ndjson)
+    lines = [json.loads(line) for line in resp.text.splitlines()]
+    assert len(lines) == 2
+    assert lines[-1]["next_page_token"]
+
+def test_metrics_endpoint():
+    client.get("/shelves")
+    resp = client.get("/metrics")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/plain")
+    assert 'aep_request_duration_seconds_count{operation="ListShelves"}' in resp.text
+    assert 'aep_db_statements_total{operation="ListShelves"}' in resp.text
+    assert "aep_cache_hits_total" in resp.text
+
+def test_read_mask():
+    client.post("/shelves", params={"id": "mask-shelf"}, json={"theme": "Mask"})
+    client.post("/shelves/mask-shelf/books", params={"id": "mask-book"}, json={"title": "T", "author": "A"})
+
+    resp = client.get("/shelves/mask-shelf/books", params={"read_mask": "path,title"})
+    assert resp.status_code == 200
+    assert resp.json()["books"] == [{"path": "shelves/mask-shelf/books/mask-book", "title": "T"}]
+    assert "ETag" in resp.headers
+
+    # Partial reads are answered from the cache too, once the full resource is cached
+    for _ in range(2):
+        resp = client.get("/shelves/mask-shelf/books/mask-book", params={"read_mask": "author"})
+        assert resp.json() == {"author": "A"}
+        client.get("/shelves/mask-shelf/books/mask-book")
+    assert client.get("/shelves/mask-shelf", params={"read_mask": "*"}).json() == {"path": "shelves/mask-shelf", "theme": "Mask"}
+
+    resp = client.get("/shelves", params={"read_mask": "path", "max_page_size": 1}, headers={"Accept": "application/x-ndjson"})
+    lines = [json.loads(line) for line in resp.text.splitlines()]
+    assert list(lines[0]) == ["path"]
+
+    assert client.get("/shelves/mask-shelf/books", params={"read_mask": "title,isbn"}).status_code == 400
+    assert client.get("/shelves/mask-shelf", params={"read_mask": "etag"}).status_code == 400
+
+def test_list_books_filter():
+    client.post("/shelves", params={"id": "filter-shelf"}, json={"theme": "Filter"})
+    books = [("f1", "A Wizard of Earthsea", "Le Guin"), ("f2", "The Tombs of Atuan", "Le Guin"), ("f3", "Dune", "Herbert"), ("f4", "The Farthest Shore", "Le Guin")]
+    for book_id, title, author in books:
+        client.post("/shelves/filter-shelf/books", params={"id": book_id}, json={"title": title, "author": author})
+
+    def ids(**params):
+        resp = client.get("/shelves/filter-shelf/books", params=params)
+        assert resp.status_code == 200
+        return [b["path"].rsplit("/", 1)[1] for b in resp.json()["books"]], resp.json()["next_page_token"]
+
+    assert ids(filter='author = "Le Guin"')[0] == ["f1", "f2", "f4"]
+    assert ids(filter='title:"earth"')[0] == ["f1"]
+    assert ids(filter='title:"the" AND author != "Herbert"')[0] == ["f2", "f4"]
+    assert ids(filter='author:"he" OR title:"du"')[0] == ["f3"]
+    assert ids(filter='title = "Nothing"')[0] == []
+
+    # The full-text index follows updates
+    client.patch("/shelves/filter-shelf/books/f3", json={"title": "Dune Messiah"})
+    assert ids(filter='title:"messiah"')[0] == ["f3"]
+
+    # Filtered pagination
+    page, token = ids(filter='author = "Le Guin"', max_page_size=2)
+    assert page == ["f1", "f2"]
+    assert ids(filter='author = "Le Guin"', max_page_size=2, page_token=token) == (["f4"], "")
+    # Tokens are bound to their filter
+    resp = client.get("/shelves/filter-shelf/books", params={"filter": 'author = "Herbert"', "page_token": token})
+    assert resp.status_code == 400
+
+    assert client.get("/shelves/filter-shelf/books", params={"filter": "isbn = 1"}).status_code == 400
+    assert client.get("/shelves/missing/books", params={"filter": 'author = "Le Guin"'}).status_code == 404
+
+def test_delete_shelf_force(monkeypatch):
+    from aep_example.config import Settings, settings
+    monkeypatch.setattr(settings, "operation_chunk_size", 2)
+
+    client.post("/shelves", params={"id": "doomed"}, json={"theme": "Doomed"})
+    body = {"requests": [{"id": f"doomed-{i}", "book": {"title": "T", "author": "A"}} for i in range(5)]}
+    client.post("/shelves/doomed/books:batchCreate", json=body)
+    assert client.get("/shelves/doomed/books/doomed-0").status_code == 200
+
+    # Without force, a shelf with books is not deleted
+    assert client.delete("/shelves/doomed").status_code == 409
+    assert client.post("/shelves:batchDelete", json={"paths": ["shelves/doomed"]}).status_code == 409
+    assert client.get("/shelves/doomed").status_code == 200
+
+    resp = client.delete("/shelves/doomed", params={"force": True})
+    assert resp.status_code == 202
+    operation = resp.json()
+    assert operation["path"].startswith("operations/")
+    assert operation["done"] is False
+
+    # The TestClient runs background tasks before returning
+    operation = client.get(f"/{operation['path']}").json()
+    assert operation["done"] is True
+    assert operation["metadata"] == {"shelf": "shelves/doomed", "books_deleted": 5}
+    assert "error" not in operation
+    assert client.get("/shelves/doomed").status_code == 404
+    assert client.get("/shelves/doomed/books/doomed-0").status_code == 404
+
+    assert client.delete("/shelves/doomed", params={"force": True}).status_code == 404
+    assert client.get("/operations/missing").status_code == 404
+
+def test_import_books():
+    client.post("/shelves", params={"id": "import-shelf"}, json={"theme": "Import"})
+    ndjson = "\n".join([
+        '{"id": "imp-1", "title": "One", "author": "A"}',
+        '{"title": "Two", "author": "B"}',
+        '{"id": "imp-1", "title": "Again", "author": "A"}',
+        'not json',
+        '{"id": "imp-3"}',
+    ]) + "\n"
+    resp = client.post("/shelves/import-shelf:importBooks", content=ndjson, headers={"Content-Type": "application/x-ndjson"})
+    assert resp.status_code == 200
+    operation = resp.json()
+    assert operation["done"] is True
+    assert operation["response"] == {"books_imported": 2, "rows_failed": 3}
+    assert [e["line"] for e in operation["metadata"]["errors"]] == [3, 4, 5]
+    assert client.get(f"/{operation['path']}").json() == operation
+    assert client.get("/shelves/import-shelf/books/imp-1").json()["title"] == "One"
+
+    csv_body = 'id,title,author\nimp-4,"Multi\nline, with comma",C\nimp-5,Five\n'
+    resp = client.post("/shelves/import-shelf:importBooks", content=csv_body, headers={"Content-Type": "text/csv; charset=utf-8"})
+    operation = resp.json()
+    assert operation["response"] == {"books_imported": 1, "rows_failed": 1}
+    assert operation["metadata"]["errors"] == [{"line": 4, "detail": "Expected 3 columns, got 2"}]
+    assert client.get("/shelves/import-shelf/books/imp-4").json()["title"] == "Multi\nline, with comma"
+
+    # A bad header fails the whole operation
+    resp = client.post("/shelves/import-shelf:importBooks", content="name\nx\n", headers={"Content-Type": "text/csv"})
+    assert resp.json()["error"]["status"] == 400
+    assert "response" not in resp.json()
+
+    assert client.post("/shelves/import-shelf:importBooks", content="{}", headers={"Content-Type": "application/json"}).status_code == 415
+    assert client.post("/shelves/missing:importBooks", content="", headers={"Content-Type": "text/csv"}).status_code == 404
+
+def test_export():
+    client.post("/shelves", params={"id": "export-shelf"}, json={"theme": "Export"})
+    client.post("/shelves/export-shelf/books", params={"id": "export-book"}, json={"title": "T", "author": "A"})
+
+    resp = client.get("/shelves:export")
+    assert resp.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in resp.text.splitlines()]
+    assert {"shelf": {"path": "shelves/export-shelf", "theme": "Export"}} in lines
+    assert {"book": {"path": "shelves/export-shelf/books/export-book", "title": "T", "author": "A"}} in lines
+    counts = lines[-1]["export"]
+    assert counts["shelves"] == sum("shelf" in line for line in lines)
+    assert counts["books"] == sum("book" in line for line in lines)
+
+    resp = client.get("/shelves:export", params={"format": "sqlite"})
+    assert resp.status_code == 200
+    assert resp.headers["content-type"] == "application/vnd.sqlite3"
+    assert resp.content.startswith(b"SQLite format 3\x00")
+
+    assert client.get("/shelves:export", params={"format": "csv"}).status_code == 422
+
+def test_openapi():
+    resp = client.get("/openapi.json")
+    assert resp.status_code == 200
+    etag = resp.headers["etag"]
+    # The served schema is the committed one, regenerate it with `just generate-openapi`.
+    with open(os.path.join(os.path.dirname(__file__), "..", "openapi.json"), "rb") as f:
+        assert resp.content == f.read()
+    assert "application/merge-patch+json" in app.openapi()["paths"]["/shelves/{shelf_id}"]["patch"]["requestBody"]["content"]
+
+    resp = client.get("/openapi.json", headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+    assert client.get("/docs").status_code == 200
+
+def test_watch():
+    from aep_example.changes import change_feed
+    from aep_example.db import DBChange
+    from sqlalchemy import func, select
+
+    async def head():
+        async with TestingSessionLocal() as db:
+            return (await db.execute(select(func.max(DBChange.revision)))).scalar() or 0
+
+    start = asyncio.run(head())
+    client.post("/shelves", params={"id": "watched"}, json={"theme": "Watched"})
+    client.post("/shelves/watched/books", params={"id": "w1"}, json={"title": "T", "author": "A"})
+    client.patch("/shelves/watched/books/w1", json={"title": "T2"})
+    client.post("/shelves/watched/books:batchCreate", json={"requests": [{"id": "w2", "book": {"title": "U", "author": "B"}}]})
+    client.delete("/shelves/watched/books/w1")
+    client.delete("/shelves/watched", params={"force": True})
+
+    async def watch(collection, n):
+        events = []
+        stream = change_feed.events(collection, start, TestingSessionLocal)
+        async for chunk in stream:
+            for block in chunk.decode().split("\n\n")[:-1]:
+                fields = dict(line.split(": ", 1) for line in block.split("\n"))
+                if "data" in fields:
+                    events.append((fields["event"], json.loads(fields["data"])))
+            if len(events) >= n:
+                await stream.aclose()
+                return events
+
+    books = asyncio.run(asyncio.wait_for(watch("shelves/watched/books", 5), 5))
+    assert [(e, d["path"]) for e, d in books] == [
+        ("created", "shelves/watched/books/w1"),
+        ("updated", "shelves/watched/books/w1"),
+        ("created", "shelves/watched/books/w2"),
+        ("deleted", "shelves/watched/books/w1"),
+        ("deleted", "shelves/watched/books/w2"),
+    ]
+    assert books[1][1]["resource"] == {"path": "shelves/watched/books/w1", "title": "T2", "author": "A"}
+    assert books[1][1]["revision"] > books[0][1]["revision"]
+    shelves = asyncio.run(asyncio.wait_for(watch("shelves", 2), 5))
+    assert [(e, d["path"]) for e, d in shelves] == [("created", "shelves/watched"), ("deleted", "shelves/watched")]
+
+    assert client.get("/shelves/missing/books:watch").status_code == 404
+    assert client.get("/shelves:watch", headers={"Last-Event-ID": "abc"}).status_code == 400
+    assert client.get("/shelves:watch", params={"start_revision": -1}).status_code == 422
+
+def test_existence_index():
+    from aep_example.existence import existence
+
+    asyncio.run(existence.rebuild([TestingSessionLocal]))
+    try:
+        negatives = existence.shelves.negatives
+        assert client.get("/shelves/never-created").status_code == 404
+        assert client.get("/shelves/never-created/books").status_code == 404
+        assert client.post("/shelves/never-created/books", json={"title": "T", "author": "A"}).status_code == 404
+        assert existence.shelves.negatives == negatives + 3
+        assert client.get("/shelves/s1/books/never-created").status_code == 404
+
+        # Ids are known as soon as they're created, and collisions still caught.
+        assert client.post("/shelves", params={"id": "indexed"}, json={"theme": "T"}).status_code == 201
+        assert client.get("/shelves/indexed").status_code == 200
+        assert client.post("/shelves", params={"id": "indexed"}, json={"theme": "T"}).status_code == 409
+        body = {"requests": [{"id": "fresh-shelf", "shelf": {"theme": "T"}}, {"id": "indexed", "shelf": {"theme": "T"}}]}
+        assert client.post("/shelves:batchCreate", json=body).status_code == 409
+        assert client.post("/shelves/indexed/books", params={"id": "indexed-book"}, json={"title": "T", "author": "A"}).status_code == 201
+        assert client.get("/shelves/indexed/books/indexed-book").status_code == 200
+        assert client.post("/shelves/indexed/books", params={"id": "indexed-book"}, json={"title": "T", "author": "A"}).status_code == 409
+        resp = client.post("/shelves/indexed:importBooks", content='{"id": "imported-book", "title": "T", "author": "A"}\n', headers={"Content-Type": "application/x-ndjson"})
+        assert resp.json()["response"] == {"books_imported": 1, "rows_failed": 0}
+        assert client.get("/shelves/indexed/books/imported-book").status_code == 200
+    finally:
+        existence.shelves.filter = existence.books.filter = None
+
+def test_list_books_wildcard():
+    for shelf in ("wild-a", "wild-b"):
+        client.post("/shelves", params={"id": shelf}, json={"theme": "Wild"})
+    client.post("/shelves/wild-a/books", params={"id": "wild-1"}, json={"title": "One", "author": "Wildcard Author"})
+    client.post("/shelves/wild-b/books", params={"id": "wild-2"}, json={"title": "Two", "author": "Wildcard Author"})
+    client.post("/shelves/wild-a/books", params={"id": "wild-3"}, json={"title": "Three", "author": "Wildcard Author"})
+
+    params = {"filter": 'author = "Wildcard Author"', "max_page_size": 2}
+    resp = client.get("/shelves/-/books", params=params)
+    assert resp.status_code == 200
+    page = resp.json()
+    assert [b["path"] for b in page["books"]] == ["shelves/wild-a/books/wild-1", "shelves/wild-b/books/wild-2"]
+    resp = client.get("/shelves/-/books", params={**params, "page_token": page["next_page_token"]})
+    assert resp.json() == {"books": [{"path": "shelves/wild-a/books/wild-3", "title": "Three", "author": "Wildcard Author"}], "next_page_token": ""}
+
+    # Page tokens are scoped to the collection they were issued for
+    assert client.get("/shelves/wild-a/books", params={**params, "page_token": page["next_page_token"]}).status_code == 400
+
+    resp = client.get("/shelves/-/books", params={**params, "read_mask": "path"})
+    assert resp.json()["books"] == [{"path": "shelves/wild-a/books/wild-1"}, {"path": "shelves/wild-b/books/wild-2"}]
+    resp = client.get("/shelves/-/books", params=params, headers={"Accept": "application/x-ndjson"})
+    assert [json.loads(line).get("path") for line in resp.text.splitlines()][:2] == ["shelves/wild-a/books/wild-1", "shelves/wild-b/books/wild-2"]
+
+    assert client.post("/shelves", params={"id": "-"}, json={"theme": "T"}).status_code == 400
+    assert client.post("/shelves:batchCreate", json={"requests": [{"id": "-", "shelf": {"theme": "T"}}]}).status_code == 400
+
+def test_lifespan(tmp_path, monkeypatch):
+    # The rest of this module skips the lifespan, so requests write on their
+    # own sessions. Here it runs: writes go through the coalescer, and the
+    # existence index and change feed are live.
+    from aep_example.existence import existence
+
+    shards = build_shards(Settings(database_url=f"sqlite+aiosqlite:///{tmp_path / 'lifespan.db'}"))
+    monkeypatch.setattr("aep_example.main.shards", shards)
+    monkeypatch.setattr(settings, "write_coalescing", True)
+    monkeypatch.setattr(settings, "existence_index_enabled", True)
+    app.dependency_overrides[get_shards] = lambda: shards
+    try:
+        with TestClient(app) as client:
+            assert shards[0].coalescer.running
+            assert existence.shelves.filter is not None
+
+            def create(i):
+                return client.post("/shelves", params={"id": f"concurrent-{i % 5}"}, json={"theme": f"T{i}"}).status_code
+
+            with ThreadPoolExecutor(max_workers=10) as pool:
+                statuses = list(pool.map(create, range(10)))
+            assert sorted(statuses) == [201] * 5 + [409] * 5
+            assert shards[0].coalescer.mutations >= 10
+
+            assert client.post("/shelves", params={"id": "concurrent-0"}, json={"theme": "T"}).status_code == 409
+            assert client.get("/shelves/concurrent-0").status_code == 200
+            assert client.get("/shelves/never-created").status_code == 404
+
+            # The watch streams never end, and TestClient reads whole bodies,
+            # so read the feed the lifespan started on the app's own loop.
+            async def watch(n):
+                created = set()
+                stream = shards[0].feed.events("shelves", 0)
+                async for chunk in stream:
+                    for line in chunk.decode().split("\n"):
+                        if line.startswith("data: "):
+                            created.add(json.loads(line[len("data: "):])["path"])
+                    if len(created) >= n:
+                        await stream.aclose()
+                        return created
+
+            assert shards[0].feed.running
+            created = client.portal.call(asyncio.wait_for, watch(5), 5)
+            assert created == {f"shelves/concurrent-{i}" for i in range(5)}
+        assert not shards[0].coalescer.running
+    finally:
+        del app.dependency_overrides[get_shards]
+        existence.shelves.filter = existence.books.filter = None
@@ -0,0 +1,265 @@
+import asyncio
+import contextlib
+import dataclasses
+import json
+import os
+import random
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+from .cache import LRUCache, ResourceCache, get_cache
+from .config import Settings
+from .repository import build_repository, get_repository
+from .shards import build_shards, get_shards
+
+# Relative weight of each operation in the mixed workload: read heavy, like
+# the traffic we see in production.
+WORKLOAD = {
+    "GetShelf": 10,
+    "ListShelves": 5,
+    "GetBook": 35,
+    "ListBooks": 25,
+    "CreateBook": 12,
+    "UpdateBook": 10,
+    "DeleteBook": 3,
+}
+
+SEED_BATCH_SIZE = 1000
+
+
+@contextlib.asynccontextmanager
+async def bench_client(settings: Optional[Settings] = None):
+    """Yield an httpx client driving the ASGI app in-process against fresh, throwaway SQLite files.
+
+    The engines, cache and write coalescers are all built from settings, so
+    different profiles (and shard counts) can be compared within one process.
+    """
+    from .main import app
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        settings = dataclasses.replace(
+            settings or Settings(),
+            database_url=f"sqlite+aiosqlite:///{os.path.join(tmpdir, 'bench.db')}",
+        )
+        shards = build_shards(settings)
+        await shards.init()
+        shards.start(settings.write_coalescing)
+
+        cache = LRUCache(settings.cache_max_entries, settings.cache_ttl_seconds) if settings.cache_enabled else ResourceCache()
+        overrides = {get_shards: lambda: shards, get_cache: lambda: cache}
+        repository = build_repository(settings)
+        if repository is not None:
+            overrides[get_repository] = lambda: repository
+
+        app.dependency_overrides.update(overrides)
+        try:
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+                yield client
+        finally:
+            for dependency in overrides:
+                app.dependency_overrides.pop(dependency, None)
+            await shards.stop()
+            await shards.dispose()
+
+
+@contextlib.contextmanager
+def timer(label: str, n: int):
+    start = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - start
+    print(f"{label:<40} {elapsed * 1000:10.1f} ms total {elapsed / n * 1e6:10.1f} us/item")
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+async def seed(client: httpx.AsyncClient, shelves: int, books_per_shelf: int) -> Dict[str, List[str]]:
+    """Create the dataset through the batch methods and return the book ids per shelf id."""
+    dataset = {}
+    for s in range(shelves):
+        shelf_id = f"shelf-{s:05d}"
+        resp = await client.post("/shelves", params={"id": shelf_id}, json={"theme": f"theme {s}"})
+        resp.raise_for_status()
+        book_ids = [f"book-{s:05d}-{b:07d}" for b in range(books_per_shelf)]
+        for start in range(0, books_per_shelf, SEED_BATCH_SIZE):
+            body = {"requests": [
+                {"id": book_ids[b], "book": {"title": f"title {b}", "author": f"author {b % 100}"}}
+                for b in range(start, min(start + SEED_BATCH_SIZE, books_per_shelf))
+            ]}
+            resp = await client.post(f"/shelves/{shelf_id}/books:batchCreate", json=body)
+            resp.raise_for_status()
+        dataset[shelf_id] = book_ids
+    return dataset
+
+
+class Workload:
+    def __init__(self, client: httpx.AsyncClient, dataset: Dict[str, List[str]], rng: random.Random):
+        self.client = client
+        self.dataset = dataset
+        self.shelf_ids = list(dataset)
+        self.rng = rng
+        self.created = 0
+
+    def _book(self):
+        shelf_id = self.rng.choice(self.shelf_ids)
+        books = self.dataset[shelf_id]
+        if not books:
+            return shelf_id, None
+        return shelf_id, self.rng.choice(books)
+
+    async def run(self, operation: str) -> httpx.Response:
+        c = self.client
+        if operation == "GetShelf":
+            return await c.get(f"/shelves/{self.rng.choice(self.shelf_ids)}")
+        if operation == "ListShelves":
+            return await c.get("/shelves", params={"max_page_size": 20})
+        if operation == "ListBooks":
+            return await c.get(f"/shelves/{self.rng.choice(self.shelf_ids)}/books", params={"max_page_size": 20})
+        if operation == "CreateBook":
+            shelf_id = self.rng.choice(self.shelf_ids)
+            self.created += 1
+            book_id = f"new-{self.created:08d}"
+            resp = await c.post(f"/shelves/{shelf_id}/books", params={"id": book_id}, json={"title": "new", "author": "bench"})
+            if resp.status_code == 201:
+                self.dataset[shelf_id].append(book_id)
+            return resp
+        shelf_id, book_id = self._book()
+        if book_id is None:
+            return await c.get(f"/shelves/{shelf_id}/books")
+        if operation == "GetBook":
+            return await c.get(f"/shelves/{shelf_id}/books/{book_id}")
+        if operation == "UpdateBook":
+            return await c.patch(f"/shelves/{shelf_id}/books/{book_id}", json={"title": f"updated {self.rng.random()}"})
+        if operation == "DeleteBook":
+            # Claim the id first so concurrent workers don't pick it up meanwhile.
+            self.dataset[shelf_id].remove(book_id)
+            return await c.delete(f"/shelves/{shelf_id}/books/{book_id}")
+        raise ValueError(f"Unknown operation {operation}")
+
+
+async def run_benchmark(
+    shelves: int = 10,
+    books_per_shelf: int = 1000,
+    concurrency: int = 16,
+    requests: int = 5000,
+    seed_value: int = 0,
+    database_shards: int = 1,
+    storage_backend: str = "sqlalchemy",
+    settings: Optional[Settings] = None,
+) -> dict:
+    settings = dataclasses.replace(settings or Settings(), database_shards=database_shards, storage_backend=storage_backend)
+    async with bench_client(settings) as client:
+        dataset = await seed(client, shelves, books_per_shelf)
+        rng = random.Random(seed_value)
+        operations = rng.choices(list(WORKLOAD), weights=list(WORKLOAD.values()), k=requests)
+        workload = Workload(client, dataset, rng)
+        latencies: Dict[str, List[float]] = {op: [] for op in WORKLOAD}
+        errors: Dict[str, int] = {op: 0 for op in WORKLOAD}
+        queue = iter(operations)
+
+        async def worker():
+            for operation in queue:
+                start = time.perf_counter()
+                resp = await workload.run(operation)
+                latencies[operation].append(time.perf_counter() - start)
+                if resp.status_code >= 400:
+                    errors[operation] += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    results = {}
+    for operation, values in latencies.items():
+        results[operation] = _summary(values, errors[operation], elapsed)
+    results["total"] = _summary([v for values in latencies.values() for v in values], sum(errors.values()), elapsed)
+    return {
+        "config": {
+            "shelves": shelves,
+            "books_per_shelf": books_per_shelf,
+            "concurrency": concurrency,
+            "requests": requests,
+            "seed": seed_value,
+            "shards": database_shards,
+            "storage": storage_backend,
+        },
+        "results": results,
+    }
+
+
+def _summary(values: List[float], errors: int, elapsed: float) -> dict:
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "errors": errors,
+        "throughput": len(values) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(values, 50) * 1000,
+        "p95_ms": percentile(values, 95) * 1000,
+        "p99_ms": percentile(values, 99) * 1000,
+    }
+
+
+def format_report(report: dict) -> str:
+    lines = [f"{'operation':<14} {'count':>7} {'errors':>6} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"]
+    for operation, r in report["results"].items():
+        lines.append(
+            f"{operation:<14} {r['count']:>7} {r['errors']:>6} {r['throughput']:>9.1f} "
+            f"{r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} {r['p99_ms']:>8.2f}"
+        )
+    return "\n".join(lines)
+
+
+def compare(report: dict, baseline: dict, threshold: float) -> List[str]:
+    """Regressions of report against baseline, as human readable messages.
+
+    An operation regresses when its p95 latency grows, or its throughput
+    drops, by more than threshold (a fraction, e.g. 0.2 for 20%).
+    """
+    regressions = []
+    for operation, base in baseline["results"].items():
+        current = report["results"].get(operation)
+        if current is None or not base["count"] or not current["count"]:
+            continue
+        if base["p95_ms"] and current["p95_ms"] > base["p95_ms"] * (1 + threshold):
+            regressions.append(f"{operation}: p95 {base['p95_ms']:.2f}ms -> {current['p95_ms']:.2f}ms")
+        if current["throughput"] < base["throughput"] * (1 - threshold):
+            regressions.append(f"{operation}: throughput {base['throughput']:.1f} -> {current['throughput']:.1f} req/s")
+    return regressions
+
+
+def main(args) -> int:
+    report = asyncio.run(run_benchmark(
+        shelves=args.shelves,
+        books_per_shelf=args.books_per_shelf,
+        concurrency=args.concurrency,
+        requests=args.requests,
+        seed_value=args.seed,
+        database_shards=args.shards,
+        storage_backend=args.storage,
+    ))
+    print(format_report(report))
+
+    if args.write_baseline:
+        with open(args.write_baseline, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline["config"] != report["config"]:
+            print(f"warning: baseline was recorded with a different config: {baseline['config']}")
+        regressions = compare(report, baseline, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+    return 0
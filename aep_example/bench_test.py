@@ -0,0 +1,25 @@
+import asyncio
+
+from aep_example.bench import WORKLOAD, compare, percentile, run_benchmark
+
+
+def test_percentile():
+    values = [float(v) for v in range(1, 101)]
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([], 50) == 0
+
+
+def test_run_benchmark():
+    report = asyncio.run(run_benchmark(shelves=2, books_per_shelf=5, concurrency=4, requests=60))
+    assert set(report["results"]) == set(WORKLOAD) | {"total"}
+    assert report["results"]["total"]["count"] == 60
+    assert report["results"]["total"]["errors"] == 0
+    assert compare(report, report, threshold=0.1) == []
+
+
+def test_compare_flags_regressions():
+    baseline = {"results": {"GetBook": {"count": 10, "throughput": 100.0, "p95_ms": 10.0}}}
+    slower = {"results": {"GetBook": {"count": 10, "throughput": 70.0, "p95_ms": 13.0}}}
+    assert len(compare(slower, baseline, threshold=0.2)) == 2
+    assert compare(slower, baseline, threshold=0.5) == []
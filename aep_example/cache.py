@@ -0,0 +1,99 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from .config import settings
+
+
+class ResourceCache:
+    """Cache of API resources keyed by resource path (e.g. "shelves/1/books/2").
+
+    This base implementation caches nothing, and is used when caching is
+    disabled. Subclasses provide the actual storage.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Bumped on every invalidation. A reader captures it before going to
+        # the database and hands it back to set(), so a value read before a
+        # concurrent write is never stored after that write invalidated it.
+        self.generation = 0
+
+    def get(self, path: str) -> Optional[Any]:
+        self.misses += 1
+        return None
+
+    def set(self, path: str, value: Any, generation: int):
+        pass
+
+    def invalidate(self, path: str):
+        self.generation += 1
+
+    def clear(self):
+        self.generation += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "size": len(self)}
+
+    def __len__(self) -> int:
+        return 0
+
+
+class LRUCache(ResourceCache):
+    """Bounded cache with a per-entry TTL, evicting the least recently used entry when full."""
+
+    def __init__(self, max_entries: int, ttl_seconds: float, clock=time.monotonic):
+        super().__init__()
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def get(self, path: str) -> Optional[Any]:
+        entry = self._entries.get(path)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires_at = entry
+        if expires_at <= self._clock():
+            del self._entries[path]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(path)
+        self.hits += 1
+        return value
+
+    def set(self, path: str, value: Any, generation: int):
+        if generation != self.generation:
+            return
+        self._entries[path] = (value, self._clock() + self.ttl_seconds)
+        self._entries.move_to_end(path)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, path: str):
+        super().invalidate(path)
+        self._entries.pop(path, None)
+
+    def clear(self):
+        super().clear()
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def create_cache() -> ResourceCache:
+    if not settings.cache_enabled or settings.cache_max_entries <= 0:
+        return ResourceCache()
+    return LRUCache(settings.cache_max_entries, settings.cache_ttl_seconds)
+
+
+resource_cache = create_cache()
+
+
+def get_cache() -> ResourceCache:
+    return resource_cache
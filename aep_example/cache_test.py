@@ -0,0 +1,49 @@
+from aep_example.cache import LRUCache, ResourceCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_eviction():
+    cache = LRUCache(max_entries=2, ttl_seconds=60)
+    cache.set("shelves/1", "a", cache.generation)
+    cache.set("shelves/2", "b", cache.generation)
+    assert cache.get("shelves/1") == "a"  # 1 is now most recently used
+    cache.set("shelves/3", "c", cache.generation)
+    assert cache.get("shelves/2") is None
+    assert cache.get("shelves/1") == "a"
+    assert cache.get("shelves/3") == "c"
+    assert cache.stats() == {"hits": 3, "misses": 1, "evictions": 1, "size": 2}
+
+
+def test_ttl_expiry():
+    clock = FakeClock()
+    cache = LRUCache(max_entries=10, ttl_seconds=5, clock=clock)
+    cache.set("shelves/1", "a", cache.generation)
+    clock.now = 4.9
+    assert cache.get("shelves/1") == "a"
+    clock.now = 5.0
+    assert cache.get("shelves/1") is None
+    assert len(cache) == 0
+
+
+def test_invalidation_drops_stale_reads():
+    cache = LRUCache(max_entries=10, ttl_seconds=60)
+    cache.set("shelves/1", "old", cache.generation)
+    generation = cache.generation
+    # A write lands between the reader's DB query and its cache fill
+    cache.invalidate("shelves/1")
+    cache.set("shelves/1", "old", generation)
+    assert cache.get("shelves/1") is None
+
+
+def test_disabled_cache():
+    cache = ResourceCache()
+    cache.set("shelves/1", "a", cache.generation)
+    assert cache.get("shelves/1") is None
+    assert cache.stats()["misses"] == 1
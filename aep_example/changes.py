@@ -0,0 +1,274 @@
+import asyncio
+import bisect
+import logging
+import time
+from typing import AsyncIterator, Callable, List, Optional, Tuple
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .config import settings
+from .db import AsyncSessionLocal, DBChange
+from .serialization import to_json
+
+logger = logging.getLogger(__name__)
+
+# Change log and watch streams.
+#
+# Every mutation records what it changed in the changes table, in the same
+# transaction, so a change is logged exactly when it is committed. SQLite
+# has a single writer, so revisions become visible in increasing order:
+# once revision N can be read, every earlier one can be too.
+#
+# Clients follow a collection over Server-Sent Events rather than polling
+# List. Each process runs one poller that reads new changes into an
+# in-memory buffer, already encoded as events, and wakes every subscriber;
+# subscribers then take their collection's events from the buffer. So no
+# matter how many clients watch, the log is queried once per poll. Writes
+# made in this process wake the poller right away, others are picked up
+# every poll interval.
+#
+# A client resuming from a revision older than the buffer catches up from
+# the database first, then continues from the buffer. Each event's id is
+# its revision, so EventSource resumes through Last-Event-ID on its own.
+#
+# With several database shards each has its own log, feed and revisions.
+# A collection within a shelf lives on one shard, but shelves are spread
+# over all of them: their stream merges one stream per shard, and its
+# event ids are the revisions of every shard, joined with dots.
+
+CREATED = "created"
+UPDATED = "updated"
+DELETED = "deleted"
+
+SSE_MEDIA_TYPE = "text/event-stream"
+
+# Rows read from the log per query when catching up.
+CATCH_UP_BATCH_SIZE = 1000
+
+# Prune the log once every this many revisions.
+PRUNE_EVERY = 1000
+
+
+def change(type: str, path: str, etag: Optional[str] = None, resource: Optional[dict] = None) -> dict:
+    """A changes row for the resource at path."""
+    return {"collection": path.rsplit("/", 1)[0], "path": path, "type": type, "etag": etag, "resource": resource}
+
+
+async def record_changes(db: AsyncSession, changes: List[dict]):
+    """Log changes, as part of the caller's mutation."""
+    if not changes:
+        return
+    revisions = (await db.execute(insert(DBChange).returning(DBChange.revision), changes)).scalars().all()
+    retention = settings.change_log_retention
+    if retention and any(revision % PRUNE_EVERY == 0 for revision in revisions):
+        await db.execute(delete(DBChange).where(DBChange.revision <= max(revisions) - retention))
+
+
+def revision_id(revision: int) -> bytes:
+    return b"%d" % revision
+
+
+def event_body(row) -> bytes:
+    """An event for a changes row, without its id."""
+    data = to_json({"revision": row.revision, "type": row.type, "path": row.path, "etag": row.etag, "resource": row.resource})
+    return b"event: %s\ndata: %s\n\n" % (row.type.encode(), data)
+
+
+def encode_event(row, event_id: Callable[[int], bytes] = revision_id) -> bytes:
+    return b"id: %s\n%s" % (event_id(row.revision), event_body(row))
+
+
+def resume_point(revision: int, event_id: Callable[[int], bytes] = revision_id) -> bytes:
+    # An event without data isn't dispatched, but EventSource still takes
+    # its id as the revision to resume from.
+    return b"id: %s\n\n" % event_id(revision)
+
+
+class ChangeFeed:
+    """The latest changes, kept in memory for the watch streams to share."""
+
+    def __init__(self, capacity: int, poll_interval_seconds: float, heartbeat_seconds: float):
+        self.capacity = capacity
+        self.poll_interval_seconds = poll_interval_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.session_factory = None
+        self.subscribers = 0
+        # The buffer holds every change with floor < revision <= head.
+        self.head = 0
+        self.floor = 0
+        self._revisions: List[int] = []
+        # The collection and event_body() of each change in the buffer.
+        self._events: List[Tuple[str, bytes]] = []
+        self._advanced: Optional[asyncio.Event] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, session_factory):
+        self.session_factory = session_factory
+        self.head = self.floor = 0
+        self._revisions, self._events = [], []
+        self._stopping = False
+        self._advanced = asyncio.Event()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if not self.running:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+
+    def notify(self):
+        """Check the log now, rather than at the next poll: called after committing changes."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._stopping:
+                return
+            # Nobody to tell: a subscriber arriving wakes the poller anyway.
+            if not self.subscribers:
+                continue
+            try:
+                await self._poll()
+            except Exception:
+                logger.exception("Reading the change log failed")
+
+    async def _poll(self):
+        # Newest first, so after a long idle spell only what fits in the
+        # buffer is read; subscribers further behind catch up from the log.
+        query = select(DBChange).where(DBChange.revision > self.head).order_by(DBChange.revision.desc()).limit(self.capacity)
+        async with self.session_factory() as db:
+            rows = (await db.execute(query)).scalars().all()
+        if not rows:
+            return
+        rows.reverse()
+        if len(rows) == self.capacity:
+            self._revisions, self._events = [], []
+            self.floor = rows[0].revision - 1
+        for row in rows:
+            self._revisions.append(row.revision)
+            self._events.append((row.collection, event_body(row)))
+        self.head = rows[-1].revision
+        # Trimmed in bulk rather than on every append.
+        if len(self._revisions) > 2 * self.capacity:
+            del self._revisions[:-self.capacity], self._events[:-self.capacity]
+            self.floor = self._revisions[0] - 1
+        advanced, self._advanced = self._advanced, asyncio.Event()
+        advanced.set()
+
+    async def _catch_up(self, session_factory, collection: str, after: int, until: Optional[int]) -> list:
+        query = select(DBChange).where(DBChange.collection == collection, DBChange.revision > after)
+        if until is not None:
+            query = query.where(DBChange.revision <= until)
+        query = query.order_by(DBChange.revision).limit(CATCH_UP_BATCH_SIZE)
+        async with session_factory() as db:
+            return (await db.execute(query)).scalars().all()
+
+    async def events(self, collection: str, after: int, session_factory=None, event_id: Callable[[int], bytes] = revision_id) -> AsyncIterator[bytes]:
+        """The collection's changes after revision after, as Server-Sent Events, until cancelled.
+
+        Outside the app's lifespan, with no poller running, the stream
+        polls the log itself. event_id gives the id of the event for a
+        revision, and is called in revision order as events are sent.
+        """
+        session_factory = session_factory or self.session_factory or AsyncSessionLocal
+        cursor = after
+        self.subscribers += 1
+        self.notify()
+        try:
+            yield resume_point(cursor, event_id)
+            last_sent = time.monotonic()
+            while True:
+                running = self.running
+                if not running or cursor < self.floor:
+                    rows = await self._catch_up(session_factory, collection, cursor, self.floor if running else None)
+                    if rows:
+                        cursor = rows[-1].revision
+                        yield b"".join(encode_event(row, event_id) for row in rows)
+                        last_sent = time.monotonic()
+                        continue
+                    if running:
+                        cursor = self.floor
+                        continue
+                    await asyncio.sleep(self.poll_interval_seconds)
+                else:
+                    advanced = self._advanced
+                    i = bisect.bisect_right(self._revisions, cursor)
+                    events = [
+                        b"id: %s\n%s" % (event_id(revision), body)
+                        for revision, (c, body) in zip(self._revisions[i:], self._events[i:]) if c == collection
+                    ]
+                    cursor = max(cursor, self.head)
+                    if events:
+                        yield b"".join(events)
+                        last_sent = time.monotonic()
+                    timeout = self.heartbeat_seconds - (time.monotonic() - last_sent)
+                    if timeout > 0:
+                        try:
+                            await asyncio.wait_for(advanced.wait(), timeout)
+                            continue
+                        except asyncio.TimeoutError:
+                            pass
+                if time.monotonic() - last_sent >= self.heartbeat_seconds:
+                    # Keeps the connection open, and moves the client's
+                    # resume point along while its collection is quiet.
+                    yield resume_point(cursor, event_id)
+                    last_sent = time.monotonic()
+        finally:
+            self.subscribers -= 1
+
+
+async def interleave(streams: List[AsyncIterator[bytes]]) -> AsyncIterator[bytes]:
+    """The chunks of several event streams, as each stream sends them.
+
+    A stream only moves on to its next chunk once every chunk queued so far
+    has been sent: event ids are worked out as chunks are made, so chunks
+    must go out in the order they were made.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def pump(stream):
+        try:
+            async for chunk in stream:
+                queue.put_nowait(chunk)
+                await queue.join()
+        except Exception as e:
+            queue.put_nowait(e)
+
+    tasks = [asyncio.create_task(pump(stream)) for stream in streams]
+    try:
+        while True:
+            chunk = await queue.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+            queue.task_done()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for stream in streams:
+            await stream.aclose()
+
+
+change_feed = ChangeFeed(
+    settings.change_buffer_size,
+    poll_interval_seconds=settings.change_poll_interval_ms / 1000,
+    heartbeat_seconds=settings.watch_heartbeat_seconds,
+)
+
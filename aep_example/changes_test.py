@@ -0,0 +1,148 @@
+import asyncio
+import json
+
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from aep_example import changes
+from aep_example.changes import CREATED, DELETED, ChangeFeed, change, record_changes
+from aep_example.db import Base, DBChange
+from aep_example.writer import SessionFactoryWriter
+
+
+def parse(chunk: bytes):
+    """The (id, event, data) of each event in a chunk of the stream."""
+    events = []
+    for block in chunk.decode().split("\n\n")[:-1]:
+        fields = dict(line.split(": ", 1) for line in block.split("\n"))
+        events.append((int(fields["id"]), fields.get("event"), json.loads(fields["data"]) if "data" in fields else None))
+    return events
+
+
+async def setup(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'changes.db'}")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    return engine, sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+
+async def create_books(writer, shelf_id, *book_ids):
+    await writer.run(lambda db: record_changes(db, [
+        change(CREATED, f"shelves/{shelf_id}/books/{i}", "e", {"path": f"shelves/{shelf_id}/books/{i}"}) for i in book_ids
+    ]))
+
+
+async def take(stream, n):
+    """The next n change events from the stream, skipping resume points."""
+    events = []
+    while len(events) < n:
+        events += [e for e in parse(await asyncio.wait_for(stream.__anext__(), 5)) if e[1]]
+    return events
+
+
+def test_change():
+    assert change(DELETED, "shelves/s1/books/b1") == {
+        "collection": "shelves/s1/books", "path": "shelves/s1/books/b1", "type": DELETED, "etag": None, "resource": None,
+    }
+    assert change(CREATED, "shelves/s1")["collection"] == "shelves"
+
+
+def test_record_changes_prunes(tmp_path, monkeypatch):
+    monkeypatch.setattr(changes, "PRUNE_EVERY", 10)
+    monkeypatch.setattr(changes.settings, "change_log_retention", 5)
+
+    async def check():
+        engine, session_factory = await setup(tmp_path)
+        writer = SessionFactoryWriter(session_factory)
+        await create_books(writer, "s1", *range(9))
+        async with session_factory() as db:
+            assert (await db.execute(select(func.count()).select_from(DBChange))).scalar() == 9
+        await create_books(writer, "s1", 9, 10)
+        async with session_factory() as db:
+            revisions = (await db.execute(select(DBChange.revision))).scalars().all()
+        assert sorted(revisions) == [7, 8, 9, 10, 11]
+        await engine.dispose()
+
+    asyncio.run(check())
+
+
+def test_feed(tmp_path):
+    async def check():
+        engine, session_factory = await setup(tmp_path)
+        writer = SessionFactoryWriter(session_factory)
+        await create_books(writer, "s1", "old1", "old2")
+        await create_books(writer, "s2", "other")
+
+        feed = ChangeFeed(capacity=2, poll_interval_seconds=0.01, heartbeat_seconds=60)
+        feed.start(session_factory)
+        stream = feed.events("shelves/s1/books", 0)
+        assert parse(await stream.__anext__()) == [(0, None, None)]
+        # Older than the buffer: caught up from the log.
+        assert [(e[0], e[2]["path"]) for e in await take(stream, 2)] == [(1, "shelves/s1/books/old1"), (2, "shelves/s1/books/old2")]
+        assert feed.subscribers == 1
+
+        await create_books(writer, "s2", "other")
+        await create_books(writer, "s1", "new")
+        feed.notify()
+        assert [(e[0], e[1], e[2]["path"]) for e in await take(stream, 1)] == [(5, CREATED, "shelves/s1/books/new")]
+
+        await stream.aclose()
+        assert feed.subscribers == 0
+        await feed.stop()
+        await engine.dispose()
+
+    asyncio.run(check())
+
+
+def test_events_without_feed(tmp_path):
+    async def check():
+        engine, session_factory = await setup(tmp_path)
+        writer = SessionFactoryWriter(session_factory)
+        await create_books(writer, "s1", "b1")
+
+        feed = ChangeFeed(capacity=10, poll_interval_seconds=0.01, heartbeat_seconds=0.05)
+        stream = feed.events("shelves/s1/books", 1, session_factory)
+        assert parse(await stream.__anext__()) == [(1, None, None)]
+        await create_books(writer, "s1", "b2")
+        assert [e[0] for e in await take(stream, 1)] == [2]
+        # Quiet: a heartbeat carrying the resume point.
+        assert parse(await asyncio.wait_for(stream.__anext__(), 5)) == [(2, None, None)]
+        await stream.aclose()
+        await engine.dispose()
+
+    asyncio.run(check())
+
+
+def test_interleave():
+    async def stream(name, n):
+        for i in range(n):
+            await asyncio.sleep(0)
+            yield f"{name}{i}".encode()
+
+    async def failing():
+        yield b"x"
+        raise RuntimeError("gone")
+
+    async def check():
+        chunks = [chunk async for chunk in _take(changes.interleave([stream("a", 3), stream("b", 2)]), 5)]
+        assert sorted(chunks) == [b"a0", b"a1", b"a2", b"b0", b"b1"]
+        # Each stream's chunks stay in order.
+        assert [c for c in chunks if c.startswith(b"a")] == [b"a0", b"a1", b"a2"]
+
+        merged = changes.interleave([failing()])
+        assert await merged.__anext__() == b"x"
+        with pytest.raises(RuntimeError):
+            await merged.__anext__()
+
+    asyncio.run(check())
+
+
+async def _take(stream, n):
+    async for chunk in stream:
+        yield chunk
+        n -= 1
+        if n == 0:
+            await stream.aclose()
+            return
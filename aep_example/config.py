@@ -0,0 +1,170 @@
+import json
+import os
+import secrets
+from dataclasses import dataclass, field, fields
+from typing import Dict, Mapping, Optional
+
+# Settings are read from, in increasing order of precedence: the defaults
+# below, a JSON file named by AEP_CONFIG_FILE, and AEP_<FIELD_NAME>
+# environment variables (e.g. AEP_DATABASE_URL).
+
+
+@dataclass
+class Settings:
+    # Signs page tokens. Set it explicitly when running more than one process,
+    # otherwise each process signs with its own random key.
+    page_token_secret: str = ""
+    # Larger max_page_size values are cut to this (AEP-158), so one List
+    # request can't read a whole table into memory.
+    max_page_size: int = 1000
+
+    # Read-through cache for GetShelf/GetBook.
+    cache_enabled: bool = True
+    cache_max_entries: int = 10000
+    cache_ttl_seconds: float = 30.0
+
+    # Prometheus metrics at /metrics, and a Server-Timing header on every response.
+    metrics_enabled: bool = True
+    server_timing: bool = False
+
+    # Where shelves and books are kept: "sqlalchemy", the database below,
+    # or "memory", in process memory, lost on restart and without watch
+    # streams, long-running operations, imports or exports. For load tests
+    # and edge caches.
+    storage_backend: str = "sqlalchemy"
+
+    # Database engine and connection pool.
+    database_url: str = "sqlite+aiosqlite:///./library.db"
+    database_echo: bool = False
+    database_pool_size: int = 5
+    database_max_overflow: int = 10
+    database_pool_timeout_seconds: float = 30.0
+    # Size of SQLAlchemy's compiled statement cache, shared by all connections.
+    database_query_cache_size: int = 1200
+    # Spread shelves, with their books, over this many SQLite files by a
+    # hash of the shelf id, library-0-of-4.db and so on next to
+    # database_url, each with its own pool and writer. Change it with
+    # `aep-server reshard`.
+    database_shards: int = 1
+
+    # Group commit: mutating requests are queued and applied by a single
+    # writer task, up to write_batch_max_size per transaction, waiting
+    # write_batch_window_ms for more to arrive.
+    write_coalescing: bool = True
+    write_batch_window_ms: float = 1.0
+    write_batch_max_size: int = 64
+
+    # Long-running operations (e.g. a forced DeleteShelf) write in
+    # transactions of at most this many rows, so other writers can
+    # interleave.
+    operation_chunk_size: int = 1000
+
+    # In-memory Bloom filters of shelf and book ids, built at startup, so
+    # lookups of ids that don't exist and id collision checks skip the
+    # database. Each is sized for existence_index_false_positive_rate at
+    # twice the ids in its table (and at least existence_index_min_capacity)
+    # and rebuilt bigger once it fills up.
+    existence_index_enabled: bool = True
+    existence_index_false_positive_rate: float = 0.01
+    existence_index_min_capacity: int = 100000
+
+    # Change log behind the :watch streams. Each process keeps the latest
+    # change_buffer_size changes in memory and serves every subscriber from
+    # there; it checks the log for writes made by other processes every
+    # change_poll_interval_ms. The log itself keeps the latest
+    # change_log_retention changes (0 keeps them all), which bounds how far
+    # back a client can resume from.
+    change_buffer_size: int = 10000
+    change_poll_interval_ms: float = 500.0
+    change_log_retention: int = 1000000
+    # Idle watch streams send a heartbeat this often, so proxies keep them open.
+    watch_heartbeat_seconds: float = 15.0
+
+    # Admission control: GETs and other requests each take a slot from
+    # their own budget (admission_read_limit, admission_write_limit) for as
+    # long as their endpoint runs, and streamed bodies other than watches
+    # until they end. The read budget defaults to the
+    # connection pool, the write budget to one coalesced batch. Both shrink
+    # while requests wait on the database longer than
+    # admission_target_db_wait_ms and grow back when they don't, down to
+    # admission_min_limit. Requests over budget queue, up to
+    # admission_max_queue of them for at most admission_queue_timeout_ms,
+    # and beyond that get a 503 with Retry-After. admission_operation_limits
+    # caps single operations further, e.g. {"ExportShelves": 2}.
+    admission_enabled: bool = True
+    admission_read_limit: int = 15
+    admission_write_limit: int = 64
+    admission_min_limit: int = 1
+    admission_max_queue: int = 100
+    admission_queue_timeout_ms: float = 1000.0
+    admission_target_db_wait_ms: float = 100.0
+    admission_retry_after_seconds: int = 1
+    admission_operation_limits: Dict[str, int] = field(default_factory=dict)
+
+    # Serve /openapi.json from this file, as written by generate-openapi,
+    # instead of building the schema in every process. It must come from
+    # the same version of the code: the file is served as it is, stale or
+    # not. `generate-openapi --check` compares it with the code.
+    openapi_file: str = ""
+
+    # aep-server serve --production. Each of server_workers processes has
+    # its own engine, cache and write coalescer. loop and http "auto" pick
+    # uvloop and httptools when they are installed.
+    server_host: str = "0.0.0.0"
+    server_port: int = 8000
+    server_workers: int = 1
+    server_loop: str = "auto"
+    server_http: str = "auto"
+    server_backlog: int = 2048
+    server_keepalive_seconds: int = 5
+    # How long shutdown waits for in-flight requests to finish.
+    server_graceful_shutdown_seconds: int = 30
+    server_access_log: bool = False
+
+    # Pragmas applied to every new SQLite connection. sqlite_tuning=false
+    # leaves SQLite's own defaults in place.
+    sqlite_tuning: bool = True
+    sqlite_journal_mode: str = "WAL"
+    sqlite_synchronous: str = "NORMAL"
+    sqlite_busy_timeout_ms: int = 5000
+    sqlite_mmap_size: int = 256 * 1024 * 1024
+    # Negative values are KiB, positive values are pages.
+    sqlite_cache_size: int = -64 * 1024
+
+
+def _coerce(kind, value: str):
+    if kind in (bool, "bool"):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    if kind in (int, "int"):
+        return int(value)
+    if kind in (float, "float"):
+        return float(value)
+    if getattr(kind, "__origin__", None) is dict:
+        return json.loads(value)
+    return value
+
+
+def load_settings(environ: Optional[Mapping[str, str]] = None) -> Settings:
+    environ = os.environ if environ is None else environ
+    values = {}
+    config_file = environ.get("AEP_CONFIG_FILE")
+    if config_file:
+        with open(config_file) as f:
+            values.update(json.load(f))
+
+    for f in fields(Settings):
+        env_value = environ.get(f"AEP_{f.name.upper()}")
+        if env_value is not None:
+            values[f.name] = _coerce(f.type, env_value)
+
+    unknown = set(values) - {f.name for f in fields(Settings)}
+    if unknown:
+        raise ValueError(f"Unknown settings: {', '.join(sorted(unknown))}")
+
+    settings = Settings(**values)
+    if not settings.page_token_secret:
+        settings.page_token_secret = secrets.token_hex(32)
+    return settings
+
+
+settings = load_settings()
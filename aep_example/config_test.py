@@ -0,0 +1,37 @@
+import json
+
+import pytest
+
+from aep_example.config import load_settings
+
+
+def test_defaults():
+    settings = load_settings({})
+    assert settings.database_url == "sqlite+aiosqlite:///./library.db"
+    assert settings.database_echo is False
+    assert settings.page_token_secret
+
+
+def test_env_overrides_config_file(tmp_path):
+    config_file = tmp_path / "config.json"
+    config_file.write_text(json.dumps({"database_pool_size": 20, "sqlite_synchronous": "FULL"}))
+
+    settings = load_settings({
+        "AEP_CONFIG_FILE": str(config_file),
+        "AEP_DATABASE_POOL_SIZE": "7",
+        "AEP_SQLITE_TUNING": "false",
+        "AEP_CACHE_TTL_SECONDS": "1.5",
+        "AEP_ADMISSION_OPERATION_LIMITS": '{"ExportShelves": 2}',
+    })
+    assert settings.database_pool_size == 7
+    assert settings.sqlite_synchronous == "FULL"
+    assert settings.sqlite_tuning is False
+    assert settings.cache_ttl_seconds == 1.5
+    assert settings.admission_operation_limits == {"ExportShelves": 2}
+
+
+def test_unknown_setting(tmp_path):
+    config_file = tmp_path / "config.json"
+    config_file.write_text(json.dumps({"database_pool": 20}))
+    with pytest.raises(ValueError):
+        load_settings({"AEP_CONFIG_FILE": str(config_file)})
@@ -1,10 +1,48 @@
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, AsyncSession
 from sqlalchemy.orm import sessionmaker, declarative_base
-from sqlalchemy import Column, String, ForeignKey
+from sqlalchemy import DDL, JSON, Boolean, Column, Integer, String, ForeignKey, Index, event, inspect
+from sqlalchemy.engine import make_url
+from .config import Settings, settings
+from .etag import new_etag
 
-DATABASE_URL = "sqlite+aiosqlite:///./library.db"
+def sqlite_pragmas(settings: Settings) -> dict:
+    if not settings.sqlite_tuning:
+        return {}
+    return {
+        "journal_mode": settings.sqlite_journal_mode,
+        "synchronous": settings.sqlite_synchronous,
+        "busy_timeout": settings.sqlite_busy_timeout_ms,
+        "mmap_size": settings.sqlite_mmap_size,
+        "cache_size": settings.sqlite_cache_size,
+    }
 
-engine = create_async_engine(DATABASE_URL, echo=True)
+def build_engine(settings: Settings) -> AsyncEngine:
+    url = make_url(settings.database_url)
+    kwargs = {
+        "echo": settings.database_echo,
+        "query_cache_size": settings.database_query_cache_size,
+    }
+    # In-memory SQLite uses a single shared connection, there is no pool to size.
+    if url.database not in (None, "", ":memory:"):
+        kwargs.update(
+            pool_size=settings.database_pool_size,
+            max_overflow=settings.database_max_overflow,
+            pool_timeout=settings.database_pool_timeout_seconds,
+        )
+    engine = create_async_engine(url, **kwargs)
+
+    pragmas = sqlite_pragmas(settings) if url.get_backend_name() == "sqlite" else {}
+    if pragmas:
+        @event.listens_for(engine.sync_engine, "connect")
+        def apply_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name} = {value}")
+            cursor.close()
+
+    return engine
+
+engine = build_engine(settings)
 AsyncSessionLocal = sessionmaker(
     engine, class_=AsyncSession, expire_on_commit=False
 )
@@ -14,6 +52,8 @@ class DBShelf(Base):
     __tablename__ = "shelves"
     id = Column(String, primary_key=True, index=True)
     theme = Column(String)
+    # Replaced on every write; backs the ETag header and If-Match updates.
+    etag = Column(String, nullable=False, default=new_etag)
 
 class DBBook(Base):
     __tablename__ = "books"
@@ -21,11 +61,103 @@ class DBBook(Base):
     title = Column(String)
     author = Column(String)
     shelf_id = Column(String, ForeignKey("shelves.id"))
+    etag = Column(String, nullable=False, default=new_etag)
+
+    __table_args__ = (
+        # Serves ListBooks: equality on shelf_id, then a range scan in id order.
+        Index("ix_books_shelf_id_id", "shelf_id", "id"),
+        # Serves ListBooks filtered on author, still in id order.
+        Index("ix_books_shelf_id_author", "shelf_id", "author", "id"),
+        # Serves ListBooks across every shelf filtered on author. Unfiltered,
+        # it reads the primary key in id order.
+        Index("ix_books_author_id", "author", "id"),
+    )
+
+class DBOperation(Base):
+    """A long-running operation, polled through GET /operations/{id}."""
+    __tablename__ = "operations"
+    id = Column(String, primary_key=True)
+    done = Column(Boolean, nullable=False, default=False)
+    # "metadata" is reserved on declarative classes.
+    meta = Column("metadata", JSON)
+    error = Column(JSON)
+    response = Column(JSON)
+
+class DBChange(Base):
+    """An entry in the change log read by the :watch streams."""
+    __tablename__ = "changes"
+    # AUTOINCREMENT, so a revision is never reused even once the log is pruned.
+    revision = Column(Integer, primary_key=True, autoincrement=True)
+    # The collection the resource belongs to, e.g. shelves/s1/books.
+    collection = Column(String, nullable=False)
+    path = Column(String, nullable=False)
+    type = Column(String, nullable=False)
+    etag = Column(String)
+    # The resource after the change, null for deletions.
+    resource = Column(JSON)
+
+    __table_args__ = (
+        # Serves a watch catching up on one collection, in revision order.
+        Index("ix_changes_collection_revision", "collection", "revision"),
+        {"sqlite_autoincrement": True},
+    )
+
+# Full-text index over book titles and authors, backing the : operator in
+# ListBooks filters. It is an external content FTS5 table: it stores only
+# the index, keyed by the books rowid, and triggers keep it in sync. The
+# trigram tokenizer matches any substring of three characters or more,
+# which covers both word and substring searches. VACUUM may renumber the
+# rowids of books (it has no INTEGER PRIMARY KEY), so follow one with
+# INSERT INTO books_fts (books_fts) VALUES ('rebuild').
+BOOKS_FTS = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5("
+    "title, author, content='books', content_rowid='rowid', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN "
+    "INSERT INTO books_fts (rowid, title, author) VALUES (new.rowid, new.title, new.author); END",
+    "CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN "
+    "INSERT INTO books_fts (books_fts, rowid, title, author) VALUES ('delete', old.rowid, old.title, old.author); END",
+    # Only fires when title or author are written, not on every etag bump.
+    "CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE OF title, author ON books BEGIN "
+    "INSERT INTO books_fts (books_fts, rowid, title, author) VALUES ('delete', old.rowid, old.title, old.author); "
+    "INSERT INTO books_fts (rowid, title, author) VALUES (new.rowid, new.title, new.author); END",
+]
+
+for statement in BOOKS_FTS:
+    event.listen(DBBook.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+
+# Each entry upgrades an existing database by one schema version, tracked in
+# SQLite's user_version. Fresh databases get the latest schema from
+# create_all and skip straight to the last version.
+MIGRATIONS = [
+    ["CREATE INDEX IF NOT EXISTS ix_books_shelf_id_id ON books (shelf_id, id)"],
+    [
+        "ALTER TABLE shelves ADD COLUMN etag VARCHAR NOT NULL DEFAULT ''",
+        "UPDATE shelves SET etag = lower(hex(randomblob(8)))",
+        "ALTER TABLE books ADD COLUMN etag VARCHAR NOT NULL DEFAULT ''",
+        "UPDATE books SET etag = lower(hex(randomblob(8)))",
+    ],
+    [
+        "CREATE INDEX IF NOT EXISTS ix_books_shelf_id_author ON books (shelf_id, author, id)",
+        *BOOKS_FTS,
+        # Indexes the books that predate the table.
+        "INSERT INTO books_fts (books_fts) VALUES ('rebuild')",
+    ],
+    ["CREATE INDEX IF NOT EXISTS ix_books_author_id ON books (author, id)"],
+]
+
+def migrate(conn):
+    fresh = not inspect(conn).has_table(DBShelf.__tablename__)
+    Base.metadata.create_all(conn)
+    version = len(MIGRATIONS) if fresh else conn.exec_driver_sql("PRAGMA user_version").scalar()
+    for statements in MIGRATIONS[version:]:
+        for statement in statements:
+            conn.exec_driver_sql(statement)
+    conn.exec_driver_sql(f"PRAGMA user_version = {len(MIGRATIONS)}")
 
 async def init_db():
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(migrate)
 
-async def get_db():
-    async with AsyncSessionLocal() as session:
-        yield session
+def get_session_factory():
+    """For work that outlives the request, and so can't use its session."""
+    return AsyncSessionLocal
@@ -0,0 +1,77 @@
+import asyncio
+
+from sqlalchemy import inspect
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from aep_example.db import MIGRATIONS, migrate
+
+
+def _run(engine, fn):
+    async def go():
+        async with engine.begin() as conn:
+            return await conn.run_sync(fn)
+    return asyncio.run(go())
+
+
+def test_migrate_upgrades_existing_schema(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'old.db'}")
+
+    def create_baseline(conn):
+        conn.exec_driver_sql("CREATE TABLE shelves (id VARCHAR PRIMARY KEY, theme VARCHAR)")
+        conn.exec_driver_sql(
+            "CREATE TABLE books (id VARCHAR PRIMARY KEY, title VARCHAR, author VARCHAR, "
+            "shelf_id VARCHAR REFERENCES shelves (id))"
+        )
+        conn.exec_driver_sql("INSERT INTO books (id, title, author) VALUES ('b1', 'A Wizard of Earthsea', 'Le Guin')")
+
+    def inspect_schema(conn):
+        indexes = {i["name"] for i in inspect(conn).get_indexes("books")}
+        return indexes, conn.exec_driver_sql("PRAGMA user_version").scalar()
+
+    _run(engine, create_baseline)
+    _run(engine, migrate)
+    indexes, version = _run(engine, inspect_schema)
+    assert "ix_books_shelf_id_id" in indexes
+    assert "ix_books_shelf_id_author" in indexes
+    assert version == len(MIGRATIONS)
+
+    # Existing books are indexed for full-text search, new ones by the triggers
+    def search(conn):
+        conn.exec_driver_sql("INSERT INTO books (id, title, author, etag) VALUES ('b2', 'Earthsea Revisioned', 'Le Guin', '')")
+        return conn.exec_driver_sql(
+            "SELECT books.id FROM books_fts JOIN books ON books.rowid = books_fts.rowid "
+            "WHERE books_fts MATCH 'title : \"earthsea\"' ORDER BY books.id"
+        ).scalars().all()
+    assert _run(engine, search) == ["b1", "b2"]
+
+    # Running again is a no-op
+    _run(engine, migrate)
+    asyncio.run(engine.dispose())
+
+
+def test_migrate_fresh_database(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'new.db'}")
+    _run(engine, migrate)
+    version = _run(engine, lambda conn: conn.exec_driver_sql("PRAGMA user_version").scalar())
+    assert version == len(MIGRATIONS)
+    asyncio.run(engine.dispose())
+
+
+def test_build_engine_applies_pragmas(tmp_path):
+    from aep_example.config import Settings
+    from aep_example.db import build_engine
+
+    def pragmas(conn):
+        return (
+            conn.exec_driver_sql("PRAGMA journal_mode").scalar(),
+            conn.exec_driver_sql("PRAGMA synchronous").scalar(),
+            conn.exec_driver_sql("PRAGMA busy_timeout").scalar(),
+        )
+
+    engine = build_engine(Settings(database_url=f"sqlite+aiosqlite:///{tmp_path / 'tuned.db'}"))
+    assert _run(engine, pragmas) == ("wal", 1, 5000)
+    asyncio.run(engine.dispose())
+
+    engine = build_engine(Settings(database_url=f"sqlite+aiosqlite:///{tmp_path / 'plain.db'}", sqlite_tuning=False))
+    assert _run(engine, pragmas)[:2] == ("delete", 2)
+    asyncio.run(engine.dispose())
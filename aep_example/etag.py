@@ -0,0 +1,44 @@
+import hashlib
+import uuid
+from typing import Iterable, List, Optional, Tuple
+
+
+def new_etag() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def quote(etag: str) -> str:
+    return f'"{etag}"'
+
+
+def list_etag(rows: Iterable[Tuple[str, str]], next_page_token: str) -> str:
+    """ETag for a list page, derived from the (id, etag) of each row without serializing them."""
+    digest = hashlib.sha256()
+    for resource_id, etag in rows:
+        digest.update(f"{resource_id}:{etag}\n".encode())
+    digest.update(next_page_token.encode())
+    return digest.hexdigest()[:16]
+
+
+def parse(header: Optional[str], weak: bool = True) -> List[str]:
+    """The opaque values listed in an If-Match/If-None-Match header.
+
+    Weak validators (W/"...") are kept only when weak is True: If-None-Match
+    uses weak comparison, If-Match requires strong comparison.
+    """
+    if not header:
+        return []
+    values = []
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            if not weak:
+                continue
+            candidate = candidate[2:]
+        values.append(candidate.strip('"'))
+    return values
+
+
+def matches(header: Optional[str], etag: str) -> bool:
+    values = parse(header)
+    return "*" in values or etag in values
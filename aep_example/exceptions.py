@@ -15,7 +15,8 @@ async def http_exception_handler(request: Request, exc: StarletteHTTPException):
     return JSONResponse(
         status_code=exc.status_code,
         content=problem.model_dump(exclude_none=True),
-        media_type="application/problem+json"
+        media_type="application/problem+json",
+        headers=getattr(exc, "headers", None)
     )
 
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
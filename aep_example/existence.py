@@ -0,0 +1,175 @@
+import asyncio
+import hashlib
+import logging
+import math
+import time
+from typing import Iterable, Iterator, List, Optional
+
+from sqlalchemy import func, select
+
+from .config import settings
+from .db import DBBook, DBShelf
+
+logger = logging.getLogger(__name__)
+
+# Existence indexes: a Bloom filter of the ids in a table, answering either
+# "definitely absent" or "maybe present". Lookups of ids that don't exist
+# (stale links, scanners) get their 404 without a query, and creates skip
+# the collision check for ids that are definitely new.
+#
+# A filter is built from its table at startup and ids are added as they are
+# created, twice: inside the mutation, so a later mutation in the same
+# coalesced transaction sees the id, and again once it has committed, in
+# case the filter was rebuilt from a snapshot taken in between. A rolled
+# back create leaves its id behind, which only costs a false positive.
+# Bloom filters can't remove, so deleted ids stay in the filter the same
+# way, until it is next rebuilt.
+#
+# Until a filter is built (and with the index disabled) everything may be
+# present, so every lookup goes to the database as before. The filters only
+# know this process's writes: with several worker processes, one would 404
+# ids another just created, so serve --production turns them off.
+
+REBUILD_YIELD_PER = 10000
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, false_positive_rate: float):
+        self.capacity = max(capacity, 1)
+        self.size = max(64, math.ceil(-self.capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        # Distinct keys added, approximately: a key whose bits were all
+        # set already isn't counted.
+        self.count = 0
+
+    def _positions(self, key: str) -> Iterator[int]:
+        # Double hashing: k positions from two 64-bit halves of one digest.
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key: str):
+        added = False
+        for position in self._positions(key):
+            byte, bit = divmod(position, 8)
+            if not self.bits[byte] & (1 << bit):
+                self.bits[byte] |= 1 << bit
+                added = True
+        if added:
+            self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        # Most absent keys stop at the first unset bit.
+        for position in self._positions(key):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def false_positive_rate(self) -> float:
+        """The expected false positive rate for the keys added so far."""
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+
+class ExistenceIndex:
+    """The existence filter for one table's ids."""
+
+    def __init__(self, name: str, column, false_positive_rate: float, min_capacity: int):
+        self.name = name
+        self.column = column
+        self.false_positive_rate = false_positive_rate
+        self.min_capacity = min_capacity
+        self.filter: Optional[BloomFilter] = None
+        self.session_factories: List = []
+        # Lookups answered "absent" without a query, and "maybe present"
+        # answers that the database then didn't find.
+        self.negatives = 0
+        self.false_positives = 0
+        # Ids created while a rebuild is reading the table.
+        self._pending: Optional[List[str]] = None
+        self._rebuild_task: Optional[asyncio.Task] = None
+
+    def might_exist(self, key: str) -> bool:
+        if self.filter is None or key in self.filter:
+            return True
+        self.negatives += 1
+        return False
+
+    def record_false_positive(self):
+        """Count a "maybe present" answer for an id the database didn't find."""
+        if self.filter is not None:
+            self.false_positives += 1
+
+    def add(self, keys: Iterable[str]):
+        keys = list(keys)
+        if self._pending is not None:
+            self._pending.extend(keys)
+        if self.filter is None:
+            return
+        for key in keys:
+            self.filter.add(key)
+        # Past capacity the false positive rate climbs, so size a new one.
+        if self.filter.count > self.filter.capacity and self._pending is None:
+            self._pending = []
+            self._rebuild_task = asyncio.get_running_loop().create_task(self._regrow())
+
+    async def _regrow(self):
+        try:
+            await self.rebuild(self.session_factories)
+        except Exception:
+            # The full filter keeps answering, just less often "absent".
+            logger.exception("Rebuilding the %s existence index failed", self.name)
+
+    async def rebuild(self, session_factories: List):
+        """Build the filter from the ids in the table on every shard, sized for twice as many."""
+        self.session_factories = session_factories
+        if self._pending is None:
+            self._pending = []
+        try:
+            start = time.perf_counter()
+            count = 0
+            for session_factory in session_factories:
+                async with session_factory() as db:
+                    count += (await db.execute(select(func.count()).select_from(self.column.table))).scalar()
+            bloom = BloomFilter(max(self.min_capacity, 2 * count), self.false_positive_rate)
+            for session_factory in session_factories:
+                async with session_factory() as db:
+                    ids = await db.stream_scalars(select(self.column).execution_options(yield_per=REBUILD_YIELD_PER))
+                    async for key in ids:
+                        bloom.add(key)
+            for key in self._pending:
+                bloom.add(key)
+            self.filter = bloom
+            logger.info("Built the %s existence index: %d ids in %.2f s", self.name, bloom.count, time.perf_counter() - start)
+        finally:
+            self._pending = None
+
+    def metrics(self) -> list:
+        rate = self.filter.false_positive_rate() if self.filter is not None else 0.0
+        return [
+            (f"aep_{self.name}_existence_false_positive_rate", "gauge", f"Expected false positive rate of the {self.name} existence index.", rate),
+            (f"aep_{self.name}_existence_negatives_total", "counter", f"Lookups of {self.name} answered absent without a query.", self.negatives),
+            (f"aep_{self.name}_existence_false_positives_total", "counter", f"Lookups of {self.name} the existence index let through for ids the database didn't find.", self.false_positives),
+        ]
+
+
+class Existence:
+    def __init__(self, false_positive_rate: float, min_capacity: int):
+        self.shelves = ExistenceIndex("shelves", DBShelf.id, false_positive_rate, min_capacity)
+        self.books = ExistenceIndex("books", DBBook.id, false_positive_rate, min_capacity)
+
+    async def rebuild(self, session_factories: List):
+        await self.shelves.rebuild(session_factories)
+        await self.books.rebuild(session_factories)
+
+    def metrics(self) -> list:
+        return self.shelves.metrics() + self.books.metrics()
+
+
+existence = Existence(settings.existence_index_false_positive_rate, settings.existence_index_min_capacity)
+
+
+def get_existence() -> Existence:
+    return existence
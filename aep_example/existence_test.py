@@ -0,0 +1,51 @@
+import asyncio
+
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from aep_example.db import Base, DBShelf
+from aep_example.existence import BloomFilter, ExistenceIndex
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(10000, 0.01)
+    for i in range(10000):
+        bloom.add(f"id-{i}")
+    assert all(f"id-{i}" in bloom for i in range(10000))
+    assert bloom.count > 9900
+    false_positives = sum(f"other-{i}" in bloom for i in range(10000))
+    assert false_positives < 200
+    assert 0.005 < bloom.false_positive_rate() < 0.02
+
+
+def test_existence_index(tmp_path):
+    async def check():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'existence.db'}")
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+            await conn.execute(insert(DBShelf), [{"id": f"s{i}", "theme": "t", "etag": "e"} for i in range(5)])
+        session_factory = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+        index = ExistenceIndex("shelves", DBShelf.id, 0.01, min_capacity=4)
+        # Not built yet: anything may exist.
+        assert index.might_exist("missing")
+        await index.rebuild([session_factory])
+        assert index.filter.capacity == 10
+        assert all(index.might_exist(f"s{i}") for i in range(5))
+        assert not index.might_exist("missing")
+        assert index.negatives == 1
+
+        # Filling it up regrows it in the background, keeping the ids added meanwhile.
+        async with session_factory() as db:
+            await db.execute(insert(DBShelf), [{"id": f"new{i}", "theme": "t", "etag": "e"} for i in range(10)])
+            await db.commit()
+        index.add(f"new{i}" for i in range(10))
+        index.add(["during"])
+        await index._rebuild_task
+        assert index.filter.capacity == 30
+        assert all(index.might_exist(f"new{i}") for i in range(10))
+        assert index.might_exist("during")
+        await engine.dispose()
+
+    asyncio.run(check())
@@ -0,0 +1,132 @@
+import asyncio
+import sqlite3
+import sys
+from typing import AsyncIterator, Callable, List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .db import DBBook, DBShelf
+from .serialization import book_dict, shelf_dict, to_json
+from .shards import merge_streams, shard_path, shards
+from .streaming import STREAM_YIELD_PER
+
+# Exports of the whole library, for backups.
+#
+# The NDJSON export is one query over shelves LEFT JOIN books, so it reads
+# from a single snapshot; in WAL mode that holds no lock writers wait on.
+# Each shelf is followed by its books:
+#
+#   {"shelf": {"path": "shelves/s1", "theme": "..."}}
+#   {"book": {"path": "shelves/s1/books/b1", "title": "...", "author": "..."}}
+#   ...
+#   {"export": {"shelves": 1, "books": 1}}
+#
+# The final line holds the counts, so a truncated export can be detected.
+# With sharded storage, each shard is read from a snapshot of its own and
+# their rows are merged in shelf order.
+#
+# The snapshot export copies the database file itself with SQLite's online
+# backup API, SNAPSHOT_STEP_PAGES pages at a time, sleeping between steps
+# so writers get the database in between. A write made during the backup
+# restarts it from the next step, so a snapshot of a very busy database
+# may take several passes.
+
+SNAPSHOT_MEDIA_TYPE = "application/vnd.sqlite3"
+SNAPSHOT_STEP_PAGES = 1024
+SNAPSHOT_STEP_SLEEP_SECONDS = 0.005
+
+# Lines are sent in batches of about this many bytes.
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+
+def _by_shelf(row):
+    return row.shelf_id
+
+
+async def export_ndjson(*dbs: AsyncSession) -> AsyncIterator[bytes]:
+    """The library as NDJSON, read through one session per shard."""
+    query = (
+        select(DBShelf.id.label("shelf_id"), DBShelf.theme, DBBook.id, DBBook.title, DBBook.author)
+        .outerjoin(DBBook, DBBook.shelf_id == DBShelf.id)
+        .order_by(DBShelf.id, DBBook.id)
+        .execution_options(yield_per=STREAM_YIELD_PER)
+    )
+    streams = []
+    shelves = books = 0
+    current = None
+    buffer = bytearray()
+    try:
+        for db in dbs:
+            streams.append(await db.stream(query))
+        # A shelf's rows all come from one shard, so merging by shelf keeps them together.
+        async for row in merge_streams(streams, _by_shelf):
+            if row.shelf_id != current:
+                current = row.shelf_id
+                shelves += 1
+                buffer += to_json({"shelf": shelf_dict(row.shelf_id, row.theme)}) + b"\n"
+            if row.id is not None:
+                books += 1
+                buffer += to_json({"book": book_dict(row.shelf_id, row.id, row.title, row.author)}) + b"\n"
+            if len(buffer) >= EXPORT_CHUNK_BYTES:
+                yield bytes(buffer)
+                buffer.clear()
+    finally:
+        for stream in streams:
+            await stream.close()
+    buffer += to_json({"export": {"shelves": shelves, "books": books}}) + b"\n"
+    yield bytes(buffer)
+
+
+async def export_library(session_factories: List) -> AsyncIterator[bytes]:
+    """export_ndjson, in sessions of its own."""
+    sessions = [session_factory() for session_factory in session_factories]
+    try:
+        async for chunk in export_ndjson(*sessions):
+            yield chunk
+    finally:
+        for session in sessions:
+            await session.close()
+
+
+async def export_snapshot(db: AsyncSession, path: str, progress: Optional[Callable[[int, int, int], None]] = None):
+    """Copy the database behind db's connection to a new SQLite file at path."""
+    connection = await db.connection()
+    if connection.dialect.name != "sqlite":
+        raise ValueError("Snapshots are only supported for SQLite databases")
+    raw = await connection.get_raw_connection()
+    # The backup runs on aiosqlite's thread.
+    target = sqlite3.connect(path, check_same_thread=False)
+    try:
+        await raw.driver_connection.backup(
+            target, pages=SNAPSHOT_STEP_PAGES, sleep=SNAPSHOT_STEP_SLEEP_SECONDS, progress=progress,
+        )
+    finally:
+        target.close()
+
+
+async def _export(output: Optional[str], snapshot: bool):
+    try:
+        if snapshot:
+            # A file per shard, named like the shards themselves.
+            for i, shard in enumerate(shards):
+                async with shard.session_factory() as db:
+                    await export_snapshot(db, shard_path(output, i, len(shards)))
+            return
+        f = open(output, "wb") if output else sys.stdout.buffer
+        try:
+            async for chunk in export_library([shard.session_factory for shard in shards]):
+                f.write(chunk)
+        finally:
+            if output:
+                f.close()
+    finally:
+        await shards.dispose()
+
+
+def main(args) -> int:
+    if args.snapshot and not args.output:
+        print("error: --snapshot needs --output", file=sys.stderr)
+        return 2
+    asyncio.run(_export(args.output, args.snapshot))
+    return 0
@@ -0,0 +1,58 @@
+import asyncio
+import json
+import sqlite3
+
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from aep_example import export
+from aep_example.config import Settings
+from aep_example.db import DBBook, DBShelf, build_engine, migrate
+
+
+async def _library(tmp_path):
+    engine = build_engine(Settings(database_url=f"sqlite+aiosqlite:///{tmp_path / 'library.db'}"))
+    async with engine.begin() as conn:
+        await conn.run_sync(migrate)
+        await conn.execute(insert(DBShelf), [{"id": "s1", "theme": "t1", "etag": "e"}, {"id": "s2", "theme": "t2", "etag": "e"}])
+        await conn.execute(insert(DBBook), [{"id": f"b{i}", "title": "T", "author": "A", "shelf_id": "s1", "etag": "e"} for i in range(3)])
+    return engine, sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+
+def test_export_ndjson_reads_one_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setattr(export, "EXPORT_CHUNK_BYTES", 1)
+
+    async def check():
+        engine, session_factory = await _library(tmp_path)
+        async with session_factory() as db:
+            chunks = export.export_ndjson(db)
+            lines = [await chunks.__anext__()]
+            # Writers are not blocked by the export, and it doesn't see their writes
+            async with session_factory() as writer:
+                await writer.execute(insert(DBShelf).values(id="s0", theme="new", etag="e"))
+                await writer.execute(insert(DBBook).values(id="b9", title="T", author="A", shelf_id="s1", etag="e"))
+                await writer.commit()
+            lines += [chunk async for chunk in chunks]
+        await engine.dispose()
+        return [json.loads(line) for line in b"".join(lines).splitlines()]
+
+    lines = asyncio.run(check())
+    assert lines[0] == {"shelf": {"path": "shelves/s1", "theme": "t1"}}
+    assert [line["book"]["path"] for line in lines[1:4]] == [f"shelves/s1/books/b{i}" for i in range(3)]
+    assert lines[4] == {"shelf": {"path": "shelves/s2", "theme": "t2"}}
+    assert lines[5] == {"export": {"shelves": 2, "books": 3}}
+
+
+def test_export_snapshot(tmp_path):
+    async def check():
+        engine, session_factory = await _library(tmp_path)
+        async with session_factory() as db:
+            await export.export_snapshot(db, str(tmp_path / "snapshot.db"))
+        await engine.dispose()
+
+    asyncio.run(check())
+    snapshot = sqlite3.connect(tmp_path / "snapshot.db")
+    assert snapshot.execute("SELECT count(*) FROM books").fetchone() == (3,)
+    assert snapshot.execute("SELECT id FROM shelves ORDER BY id").fetchall() == [("s1",), ("s2",)]
+    snapshot.close()
@@ -0,0 +1,193 @@
+import re
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import and_, not_, or_
+from sqlalchemy.sql.elements import ColumnElement
+
+# A subset of the AEP-160 filter language:
+#
+#   filter      = conjunction
+#   conjunction = sequence { "AND" sequence }
+#   sequence    = disjunction { disjunction }      (implicit AND)
+#   disjunction = term { "OR" term }               (OR binds tighter than AND)
+#   term        = [ "NOT" | "-" ] simple
+#   simple      = restriction | "(" conjunction ")"
+#   restriction = field comparator value
+#   comparator  = "=" | "!=" | "<" | "<=" | ">" | ">=" | ":"
+#   value       = quoted string | bare word
+#
+# e.g. author = "Ursula K. Le Guin" AND title:"earthsea"
+
+COMPARATORS = {
+    "=": lambda column, value: column == value,
+    "!=": lambda column, value: column != value,
+    "<": lambda column, value: column < value,
+    "<=": lambda column, value: column <= value,
+    ">": lambda column, value: column > value,
+    ">=": lambda column, value: column >= value,
+}
+
+# The ":" (has) comparator is resolved by the caller, e.g. as a full-text search.
+Search = Callable[[str, str], ColumnElement]
+
+# A compiled filter for storage without SQL: true for the rows it matches.
+Predicate = Callable[[Any], bool]
+
+_TOKEN = re.compile(r'\s*(?:(?P<string>"(?:[^"\\]|\\.)*")|(?P<op><=|>=|!=|[=<>:()-])|(?P<word>[^\s=<>!:()"]+))')
+
+
+class InvalidFilter(ValueError):
+    pass
+
+
+def _tokenize(text: str) -> List[Tuple[str, str]]:
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = _TOKEN.match(text, pos)
+        if not match:
+            raise InvalidFilter(f"Unexpected character in filter at position {pos}: {text[pos]!r}")
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "string":
+            value = re.sub(r"\\(.)", r"\1", value[1:-1])
+        elif kind == "word" and value in ("AND", "OR", "NOT"):
+            kind = "op"
+        tokens.append((kind, value))
+        pos = match.end()
+    return tokens
+
+
+class _Parser:
+    """Parses a filter into a SQL expression."""
+
+    def __init__(self, text: str, columns: Dict[str, Any], search: Optional[Callable]):
+        self.tokens = _tokenize(text)
+        self.pos = 0
+        self.columns = columns
+        self.search = search
+
+    def all_of(self, terms: list):
+        return and_(*terms)
+
+    def any_of(self, terms: list):
+        return or_(*terms)
+
+    def negate(self, term):
+        return not_(term)
+
+    def compare(self, field: str, comparator: str, value: str):
+        return COMPARATORS[comparator](self.columns[field], value)
+
+    def peek(self) -> Tuple[Optional[str], Optional[str]]:
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None, None
+
+    def take(self) -> Tuple[Optional[str], Optional[str]]:
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def expect(self, value: str):
+        kind, got = self.take()
+        if kind != "op" or got != value:
+            raise InvalidFilter(f"Expected {value!r} in filter, got {got!r}")
+
+    def parse(self) -> ColumnElement:
+        expression = self.conjunction()
+        if self.pos < len(self.tokens):
+            raise InvalidFilter(f"Unexpected {self.peek()[1]!r} in filter")
+        return expression
+
+    def conjunction(self) -> ColumnElement:
+        terms = [self.sequence()]
+        while self.peek() == ("op", "AND"):
+            self.take()
+            terms.append(self.sequence())
+        return self.all_of(terms) if len(terms) > 1 else terms[0]
+
+    def sequence(self) -> ColumnElement:
+        terms = [self.disjunction()]
+        while self.peek()[0] is not None and self.peek() not in (("op", "AND"), ("op", ")")):
+            terms.append(self.disjunction())
+        return self.all_of(terms) if len(terms) > 1 else terms[0]
+
+    def disjunction(self) -> ColumnElement:
+        terms = [self.term()]
+        while self.peek() == ("op", "OR"):
+            self.take()
+            terms.append(self.term())
+        return self.any_of(terms) if len(terms) > 1 else terms[0]
+
+    def term(self) -> ColumnElement:
+        if self.peek() in (("op", "NOT"), ("op", "-")):
+            self.take()
+            return self.negate(self.simple())
+        return self.simple()
+
+    def simple(self) -> ColumnElement:
+        if self.peek() == ("op", "("):
+            self.take()
+            expression = self.conjunction()
+            self.expect(")")
+            return expression
+        return self.restriction()
+
+    def restriction(self) -> ColumnElement:
+        kind, field = self.take()
+        if kind != "word":
+            raise InvalidFilter(f"Expected a field name in filter, got {field!r}")
+        if field not in self.columns:
+            raise InvalidFilter(f"Unknown field in filter: {field}")
+        kind, comparator = self.take()
+        if kind != "op" or (comparator not in COMPARATORS and comparator != ":"):
+            raise InvalidFilter(f"Expected a comparator after {field!r} in filter, got {comparator!r}")
+        kind, value = self.take()
+        if kind not in ("string", "word"):
+            raise InvalidFilter(f"Expected a value after {field} {comparator} in filter, got {value!r}")
+        if comparator == ":":
+            if self.search is None:
+                raise InvalidFilter(f"The : operator is not supported on {field}")
+            return self.search(field, value)
+        return self.compare(field, comparator, value)
+
+
+class _PredicateParser(_Parser):
+    """Parses a filter into a function of a row, with columns mapping fields to getters."""
+
+    def all_of(self, terms: list) -> Predicate:
+        return lambda row: all(term(row) for term in terms)
+
+    def any_of(self, terms: list) -> Predicate:
+        return lambda row: any(term(row) for term in terms)
+
+    def negate(self, term: Predicate) -> Predicate:
+        return lambda row: not term(row)
+
+    def compare(self, field: str, comparator: str, value: str) -> Predicate:
+        get, compare = self.columns[field], COMPARATORS[comparator]
+        return lambda row: compare(get(row), value)
+
+
+def compile_filter(text: str, columns: Dict[str, ColumnElement], search: Optional[Search] = None) -> Optional[ColumnElement]:
+    """Translate a filter into a SQL expression over columns, or None when it is empty.
+
+    columns maps the field names clients may filter on to the columns they
+    compare against. search builds the expression for field:value.
+    """
+    if not text or not text.strip():
+        return None
+    return _Parser(text, columns, search).parse()
+
+
+def compile_predicate(text: str, getters: Dict[str, Callable[[Any], Any]], search: Optional[Callable[[str, str], Predicate]] = None) -> Optional[Predicate]:
+    """Like compile_filter, for rows in memory: a function true for the rows the filter matches.
+
+    getters maps the field names clients may filter on to functions reading
+    them from a row. search builds the predicate for field:value.
+    """
+    if not text or not text.strip():
+        return None
+    return _PredicateParser(text, getters, search).parse()
@@ -0,0 +1,55 @@
+import pytest
+from sqlalchemy import column
+
+from .filtering import InvalidFilter, compile_filter, compile_predicate
+
+COLUMNS = {"title": column("title"), "author": column("author")}
+
+
+def _sql(text, search=None):
+    expression = compile_filter(text, COLUMNS, search)
+    return str(expression.compile(compile_kwargs={"literal_binds": True}))
+
+
+def test_compile_filter():
+    assert compile_filter("", COLUMNS) is None
+    assert _sql('author = "Le Guin"') == "author = 'Le Guin'"
+    assert _sql('author != x') == "author != 'x'"
+    assert _sql('title = "say \\"hi\\""') == "title = 'say \"hi\"'"
+    # OR binds tighter than AND, whitespace is an implicit AND
+    assert _sql('title = a AND author = b OR author = c') == "title = 'a' AND (author = 'b' OR author = 'c')"
+    assert _sql('title = a author = b') == "title = 'a' AND author = 'b'"
+    assert _sql('(title = a AND author = b) OR author = c') == "title = 'a' AND author = 'b' OR author = 'c'"
+    assert _sql('NOT title = a -author = b') == "title != 'a' AND author != 'b'"
+    assert _sql('title:"sea"', lambda field, value: COLUMNS[field].contains(value)) == "title LIKE '%' || 'sea' || '%'"
+
+
+@pytest.mark.parametrize("text", [
+    'isbn = 1',
+    'title = ',
+    'title "x"',
+    'title = a AND',
+    '(title = a',
+    'title = a)',
+    'title:"x"',
+    'title = "unterminated',
+])
+def test_compile_filter_invalid(text):
+    with pytest.raises(InvalidFilter):
+        compile_filter(text, COLUMNS)
+
+
+def test_compile_predicate():
+    getters = {"title": lambda row: row["title"], "author": lambda row: row["author"]}
+    books = [{"title": "A Wizard of Earthsea", "author": "Le Guin"}, {"title": "Dune", "author": "Herbert"}]
+
+    def matching(text, search=None):
+        predicate = compile_predicate(text, getters, search)
+        return [book["title"] for book in books if predicate(book)]
+
+    assert compile_predicate(" ", getters) is None
+    assert matching('author = "Le Guin"') == ["A Wizard of Earthsea"]
+    assert matching('NOT author = "Le Guin"') == ["Dune"]
+    assert matching('title > "B" author != x') == ["Dune"]
+    assert matching('author = x OR title = Dune AND author = Herbert') == ["Dune"]
+    assert matching('title:sea', lambda field, value: lambda row: value in row[field]) == ["A Wizard of Earthsea"]
@@ -0,0 +1,226 @@
+import codecs
+import csv
+import json
+import re
+import uuid
+from typing import AsyncIterator, Dict, List, Optional, Sequence, Tuple, Union
+
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .cache import ResourceCache
+from .changes import CREATED, ChangeFeed, change, record_changes
+from .db import DBBook, DBShelf
+from .etag import new_etag
+from .existence import ExistenceIndex
+from .operations import OperationFailed, operation_dict, update_operation
+from .repository import books_on
+from .serialization import book_dict
+from .streaming import NDJSON_MEDIA_TYPE
+
+# Bulk imports stream the request body: it is decoded and split into rows
+# as it arrives, and rows are inserted chunk by chunk, so memory use is
+# bounded by the chunk size rather than by the size of the upload.
+
+CSV_MEDIA_TYPE = "text/csv"
+IMPORT_MEDIA_TYPES = (NDJSON_MEDIA_TYPE, CSV_MEDIA_TYPE)
+
+# Only the first errors are kept in the operation, the rest are counted.
+MAX_REPORTED_ERRORS = 100
+
+# A quoted CSV field may span lines, up to this many.
+MAX_RECORD_LINES = 1000
+
+ID_PATTERN = re.compile(r"^[a-zA-Z0-9\-]+$")
+
+# A parsed row, or why the row could not be parsed, with its line number.
+Row = Tuple[int, Union[dict, str]]
+
+
+async def _lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    pending = ""
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending.rstrip("\r")
+
+
+async def ndjson_rows(chunks: AsyncIterator[bytes]) -> AsyncIterator[Row]:
+    line_number = 0
+    async for line in _lines(chunks):
+        line_number += 1
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield line_number, f"Invalid JSON: {e}"
+            continue
+        if not isinstance(row, dict):
+            yield line_number, "Expected a JSON object"
+            continue
+        yield line_number, row
+
+
+async def csv_rows(chunks: AsyncIterator[bytes]) -> AsyncIterator[Row]:
+    """Rows of a CSV file whose first line names the columns."""
+    header: Optional[List[str]] = None
+    record: List[str] = []
+    quotes = 0
+    line_number = start = 0
+    async for line in _lines(chunks):
+        line_number += 1
+        if not record:
+            start = line_number
+        record.append(line)
+        # An odd number of quotes so far means a quoted field spans lines.
+        quotes += line.count('"')
+        if quotes % 2:
+            if len(record) >= MAX_RECORD_LINES:
+                raise OperationFailed(f"Unterminated quoted field on line {start}")
+            continue
+        try:
+            fields = next(csv.reader(["\n".join(record)]), [])
+        except csv.Error as e:
+            fields = None
+            error = f"Invalid CSV: {e}"
+        record, quotes = [], 0
+        if header is None:
+            if fields is None or not {"title", "author"} <= set(fields):
+                raise OperationFailed("The CSV header must name the title and author columns")
+            header = fields
+        elif fields is None:
+            yield start, error
+        elif fields:
+            if len(fields) != len(header):
+                yield start, f"Expected {len(header)} columns, got {len(fields)}"
+                continue
+            yield start, dict(zip(header, fields))
+    if record:
+        yield start, "Unterminated quoted field"
+
+
+def validate_row(row: dict) -> dict:
+    """The columns of a books row, or ValueError."""
+    book_id, title, author = row.get("id"), row.get("title"), row.get("author")
+    if not isinstance(title, str) or not isinstance(author, str):
+        raise ValueError("title and author are required strings")
+    if book_id in (None, ""):
+        return {"id": None, "title": title, "author": author}
+    if not isinstance(book_id, str) or not ID_PATTERN.match(book_id):
+        raise ValueError(f"Invalid book id: {book_id!r}")
+    return {"id": book_id, "title": title, "author": author}
+
+
+class BookImporter:
+    """Imports parsed rows into a shelf, a transaction per chunk of rows.
+
+    Progress and the first per-row errors are recorded in the operation's
+    metadata as each chunk commits, and the last chunk marks it done.
+    """
+
+    def __init__(self, shelf_id: str, operation_id: str, writer, cache: ResourceCache, feed: ChangeFeed, book_ids: ExistenceIndex, chunk_size: int, other_shards: Sequence = ()):
+        self.shelf_id = shelf_id
+        self.operation_id = operation_id
+        self.writer = writer
+        self.cache = cache
+        self.feed = feed
+        self.book_ids = book_ids
+        self.chunk_size = chunk_size
+        # Book ids are unique on every shard, not just the shelf's.
+        self.other_shards = list(other_shards)
+        self.imported = 0
+        self.failed = 0
+        self.errors: List[Dict] = []
+
+    def metadata(self, imported: int, failed: int, errors: List[Dict]) -> dict:
+        return {
+            "shelf": f"shelves/{self.shelf_id}",
+            "books_imported": imported,
+            "rows_failed": failed,
+            "errors": errors,
+        }
+
+    def response(self, imported: int, failed: int) -> dict:
+        return {"books_imported": imported, "rows_failed": failed}
+
+    def operation(self, error: Optional[dict] = None) -> dict:
+        response = None if error else self.response(self.imported, self.failed)
+        metadata = self.metadata(self.imported, self.failed, self.errors)
+        return operation_dict(self.operation_id, True, metadata, error, response)
+
+    def _errors_with(self, errors: List[Dict], new: List[Tuple[int, str]]) -> List[Dict]:
+        room = MAX_REPORTED_ERRORS - len(errors)
+        return errors + [{"line": line, "detail": detail} for line, detail in new[:max(room, 0)]]
+
+    async def run(self, rows: AsyncIterator[Row]):
+        chunk: List[Tuple[int, dict]] = []
+        invalid: List[Tuple[int, str]] = []
+        async for line, row in rows:
+            if isinstance(row, str):
+                invalid.append((line, row))
+            else:
+                try:
+                    chunk.append((line, validate_row(row)))
+                except ValueError as e:
+                    invalid.append((line, str(e)))
+            if len(chunk) + len(invalid) >= self.chunk_size:
+                await self._flush(chunk, invalid, done=False)
+                chunk, invalid = [], []
+        await self._flush(chunk, invalid, done=True)
+
+    async def _flush(self, chunk: List[Tuple[int, dict]], invalid: List[Tuple[int, str]], done: bool):
+        for _, row in chunk:
+            if row["id"] is None:
+                row["id"] = str(uuid.uuid4())
+        ids = [row["id"] for _, row in chunk]
+        elsewhere = set(await books_on(self.other_shards, [i for i in ids if self.book_ids.might_exist(i)]))
+
+        async def mutation(db: AsyncSession):
+            # A forced DeleteShelf may have finished since the last chunk,
+            # and books must not outlive their shelf.
+            if not (await db.execute(select(DBShelf.id).where(DBShelf.id == self.shelf_id))).first():
+                raise OperationFailed(f"Shelf not found: shelves/{self.shelf_id}", 404)
+            maybe_existing = [i for i in ids if self.book_ids.might_exist(i)]
+            existing = set((await db.execute(select(DBBook.id).where(DBBook.id.in_(maybe_existing)))).scalars().all()) if maybe_existing else set()
+            existing |= elsewhere
+            failed = list(invalid)
+            rows = []
+            for line, row in chunk:
+                if row["id"] in existing:
+                    failed.append((line, f"Book already exists: {row['id']}"))
+                    continue
+                existing.add(row["id"])
+                rows.append({**row, "shelf_id": self.shelf_id, "etag": new_etag()})
+            if rows:
+                await db.execute(insert(DBBook), rows)
+            self.book_ids.add(row["id"] for row in rows)
+            await record_changes(db, [
+                change(CREATED, f"shelves/{self.shelf_id}/books/{row['id']}", row["etag"], book_dict(self.shelf_id, row["id"], row["title"], row["author"]))
+                for row in rows
+            ])
+            failed.sort()
+            errors = self._errors_with(self.errors, failed)
+            imported, failed_count = self.imported + len(rows), self.failed + len(failed)
+            metadata = self.metadata(imported, failed_count, errors)
+            if done:
+                await update_operation(db, self.operation_id, metadata=metadata, done=True, response=self.response(imported, failed_count))
+            else:
+                await update_operation(db, self.operation_id, metadata=metadata)
+            return rows, failed, errors
+
+        # The counters only move once the chunk has committed: the write
+        # coalescer may run the mutation more than once.
+        rows, failed, errors = await self.writer.run(mutation)
+        self.imported += len(rows)
+        self.failed += len(failed)
+        self.errors = errors
+        self.book_ids.add(row["id"] for row in rows)
+        for row in rows:
+            self.cache.invalidate(f"shelves/{self.shelf_id}/books/{row['id']}")
+        self.feed.notify()
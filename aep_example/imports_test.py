@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+from sqlalchemy import delete, func, insert, select
+
+from aep_example.cache import ResourceCache
+from aep_example.config import Settings
+from aep_example.db import DBBook, DBShelf
+from aep_example.existence import ExistenceIndex
+from aep_example.imports import BookImporter, csv_rows, ndjson_rows, validate_row
+from aep_example.operations import OperationFailed, create_operation, run_operation
+from aep_example.shards import build_shards
+
+
+def _rows(parse, *chunks):
+    async def stream():
+        for chunk in chunks:
+            yield chunk
+
+    async def collect():
+        return [row async for row in parse(stream())]
+
+    return asyncio.run(collect())
+
+
+def test_ndjson_rows_split_across_chunks():
+    # Chunks may split lines and multi-byte characters anywhere
+    body = '{"title": "Café", "author": "A"}\r\n\n[1]\n{"title": "B"}'.encode()
+    chunks = [body[i:i + 5] for i in range(0, len(body), 5)]
+    assert _rows(ndjson_rows, *chunks) == [
+        (1, {"title": "Café", "author": "A"}),
+        (3, "Expected a JSON object"),
+        (4, {"title": "B"}),
+    ]
+
+
+def test_csv_rows():
+    body = b'title,author,id\n"A ""quoted"" title",X,a1\n\n"two\nlines",Y,a2\n"open,Z\n'
+    assert _rows(csv_rows, body[:20], body[20:]) == [
+        (2, {"title": 'A "quoted" title', "author": "X", "id": "a1"}),
+        (4, {"title": "two\nlines", "author": "Y", "id": "a2"}),
+        (6, "Unterminated quoted field"),
+    ]
+    with pytest.raises(OperationFailed):
+        _rows(csv_rows, b"id,title\n1,x\n")
+
+
+def test_validate_row():
+    assert validate_row({"title": "T", "author": "A", "extra": 1}) == {"id": None, "title": "T", "author": "A"}
+    assert validate_row({"id": "b-1", "title": "T", "author": "A"})["id"] == "b-1"
+    for row in ({"title": "T"}, {"title": 1, "author": "A"}, {"id": "no/slashes", "title": "T", "author": "A"}):
+        with pytest.raises(ValueError):
+            validate_row(row)
+
+
+def test_import_stops_when_the_shelf_is_deleted(tmp_path):
+    shards = build_shards(Settings(database_url=f"sqlite+aiosqlite:///{tmp_path / 'library.db'}"))
+    shard = shards[0]
+
+    async def run():
+        await shards.init()
+
+        async def start(db):
+            await db.execute(insert(DBShelf).values(id="s1", theme="T", etag="e"))
+            return await create_operation(db)
+
+        operation = await shard.writer.run(start)
+        operation_id = operation["path"].split("/")[1]
+        books = ExistenceIndex("books", DBBook.id, 0.01, 100)
+        importer = BookImporter("s1", operation_id, shard.writer, ResourceCache(), shard.feed, books, chunk_size=1)
+
+        async def rows():
+            yield 1, {"title": "One", "author": "A"}
+            # A forced DeleteShelf finishing between chunks.
+            async with shard.session_factory() as db:
+                await db.execute(delete(DBBook))
+                await db.execute(delete(DBShelf))
+                await db.commit()
+            yield 2, {"title": "Two", "author": "A"}
+
+        error = await run_operation(shard.writer, operation_id, lambda: importer.run(rows()))
+        async with shard.session_factory() as db:
+            count = (await db.execute(select(func.count()).select_from(DBBook))).scalar()
+        await shards.dispose()
+        return error, count
+
+    error, count = asyncio.run(run())
+    assert error["status"] == 404
+    assert count == 0
@@ -1,8 +1,17 @@
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.openapi.docs import get_redoc_html, get_swagger_ui_html
+from fastapi.responses import PlainTextResponse
 from contextlib import asynccontextmanager
-from .db import init_db
+from .admission import admission
 from .api import router
+from .cache import ResourceCache, get_cache, resource_cache
+from .existence import existence
+from .config import settings
+from .metrics import MetricsMiddleware, metrics
+from .openapi import OpenAPIDocument, encode, patch_schema
+from .repository import check_storage_backend
+from .shards import shards
 
 from .exceptions import http_exception_handler, validation_exception_handler
 from .models import ProblemDetails
@@ -12,13 +21,28 @@ from fastapi.exceptions import RequestValidationError
 
 @asynccontextmanager
 async def setup_db(app: FastAPI):
+    check_storage_backend(settings)
+    if settings.storage_backend == "memory":
+        # Nothing to open or load: the library starts empty.
+        yield
+        return
     # Startup: Create tables
-    await init_db()
+    await shards.init()
+    if settings.existence_index_enabled:
+        await existence.rebuild([shard.session_factory for shard in shards])
+    shards.start(settings.write_coalescing)
     yield
-    # Shutdown
+    # Shutdown, once in-flight requests have drained: apply writes that are
+    # already queued, then close the pools' connections.
+    await shards.stop()
+    await shards.dispose()
 
 app = FastAPI(
     lifespan=setup_db,
+    # Served below, from the precomputed document.
+    openapi_url=None,
+    docs_url=None,
+    redoc_url=None,
     title="Library API",
     version="1.0.0",
     description="A simple library API.",
@@ -56,30 +80,121 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-app.include_router(router)
-
-import argparse
-import json
-import uvicorn
+if settings.metrics_enabled:
+    app.add_middleware(MetricsMiddleware, server_timing=settings.server_timing)
 
-def run_server():
-    uvicorn.run("aep_example.main:app", host="0.0.0.0", port=8000, reload=True)
+app.include_router(router)
 
-def generate_openapi():
-    openapi_data = app.openapi()
+openapi_document = OpenAPIDocument(app.openapi, settings.openapi_file or None)
+app.openapi = openapi_document.schema
+app.add_api_route("/openapi.json", openapi_document.endpoint, include_in_schema=False)
+
+@app.get("/docs", include_in_schema=False)
+async def swagger_ui():
+    return get_swagger_ui_html(openapi_url="/openapi.json", title=f"{app.title} - Swagger UI")
+
+@app.get("/redoc", include_in_schema=False)
+async def redoc():
+    return get_redoc_html(openapi_url="/openapi.json", title=f"{app.title} - ReDoc")
+
+@app.get("/_stats/cache", include_in_schema=False)
+async def cache_stats(cache: ResourceCache = Depends(get_cache)):
+    return cache.stats()
+
+def _component_metrics():
+    cache_stats = resource_cache.stats()
+    return [
+        ("aep_cache_hits_total", "counter", "Resource cache hits.", cache_stats["hits"]),
+        ("aep_cache_misses_total", "counter", "Resource cache misses.", cache_stats["misses"]),
+        ("aep_cache_evictions_total", "counter", "Resource cache LRU evictions.", cache_stats["evictions"]),
+        ("aep_cache_entries", "gauge", "Resources currently cached.", cache_stats["size"]),
+        ("aep_write_batches_total", "counter", "Transactions committed by the write coalescers.", sum(shard.coalescer.batches for shard in shards)),
+        ("aep_write_mutations_total", "counter", "Mutations applied by the write coalescers.", sum(shard.coalescer.mutations for shard in shards)),
+        ("aep_watch_subscribers", "gauge", "Open watch streams, counting a stream over several shards once per shard.", sum(shard.feed.subscribers for shard in shards)),
+        *existence.metrics(),
+        *admission.metrics(),
+    ]
+
+metrics.collectors.append(_component_metrics)
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
-    # Patch content type for merge-patch+json
-    for path, methods in openapi_data.get("paths", {}).items():
-        if "patch" in methods:
-            op = methods["patch"]
-            if "requestBody" in op and "content" in op["requestBody"]:
-                content = op["requestBody"]["content"]
-                if "application/json" in content:
-                    content["application/merge-patch+json"] = content.pop("application/json")
+import argparse
+import asyncio
+import os
+import sys
+from sqlalchemy.engine import make_url
+
+def server_options(args, settings) -> dict:
+    """uvicorn.run arguments for the serve subcommand."""
+    options = {
+        "host": args.host or settings.server_host,
+        "port": args.port or settings.server_port,
+    }
+    if not args.production:
+        return {**options, "reload": True}
+    return {
+        **options,
+        "workers": args.workers or settings.server_workers,
+        "loop": settings.server_loop,
+        "http": settings.server_http,
+        "backlog": settings.server_backlog,
+        "timeout_keep_alive": settings.server_keepalive_seconds,
+        "timeout_graceful_shutdown": settings.server_graceful_shutdown_seconds,
+        "access_log": settings.server_access_log,
+    }
 
-    with open("openapi.json", "w") as f:
-        json.dump(openapi_data, f, indent=2)
-        f.write("\n")
+def prepare_workers(settings, environ=os.environ):
+    """Set up the environment worker processes inherit, before they start."""
+    if settings.storage_backend == "memory":
+        raise SystemExit("error: workers can't share the memory storage backend, run a single worker")
+    if make_url(settings.database_url).database in (None, "", ":memory:"):
+        raise SystemExit("error: workers can't share an in-memory database, set AEP_DATABASE_URL to a file")
+    # Every worker must accept the page tokens the others sign.
+    environ.setdefault("AEP_PAGE_TOKEN_SECRET", settings.page_token_secret)
+    # Workers can't invalidate each other's caches, so a write on one would
+    # leave stale reads on the others until the TTL expires. Opt back in
+    # with AEP_CACHE_ENABLED=true if that's acceptable.
+    environ.setdefault("AEP_CACHE_ENABLED", "false")
+    # Likewise, a worker's existence index would answer "absent" for ids
+    # another worker created.
+    environ.setdefault("AEP_EXISTENCE_INDEX_ENABLED", "false")
+
+def run_server(args):
+    # Imported here, so the app itself (which is what each worker imports)
+    # and the other commands don't pay for it.
+    import uvicorn
+
+    options = server_options(args, settings)
+    if options.get("workers", 1) > 1:
+        prepare_workers(settings)
+        # Create and migrate the schema (and switch to WAL, which lets the
+        # workers read while one of them writes) once, rather than having
+        # the workers race to do it.
+        async def init_once():
+            await shards.init()
+            await shards.dispose()
+        asyncio.run(init_once())
+    uvicorn.run("aep_example.main:app", **options)
+
+def generate_openapi(path: str = "openapi.json", check: bool = False) -> int:
+    # Always built from the code, never from openapi_file.
+    content = encode(patch_schema(openapi_document.build()))
+    if check:
+        try:
+            with open(path, "rb") as f:
+                current = f.read()
+        except FileNotFoundError:
+            current = None
+        if current != content:
+            print(f"error: {path} does not match the code, run generate-openapi", file=sys.stderr)
+            return 1
+        return 0
+    with open(path, "wb") as f:
+        f.write(content)
+    return 0
 
 def main():
     parser = argparse.ArgumentParser(description="AEP Example Server")
@@ -87,16 +202,53 @@ def main():
 
     # Subcommand: serve
     parser_serve = subparsers.add_parser("serve", help="Start the server")
+    parser_serve.add_argument("--production", action="store_true", help="Run without auto-reload, with the server_* settings (workers, event loop, keep-alive, ...)")
+    parser_serve.add_argument("--host", help="Interface to bind (default from AEP_SERVER_HOST, 0.0.0.0)")
+    parser_serve.add_argument("--port", type=int, help="Port to bind (default from AEP_SERVER_PORT, 8000)")
+    parser_serve.add_argument("--workers", type=int, help="Worker processes with --production (default from AEP_SERVER_WORKERS, 1)")
 
     # Subcommand: generate-openapi
     parser_generate = subparsers.add_parser("generate-openapi", help="Generate OpenAPI JSON")
+    parser_generate.add_argument("--check", action="store_true", help="Exit 1 if openapi.json doesn't match the code, instead of writing it")
+
+    # Subcommand: benchmark
+    parser_benchmark = subparsers.add_parser("benchmark", help="Load test the API in-process against a throwaway database")
+    parser_benchmark.add_argument("--shelves", type=int, default=10, help="Number of shelves to seed")
+    parser_benchmark.add_argument("--books-per-shelf", type=int, default=1000, help="Number of books to seed on each shelf")
+    parser_benchmark.add_argument("--concurrency", type=int, default=16, help="Number of concurrent clients")
+    parser_benchmark.add_argument("--requests", type=int, default=5000, help="Total number of requests in the mixed workload")
+    parser_benchmark.add_argument("--seed", type=int, default=0, help="Random seed for the workload")
+    parser_benchmark.add_argument("--shards", type=int, default=1, help="Number of database shards (default 1)")
+    parser_benchmark.add_argument("--storage", choices=["sqlalchemy", "memory"], default="sqlalchemy", help="Storage backend to benchmark (default sqlalchemy)")
+    parser_benchmark.add_argument("--write-baseline", metavar="PATH", help="Write the results as a JSON baseline")
+    parser_benchmark.add_argument("--compare", metavar="PATH", help="Compare against a JSON baseline, failing on regressions")
+    parser_benchmark.add_argument("--threshold", type=float, default=0.2, help="Allowed regression in p95 latency or throughput, as a fraction (default 0.2)")
+
+    # Subcommand: export
+    parser_export = subparsers.add_parser("export", help="Export every shelf and book as NDJSON from one consistent snapshot")
+    parser_export.add_argument("--output", "-o", metavar="PATH", help="Write the export to PATH instead of stdout")
+    parser_export.add_argument("--snapshot", action="store_true", help="Write a copy of the SQLite database instead, using the online backup API")
+
+    # Subcommand: reshard
+    parser_reshard = subparsers.add_parser("reshard", help="Copy the library to a different number of database shards, with the server stopped")
+    parser_reshard.add_argument("--shards", type=int, required=True, help="Number of shards to copy the library to")
 
     args = parser.parse_args()
 
     if args.command == "serve":
-        run_server()
+        run_server(args)
     elif args.command == "generate-openapi":
-        generate_openapi()
+        sys.exit(generate_openapi(check=args.check))
+    elif args.command == "benchmark":
+        # httpx is a dev dependency, only needed here
+        from . import bench
+        sys.exit(bench.main(args))
+    elif args.command == "export":
+        from . import export
+        sys.exit(export.main(args))
+    elif args.command == "reshard":
+        from . import reshard
+        sys.exit(reshard.main(args))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,48 @@
+import argparse
+
+import pytest
+
+from aep_example.config import load_settings
+from aep_example.main import generate_openapi, prepare_workers, server_options
+
+
+def serve_args(**kwargs):
+    return argparse.Namespace(**{"production": False, "host": None, "port": None, "workers": None, **kwargs})
+
+
+def test_server_options_dev():
+    settings = load_settings({})
+    assert server_options(serve_args(port=9000), settings) == {"host": "0.0.0.0", "port": 9000, "reload": True}
+
+
+def test_server_options_production():
+    settings = load_settings({"AEP_SERVER_WORKERS": "4", "AEP_SERVER_LOOP": "uvloop"})
+    options = server_options(serve_args(production=True), settings)
+    assert "reload" not in options
+    assert options["workers"] == 4
+    assert options["loop"] == "uvloop"
+    assert options["timeout_graceful_shutdown"] == 30
+    assert server_options(serve_args(production=True, workers=2), settings)["workers"] == 2
+
+
+def test_prepare_workers():
+    settings = load_settings({"AEP_DATABASE_URL": "sqlite+aiosqlite:///./library.db"})
+    environ = {"AEP_CACHE_ENABLED": "true"}
+    prepare_workers(settings, environ)
+    assert environ["AEP_PAGE_TOKEN_SECRET"] == settings.page_token_secret
+    assert environ["AEP_CACHE_ENABLED"] == "true"
+
+    with pytest.raises(SystemExit):
+        prepare_workers(load_settings({"AEP_DATABASE_URL": "sqlite+aiosqlite://"}), {})
+    with pytest.raises(SystemExit):
+        prepare_workers(load_settings({"AEP_STORAGE_BACKEND": "memory"}), {})
+
+
+def test_generate_openapi_check(tmp_path):
+    path = str(tmp_path / "openapi.json")
+    assert generate_openapi(path, check=True) == 1
+    assert generate_openapi(path) == 0
+    assert generate_openapi(path, check=True) == 0
+    with open(path, "ab") as f:
+        f.write(b" ")
+    assert generate_openapi(path, check=True) == 1
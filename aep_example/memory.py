@@ -0,0 +1,284 @@
+from bisect import bisect_left, bisect_right, insort
+from typing import Dict, Iterator, List, Optional
+
+from fastapi import HTTPException
+
+from .cache import ResourceCache
+from .filtering import compile_predicate
+from .repository import Repository
+
+# The in-memory storage backend (storage_backend = "memory"): shelves and
+# books in dicts by id, for O(1) gets, plus sorted indexes of their ids (all
+# shelves, all books, and the books on each shelf) for keyset pagination.
+# A page seeks to the page token's id in O(log n) and reads on from there.
+#
+# Every method runs without awaiting, so each one, batches included, is
+# atomic with respect to the others. Nothing is persisted, and each process
+# has a library of its own.
+
+# Ids per chunk of a SortedIds, before it is split in two.
+CHUNK_SIZE = 1024
+
+
+class SortedIds:
+    """Ids in sorted order, as a list of sorted chunks.
+
+    Finding an id takes a binary search over the chunks' last ids, then one
+    within the chunk, and inserting or removing one only moves the ids of
+    its chunk, so neither grows with the number of ids.
+    """
+
+    __slots__ = ("_chunks", "_maxes", "_size")
+
+    def __init__(self):
+        self._chunks: List[List[str]] = []
+        self._maxes: List[str] = []
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, key: str):
+        self._size += 1
+        if not self._chunks:
+            self._chunks.append([key])
+            self._maxes.append(key)
+            return
+        i = bisect_left(self._maxes, key)
+        if i == len(self._chunks):
+            i -= 1
+            self._chunks[i].append(key)
+            self._maxes[i] = key
+        else:
+            insort(self._chunks[i], key)
+        chunk = self._chunks[i]
+        if len(chunk) > CHUNK_SIZE:
+            half = len(chunk) // 2
+            self._chunks[i:i + 1] = [chunk[:half], chunk[half:]]
+            self._maxes[i:i + 1] = [chunk[half - 1], chunk[-1]]
+
+    def remove(self, key: str):
+        i = bisect_left(self._maxes, key)
+        chunk = self._chunks[i]
+        del chunk[bisect_left(chunk, key)]
+        self._size -= 1
+        if chunk:
+            self._maxes[i] = chunk[-1]
+        else:
+            del self._chunks[i]
+            del self._maxes[i]
+
+    def after(self, key: Optional[str]) -> Iterator[str]:
+        """The ids after key (or from the first, with None), in order."""
+        if key is None:
+            i = j = 0
+        else:
+            i = bisect_right(self._maxes, key)
+            if i == len(self._chunks):
+                return
+            j = bisect_right(self._chunks[i], key)
+        for k in range(i, len(self._chunks)):
+            chunk = self._chunks[k]
+            yield from chunk[j:] if j else chunk
+            j = 0
+
+
+class MemoryShelf:
+    __slots__ = ("id", "theme", "etag")
+
+    def __init__(self, id: str, theme: str, etag: str):
+        self.id = id
+        self.theme = theme
+        self.etag = etag
+
+
+class MemoryBook:
+    __slots__ = ("id", "shelf_id", "title", "author", "etag")
+
+    def __init__(self, id: str, shelf_id: str, title: str, author: str, etag: str):
+        self.id = id
+        self.shelf_id = shelf_id
+        self.title = title
+        self.author = author
+        self.etag = etag
+
+
+BOOK_FILTER_FIELDS = {"title": lambda book: book.title, "author": lambda book: book.author}
+
+
+def _book_search(field: str, value: str):
+    # Case insensitive, like the full-text index.
+    value = value.casefold()
+    get = BOOK_FILTER_FIELDS[field]
+    return lambda book: value in get(book).casefold()
+
+
+def _page(ids: Iterator[str], rows: dict, limit: int, predicate=None) -> list:
+    page = []
+    for i in ids:
+        if len(page) == limit:
+            break
+        row = rows[i]
+        if predicate is None or predicate(row):
+            page.append(row)
+    return page
+
+
+def _matches(row, expected: Optional[List[str]]) -> bool:
+    return expected is None or row.etag in expected
+
+
+class MemoryRepository(Repository):
+    def __init__(self):
+        self.shelves: Dict[str, MemoryShelf] = {}
+        self.books: Dict[str, MemoryBook] = {}
+        self.shelf_ids = SortedIds()
+        self.book_ids = SortedIds()
+        self.shelf_book_ids: Dict[str, SortedIds] = {}
+
+    def _add_shelf(self, row: dict):
+        self.shelves[row["id"]] = MemoryShelf(row["id"], row["theme"], row["etag"])
+        self.shelf_ids.add(row["id"])
+        self.shelf_book_ids[row["id"]] = SortedIds()
+
+    def _remove_shelf(self, shelf_id: str):
+        del self.shelves[shelf_id]
+        del self.shelf_book_ids[shelf_id]
+        self.shelf_ids.remove(shelf_id)
+
+    def _add_book(self, shelf_id: str, row: dict):
+        self.books[row["id"]] = MemoryBook(row["id"], shelf_id, row["title"], row["author"], row["etag"])
+        self.book_ids.add(row["id"])
+        self.shelf_book_ids[shelf_id].add(row["id"])
+
+    def _remove_book(self, book: MemoryBook):
+        del self.books[book.id]
+        self.book_ids.remove(book.id)
+        self.shelf_book_ids[book.shelf_id].remove(book.id)
+
+    def _book(self, shelf_id: str, book_id: str) -> Optional[MemoryBook]:
+        # A book on another shelf doesn't exist at this path.
+        book = self.books.get(book_id)
+        return book if book is not None and book.shelf_id == shelf_id else None
+
+    # Shelves
+
+    async def get_shelf(self, shelf_id: str, fields: tuple):
+        return self.shelves.get(shelf_id)
+
+    async def list_shelves(self, after: Optional[str], limit: int, fields: tuple) -> list:
+        return _page(self.shelf_ids.after(after), self.shelves, limit)
+
+    async def create_shelf(self, shelf_id: str, theme: str, etag: str):
+        if shelf_id in self.shelves:
+            raise HTTPException(status_code=409, detail="Shelf already exists")
+        self._add_shelf({"id": shelf_id, "theme": theme, "etag": etag})
+
+    async def update_shelf(self, shelf_id: str, values: dict, etag: str, expected: Optional[List[str]]):
+        shelf = self.shelves.get(shelf_id)
+        if shelf is None:
+            raise HTTPException(status_code=404, detail="Shelf not found")
+        if not _matches(shelf, expected):
+            raise HTTPException(status_code=412, detail="Shelf etag does not match If-Match")
+        # Replaced rather than changed, so rows already handed out stay as they were.
+        updated = MemoryShelf(shelf_id, values.get("theme", shelf.theme), etag)
+        self.shelves[shelf_id] = updated
+        return updated
+
+    async def delete_shelf(self, shelf_id: str):
+        if shelf_id not in self.shelves:
+            raise HTTPException(status_code=404, detail="Shelf not found")
+        if self.shelf_book_ids[shelf_id]:
+            raise HTTPException(status_code=409, detail="Shelf is not empty, delete it with force=true")
+        self._remove_shelf(shelf_id)
+
+    async def force_delete_shelf(self, shelf_id: str, cache: ResourceCache):
+        if shelf_id not in self.shelves:
+            raise HTTPException(status_code=404, detail="Shelf not found")
+        # Nothing to wait on, so no operation: done by the time it returns.
+        for book_id in list(self.shelf_book_ids[shelf_id].after(None)):
+            self._remove_book(self.books[book_id])
+            cache.invalidate(f"shelves/{shelf_id}/books/{book_id}")
+        self._remove_shelf(shelf_id)
+        cache.invalidate(f"shelves/{shelf_id}")
+        return None
+
+    async def batch_create_shelves(self, rows: List[dict]):
+        existing = [row["id"] for row in rows if row["id"] in self.shelves]
+        if existing:
+            raise HTTPException(status_code=409, detail=f"Shelf already exists: shelves/{existing[0]}")
+        for row in rows:
+            self._add_shelf(row)
+
+    async def batch_get_shelves(self, shelf_ids: List[str]) -> dict:
+        return {i: self.shelves[i] for i in shelf_ids if i in self.shelves}
+
+    async def batch_delete_shelves(self, shelf_ids: List[str]):
+        ids = sorted(set(shelf_ids))
+        missing = [i for i in ids if i not in self.shelves]
+        if missing:
+            raise HTTPException(status_code=404, detail=f"Shelf not found: shelves/{missing[0]}")
+        non_empty = [i for i in ids if self.shelf_book_ids[i]]
+        if non_empty:
+            raise HTTPException(status_code=409, detail=f"Shelf is not empty: shelves/{non_empty[0]}")
+        for i in ids:
+            self._remove_shelf(i)
+
+    # Books
+
+    async def get_book(self, shelf_id: str, book_id: str, fields: tuple):
+        return self._book(shelf_id, book_id)
+
+    async def list_books(self, shelf_id: Optional[str], after: Optional[str], limit: int, fields: tuple, filter: str) -> Optional[list]:
+        predicate = compile_predicate(filter, BOOK_FILTER_FIELDS, _book_search)
+        if shelf_id is None:
+            ids = self.book_ids
+        else:
+            ids = self.shelf_book_ids.get(shelf_id)
+            if ids is None:
+                return None
+        return _page(ids.after(after), self.books, limit, predicate)
+
+    async def create_book(self, shelf_id: str, book_id: str, title: str, author: str, etag: str):
+        if shelf_id not in self.shelves:
+            raise HTTPException(status_code=404, detail="Parent shelf not found")
+        if book_id in self.books:
+            raise HTTPException(status_code=409, detail="Book already exists")
+        self._add_book(shelf_id, {"id": book_id, "title": title, "author": author, "etag": etag})
+
+    async def update_book(self, shelf_id: str, book_id: str, values: dict, etag: str, expected: Optional[List[str]]):
+        book = self._book(shelf_id, book_id)
+        if book is None:
+            raise HTTPException(status_code=404, detail="Book not found")
+        if not _matches(book, expected):
+            raise HTTPException(status_code=412, detail="Book etag does not match If-Match")
+        updated = MemoryBook(book_id, shelf_id, values.get("title", book.title), values.get("author", book.author), etag)
+        self.books[book_id] = updated
+        return updated
+
+    async def delete_book(self, shelf_id: str, book_id: str):
+        book = self._book(shelf_id, book_id)
+        if book is None:
+            raise HTTPException(status_code=404, detail="Book not found")
+        self._remove_book(book)
+
+    async def batch_create_books(self, shelf_id: str, rows: List[dict]):
+        if shelf_id not in self.shelves:
+            raise HTTPException(status_code=404, detail="Parent shelf not found")
+        existing = [row["id"] for row in rows if row["id"] in self.books]
+        if existing:
+            raise HTTPException(status_code=409, detail=f"Book already exists: {existing[0]}")
+        for row in rows:
+            self._add_book(shelf_id, row)
+
+    async def batch_get_books(self, shelf_id: str, book_ids: List[str]) -> dict:
+        books = (self._book(shelf_id, i) for i in book_ids)
+        return {book.id: book for book in books if book is not None}
+
+    async def batch_delete_books(self, shelf_id: str, book_ids: List[str]):
+        ids = sorted(set(book_ids))
+        missing = [i for i in ids if self._book(shelf_id, i) is None]
+        if missing:
+            raise HTTPException(status_code=404, detail=f"Book not found: shelves/{shelf_id}/books/{missing[0]}")
+        for i in ids:
+            self._remove_book(self.books[i])
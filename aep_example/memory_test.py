@@ -0,0 +1,107 @@
+import random
+
+import pytest
+from fastapi.testclient import TestClient
+
+from aep_example import memory
+from aep_example.main import app
+from aep_example.memory import MemoryRepository, SortedIds
+from aep_example.repository import Repository, get_repository
+
+
+def test_sorted_ids(monkeypatch):
+    monkeypatch.setattr(memory, "CHUNK_SIZE", 4)
+    ids = SortedIds()
+    keys = [f"k{i:03d}" for i in range(100)]
+    shuffled = keys[:]
+    random.Random(0).shuffle(shuffled)
+    for key in shuffled:
+        ids.add(key)
+    assert len(ids) == 100
+    assert list(ids.after(None)) == keys
+    assert list(ids.after("k049"))[:2] == ["k050", "k051"]
+    assert list(ids.after("k0495")) == keys[50:]
+    assert list(ids.after("k099")) == []
+    for key in shuffled[:90]:
+        ids.remove(key)
+    assert list(ids.after(None)) == sorted(shuffled[90:])
+    assert list(ids.after("a")) == sorted(shuffled[90:])
+
+
+def test_backends_implement_every_method():
+    class Partial(Repository):
+        async def get_shelf(self, shelf_id, fields):
+            return None
+
+    # Refused when built, rather than a 500 on the first request it can't serve.
+    with pytest.raises(TypeError):
+        Partial()
+    MemoryRepository()
+
+
+@pytest.fixture
+def client():
+    repository = MemoryRepository()
+    app.dependency_overrides[get_repository] = lambda: repository
+    yield TestClient(app)
+    app.dependency_overrides.pop(get_repository, None)
+
+
+def test_memory_backend(client):
+    assert client.post("/shelves", params={"id": "s1"}, json={"theme": "Fantasy"}).status_code == 201
+    assert client.post("/shelves", params={"id": "s1"}, json={"theme": "Fantasy"}).status_code == 409
+    resp = client.post("/shelves:batchCreate", json={"requests": [{"id": "s2", "shelf": {"theme": "SF"}}, {"id": "s3", "shelf": {"theme": "Empty"}}]})
+    assert resp.status_code == 200
+
+    books = [("b1", "A Wizard of Earthsea", "Le Guin"), ("b2", "Dune", "Herbert"), ("b3", "The Tombs of Atuan", "Le Guin")]
+    resp = client.post("/shelves/s1/books:batchCreate", json={"requests": [{"id": i, "book": {"title": t, "author": a}} for i, t, a in books]})
+    assert resp.status_code == 200
+    assert client.post("/shelves/s2/books", params={"id": "b4"}, json={"title": "Hyperion", "author": "Simmons"}).status_code == 201
+    assert client.post("/shelves/s2/books", params={"id": "b1"}, json={"title": "T", "author": "A"}).status_code == 409
+    assert client.post("/shelves/nope/books", json={"title": "T", "author": "A"}).status_code == 404
+
+    page = client.get("/shelves/s1/books", params={"max_page_size": 2}).json()
+    assert [b["path"] for b in page["books"]] == ["shelves/s1/books/b1", "shelves/s1/books/b2"]
+    page = client.get("/shelves/s1/books", params={"max_page_size": 2, "page_token": page["next_page_token"]}).json()
+    assert [b["path"] for b in page["books"]] == ["shelves/s1/books/b3"]
+    assert page["next_page_token"] == ""
+    assert client.get("/shelves/nope/books").status_code == 404
+    assert client.get("/shelves/s3/books").json()["books"] == []
+
+    resp = client.get("/shelves/s1/books", params={"filter": 'author = "Le Guin" AND title:EARTH'})
+    assert [b["path"] for b in resp.json()["books"]] == ["shelves/s1/books/b1"]
+    assert client.get("/shelves/s1/books", params={"filter": "isbn = 1"}).status_code == 400
+    resp = client.get("/shelves/-/books", params={"read_mask": "path,author"})
+    assert resp.json()["books"][-1] == {"path": "shelves/s2/books/b4", "author": "Simmons"}
+
+    resp = client.get("/shelves/s1/books/b2")
+    assert resp.json() == {"path": "shelves/s1/books/b2", "title": "Dune", "author": "Herbert"}
+    assert client.get("/shelves/s2/books/b2").status_code == 404
+    assert client.get("/shelves/s1/books/b2", headers={"If-None-Match": resp.headers["etag"]}).status_code == 304
+    assert client.patch("/shelves/s1/books/b2", json={"title": "Dune Messiah"}, headers={"If-Match": '"stale"'}).status_code == 412
+    resp = client.patch("/shelves/s1/books/b2", json={"title": "Dune Messiah"}, headers={"If-Match": resp.headers["etag"]})
+    assert resp.json()["title"] == "Dune Messiah"
+    assert client.get("/shelves/s1/books/b2").json()["title"] == "Dune Messiah"
+
+    resp = client.get("/shelves:batchGet", params={"paths": ["shelves/s2", "shelves/s1"]})
+    assert [s["theme"] for s in resp.json()["results"]] == ["SF", "Fantasy"]
+    assert client.get("/shelves/s1/books:batchGet", params={"paths": ["shelves/s1/books/b4"]}).status_code == 404
+
+    assert client.delete("/shelves/s1").status_code == 409
+    assert client.post("/shelves:batchDelete", json={"paths": ["shelves/s3", "shelves/s1"]}).status_code == 409
+    assert client.post("/shelves/s1/books:batchDelete", json={"paths": ["shelves/s1/books/b1", "shelves/s1/books/b2"]}).status_code == 204
+    assert client.delete("/shelves/s1/books/b3").status_code == 204
+    assert client.delete("/shelves/s1/books/b3").status_code == 404
+    assert client.delete("/shelves/s1").status_code == 204
+    assert [s["path"] for s in client.get("/shelves").json()["shelves"]] == ["shelves/s2", "shelves/s3"]
+
+    # A forced delete is done by the time it returns, books and all.
+    assert client.delete("/shelves/s2").status_code == 409
+    assert client.delete("/shelves/s2", params={"force": True}).status_code == 204
+    assert client.get("/shelves/s2/books/b4").status_code == 404
+    assert client.get("/shelves/-/books").json()["books"] == []
+    assert client.delete("/shelves/s2", params={"force": True}).status_code == 404
+
+    # These keep their state in the database.
+    assert client.get("/shelves:watch").status_code == 501
+    assert client.get("/shelves:export").status_code == 501
@@ -0,0 +1,217 @@
+import bisect
+import contextvars
+import functools
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds, in seconds, shared by every histogram. Finer than the
+# Prometheus defaults at the low end, where most SQLite statements land.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Statements executed outside of a request, e.g. by the write coalescer.
+BACKGROUND = "background"
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RequestTimings:
+    """Per-request measurements, shared through a context variable."""
+
+    __slots__ = ("operation", "db_statements", "db_seconds", "write_wait_seconds", "endpoint_end", "serialize_seconds")
+
+    def __init__(self):
+        self.operation: Optional[str] = None
+        self.db_statements = 0
+        self.db_seconds = 0.0
+        # Time spent waiting on the write coalescer, whose statements run
+        # outside of the request and so aren't in db_seconds.
+        self.write_wait_seconds = 0.0
+        self.endpoint_end: Optional[float] = None
+        # FastAPI's encoding of the endpoint's result, plus responses the
+        # endpoint rendered itself (TrustedJSONResponse).
+        self.serialize_seconds = 0.0
+
+
+_current: contextvars.ContextVar[Optional[RequestTimings]] = contextvars.ContextVar("aep_request_timings", default=None)
+
+
+def current_timings() -> Optional[RequestTimings]:
+    """The timings of the request being handled, if any."""
+    return _current.get()
+
+
+def record_write_wait(seconds: float):
+    timings = _current.get()
+    if timings is not None:
+        timings.write_wait_seconds += seconds
+
+
+class Metrics:
+    def __init__(self):
+        self.request_duration: Dict[str, Histogram] = defaultdict(Histogram)
+        self.requests: Dict[Tuple[str, int], int] = defaultdict(int)
+        self.db_duration: Dict[str, Histogram] = defaultdict(Histogram)
+        self.db_statements: Dict[str, int] = defaultdict(int)
+        self.serialize_duration: Dict[str, Histogram] = defaultdict(Histogram)
+        self.background_db_seconds = 0.0
+        # Callables returning extra (name, type, help, value) samples, so other
+        # components can publish their counters without depending on this module.
+        self.collectors: List[Callable[[], List[Tuple[str, str, str, float]]]] = []
+
+    def record_request(self, timings: RequestTimings, status_code: int, seconds: float):
+        operation = timings.operation or "unmatched"
+        self.request_duration[operation].observe(seconds)
+        self.requests[(operation, status_code)] += 1
+        self.db_duration[operation].observe(timings.db_seconds)
+        self.db_statements[operation] += timings.db_statements
+        self.serialize_duration[operation].observe(timings.serialize_seconds)
+
+    def render(self) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        lines: List[str] = []
+        _histograms(lines, "aep_request_duration_seconds", "Request latency by operation.", self.request_duration)
+        lines.append("# HELP aep_requests_total Requests by operation and status code.")
+        lines.append("# TYPE aep_requests_total counter")
+        for (operation, status_code), value in sorted(self.requests.items()):
+            lines.append(f'aep_requests_total{{operation="{operation}",code="{status_code}"}} {value}')
+        _histograms(lines, "aep_db_duration_seconds", "Time spent executing SQL per request, by operation.", self.db_duration)
+        lines.append("# HELP aep_db_statements_total SQL statements executed, by operation.")
+        lines.append("# TYPE aep_db_statements_total counter")
+        for operation, value in sorted(self.db_statements.items()):
+            lines.append(f'aep_db_statements_total{{operation="{operation}"}} {value}')
+        lines.append("# HELP aep_background_db_seconds_total Time spent executing SQL outside of requests.")
+        lines.append("# TYPE aep_background_db_seconds_total counter")
+        lines.append(f"aep_background_db_seconds_total {self.background_db_seconds}")
+        _histograms(lines, "aep_serialization_duration_seconds", "Time from the endpoint returning to the response being built (validation and serialization).", self.serialize_duration)
+        for collect in self.collectors:
+            for name, kind, help_text, value in collect():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _histograms(lines: List[str], name: str, help_text: str, histograms: Dict[str, Histogram]):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} histogram")
+    for operation, histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ("+Inf",), histogram.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{operation="{operation}",le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_sum{{operation="{operation}"}} {histogram.sum}')
+        lines.append(f'{name}_count{{operation="{operation}"}} {histogram.count}')
+
+
+metrics = Metrics()
+
+
+# --- SQL instrumentation ---
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info["aep_statement_start"] = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info.pop("aep_statement_start", time.perf_counter())
+    timings = _current.get()
+    if timings is None:
+        metrics.db_statements[BACKGROUND] += 1
+        metrics.background_db_seconds += elapsed
+        return
+    timings.db_statements += 1
+    timings.db_seconds += elapsed
+
+
+# --- Request instrumentation ---
+
+class InstrumentedRoute(APIRoute):
+    """Records the operation id and how long FastAPI spends serializing the endpoint's result."""
+
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        @functools.wraps(endpoint)
+        async def timed_endpoint(*args, **kwargs):
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                timings = _current.get()
+                if timings is not None:
+                    timings.endpoint_end = time.perf_counter()
+
+        super().__init__(path, timed_endpoint, **kwargs)
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        operation = self.operation_id or self.name
+
+        async def instrumented_handler(request):
+            timings = _current.get()
+            if timings is None:
+                return await handler(request)
+            timings.operation = operation
+            response = await handler(request)
+            if timings.endpoint_end is not None:
+                timings.serialize_seconds += time.perf_counter() - timings.endpoint_end
+            return response
+
+        return instrumented_handler
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware timing each HTTP request.
+
+    With server_timing enabled, a Server-Timing header breaks the request's
+    time down into database and serialization time.
+    """
+
+    def __init__(self, app, server_timing: bool = False):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        timings = RequestTimings()
+        token = _current.set(timings)
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if self.server_timing:
+                    total_ms = (time.perf_counter() - start) * 1000
+                    value = (
+                        f'db;dur={timings.db_seconds * 1000:.2f};desc="{timings.db_statements} statements", '
+                        f"ser;dur={timings.serialize_seconds * 1000:.2f}, "
+                        f"total;dur={total_ms:.2f}"
+                    )
+                    message["headers"] = list(message.get("headers", [])) + [(b"server-timing", value.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            metrics.record_request(timings, status_code, time.perf_counter() - start)
+            _current.reset(token)
@@ -0,0 +1,74 @@
+import asyncio
+
+from fastapi import APIRouter, FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from aep_example.metrics import Histogram, InstrumentedRoute, Metrics, MetricsMiddleware, metrics
+from aep_example.serialization import TrustedJSONResponse
+
+
+def test_histogram_buckets():
+    histogram = Histogram()
+    for value in (0.0001, 0.0005, 0.003, 100):
+        histogram.observe(value)
+    assert histogram.counts[0] == 2  # le=0.0005 is inclusive
+    assert histogram.counts[3] == 1
+    assert histogram.counts[-1] == 1
+    assert histogram.count == 4
+
+
+def test_render_prometheus_text():
+    registry = Metrics()
+    registry.collectors.append(lambda: [("aep_things_total", "counter", "Things.", 3)])
+    registry.request_duration["GetShelf"].observe(0.002)
+    registry.requests[("GetShelf", 200)] += 1
+    text_format = registry.render()
+    assert 'aep_request_duration_seconds_bucket{operation="GetShelf",le="0.0025"} 1' in text_format
+    assert 'aep_request_duration_seconds_bucket{operation="GetShelf",le="+Inf"} 1' in text_format
+    assert 'aep_requests_total{operation="GetShelf",code="200"} 1' in text_format
+    assert "# TYPE aep_things_total counter\naep_things_total 3" in text_format
+
+
+def test_middleware_records_operations_and_sql():
+    engine = create_async_engine("sqlite+aiosqlite://")
+    router = APIRouter(route_class=InstrumentedRoute)
+
+    @router.get("/things", operation_id="ListThings")
+    async def list_things():
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+            await conn.execute(text("SELECT 2"))
+        return {"things": []}
+
+    app = FastAPI()
+    app.add_middleware(MetricsMiddleware, server_timing=True)
+    app.include_router(router)
+
+    before = metrics.db_statements["ListThings"]
+    response = TestClient(app).get("/things")
+    assert response.status_code == 200
+    assert metrics.db_statements["ListThings"] == before + 2
+    assert metrics.requests[("ListThings", 200)] >= 1
+    assert 'db;dur=' in response.headers["server-timing"]
+    assert 'desc="2 statements"' in response.headers["server-timing"]
+    asyncio.run(engine.dispose())
+
+
+def test_trusted_responses_count_as_serialization():
+    router = APIRouter(route_class=InstrumentedRoute)
+
+    @router.get("/books", operation_id="ListManyBooks")
+    async def list_books():
+        return TrustedJSONResponse({"books": [{"path": f"shelves/s/books/{i}", "title": "T" * 50} for i in range(20000)]})
+
+    app = FastAPI()
+    app.add_middleware(MetricsMiddleware, server_timing=True)
+    app.include_router(router)
+
+    response = TestClient(app).get("/books")
+    assert response.status_code == 200
+    # Encoding 20000 books takes milliseconds, all of it inside the endpoint.
+    assert metrics.serialize_duration["ListManyBooks"].sum > 0.001
+    assert float(response.headers["server-timing"].split("ser;dur=")[1].split(",")[0]) > 1
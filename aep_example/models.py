@@ -5,6 +5,7 @@ from pydantic import BaseModel, Field
 # Common regex patterns
 SHELF_NAME_PATTERN = r"^shelves/[a-zA-Z0-9\-]+$"
 BOOK_NAME_PATTERN = r"^shelves/[a-zA-Z0-9\-]+/books/[a-zA-Z0-9\-]+$"
+OPERATION_NAME_PATTERN = r"^operations/[a-zA-Z0-9\-]+$"
 
 class ProblemDetails(BaseModel):
     type: str = Field(description="A URI reference that identifies the problem type.", json_schema_extra={"format": "uri-reference"})
@@ -58,6 +59,38 @@ class ListBooksResponse(BaseModel):
     books: List[Book]
     next_page_token: str = ""
 
+class CreateShelfRequest(BaseModel):
+    id: Optional[str] = Field(default=None, description="The ID to use for the shelf. Generated by the server if empty.")
+    shelf: Shelf
+
+class BatchCreateShelvesRequest(BaseModel):
+    requests: List[CreateShelfRequest]
+
+class BatchCreateShelvesResponse(BaseModel):
+    results: List[Shelf]
+
+class BatchGetShelvesResponse(BaseModel):
+    results: List[Shelf]
+
+class BatchDeleteShelvesRequest(BaseModel):
+    paths: List[str] = Field(description="The paths of the shelves to delete.")
+
+class CreateBookRequest(BaseModel):
+    id: Optional[str] = Field(default=None, description="The ID to use for the book. Generated by the server if empty.")
+    book: Book
+
+class BatchCreateBooksRequest(BaseModel):
+    requests: List[CreateBookRequest]
+
+class BatchCreateBooksResponse(BaseModel):
+    results: List[Book]
+
+class BatchGetBooksResponse(BaseModel):
+    results: List[Book]
+
+class BatchDeleteBooksRequest(BaseModel):
+    paths: List[str] = Field(description="The paths of the books to delete.")
+
 class ShelfUpdate(BaseModel):
     path: Optional[str] = Field(default=None, pattern=SHELF_NAME_PATTERN, description="The resource path.", json_schema_extra={"readOnly": True, "type": "string"})
     theme: Optional[str] = None
@@ -88,3 +121,10 @@ class BookUpdate(BaseModel):
             }
         }
     }
+
+class Operation(BaseModel):
+    path: str = Field(pattern=OPERATION_NAME_PATTERN, description="The resource path.")
+    done: bool = Field(description="Whether the operation has finished, either successfully or with an error.")
+    metadata: Optional[Dict[str, Any]] = Field(None, description="Progress of the operation.")
+    error: Optional[ProblemDetails] = Field(None, description="Why the operation failed, once done.")
+    response: Optional[Dict[str, Any]] = Field(None, description="The result of the operation, once done.")
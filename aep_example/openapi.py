@@ -0,0 +1,81 @@
+import hashlib
+import json
+from typing import Callable, Optional
+
+from fastapi import Request, Response, status
+
+from . import etag as etags
+
+# /openapi.json is served from one precomputed document: the schema FastAPI
+# builds, with the same patches generate-openapi applies, encoded once and
+# hashed into a strong ETag. The bytes are exactly those generate-openapi
+# writes to openapi.json, so the served and committed schemas can be
+# compared byte for byte.
+#
+# Building the schema walks every route and model, which is slow enough to
+# matter when many workers start at once. With openapi_file set, the
+# document is read from that file (e.g. the openapi.json written by
+# generate-openapi from the same code) and not built at all, nor checked
+# against the code: a stale file is served as it is. generate-openapi
+# --check tells whether a file still matches.
+
+MERGE_PATCH_MEDIA_TYPE = "application/merge-patch+json"
+
+
+def patch_schema(schema: dict) -> dict:
+    # Patch content type for merge-patch+json
+    for path, methods in schema.get("paths", {}).items():
+        if "patch" in methods:
+            op = methods["patch"]
+            if "requestBody" in op and "content" in op["requestBody"]:
+                content = op["requestBody"]["content"]
+                if "application/json" in content:
+                    content[MERGE_PATCH_MEDIA_TYPE] = content.pop("application/json")
+    return schema
+
+
+def encode(schema: dict) -> bytes:
+    return (json.dumps(schema, indent=2) + "\n").encode()
+
+
+class OpenAPIDocument:
+    """The encoded schema and its ETag, loaded on first use."""
+
+    def __init__(self, build: Callable[[], dict], path: Optional[str] = None):
+        self.build = build
+        self.path = path
+        self._content: Optional[bytes] = None
+        self._schema: Optional[dict] = None
+        self._etag = ""
+
+    def load(self):
+        if self._content is None:
+            if self.path:
+                with open(self.path, "rb") as f:
+                    content = f.read()
+            else:
+                content = encode(patch_schema(self.build()))
+            self._etag = hashlib.sha256(content).hexdigest()[:16]
+            self._content = content
+
+    @property
+    def content(self) -> bytes:
+        self.load()
+        return self._content
+
+    @property
+    def etag(self) -> str:
+        self.load()
+        return self._etag
+
+    def schema(self) -> dict:
+        # Parsed once, like FastAPI's own openapi_schema.
+        if self._schema is None:
+            self._schema = json.loads(self.content)
+        return self._schema
+
+    async def endpoint(self, request: Request) -> Response:
+        headers = {"ETag": etags.quote(self.etag), "Cache-Control": "no-cache"}
+        if etags.matches(request.headers.get("if-none-match"), self.etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(self.content, media_type="application/json", headers=headers)
@@ -0,0 +1,48 @@
+import asyncio
+
+from starlette.requests import Request
+
+from aep_example.openapi import OpenAPIDocument, encode, patch_schema
+
+
+def patch_operation(media_type):
+    return {"paths": {"/things/{id}": {"patch": {"requestBody": {"content": {media_type: {"schema": {}}}}}}}}
+
+
+def test_patch_schema():
+    schema = patch_schema(patch_operation("application/json"))
+    assert schema == patch_operation("application/merge-patch+json")
+
+
+def test_document_from_file(tmp_path):
+    path = tmp_path / "openapi.json"
+    path.write_bytes(encode({"openapi": "3.1.0"}))
+
+    def build():
+        raise AssertionError("the schema should not be built")
+
+    document = OpenAPIDocument(build, str(path))
+    assert document.schema() == {"openapi": "3.1.0"}
+    # Parsed once.
+    assert document.schema() is document.schema()
+    assert document.etag == OpenAPIDocument(lambda: {"openapi": "3.1.0"}).etag
+
+
+def test_endpoint():
+    builds = []
+
+    def build():
+        builds.append(1)
+        return patch_operation("application/json")
+
+    document = OpenAPIDocument(build)
+
+    def get(headers=()):
+        scope = {"type": "http", "method": "GET", "path": "/openapi.json", "headers": [(k.encode(), v.encode()) for k, v in headers]}
+        return asyncio.run(document.endpoint(Request(scope)))
+
+    resp = get()
+    assert resp.status_code == 200
+    assert resp.body == encode(patch_operation("application/merge-patch+json"))
+    assert get([("if-none-match", resp.headers["etag"])]).status_code == 304
+    assert builds == [1]
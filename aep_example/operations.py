@@ -0,0 +1,74 @@
+import logging
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from sqlalchemy import insert, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .db import DBOperation
+
+logger = logging.getLogger(__name__)
+
+# Long-running operations (AEP-151). A method that takes too long to finish
+# within a request records an operation, hands the work to a background
+# task and returns the operation right away. The task reports progress in
+# the operation's metadata and finally marks it done, with either a
+# response or an error, for clients polling GET /operations/{id}.
+
+
+class OperationFailed(Exception):
+    """Raised by an operation's work to fail it with a client error."""
+
+    def __init__(self, detail: str, status: int = 400):
+        super().__init__(detail)
+        self.detail = detail
+        self.status = status
+
+
+def operation_dict(operation_id: str, done: bool, metadata=None, error=None, response=None) -> dict:
+    operation = {"path": f"operations/{operation_id}", "done": done, "metadata": metadata}
+    if error is not None:
+        operation["error"] = error
+    if response is not None:
+        operation["response"] = response
+    return operation
+
+
+async def create_operation(db: AsyncSession, metadata: Optional[Dict[str, Any]] = None) -> dict:
+    """Record a new pending operation, as part of the caller's mutation."""
+    operation_id = str(uuid.uuid4())
+    await db.execute(insert(DBOperation).values(id=operation_id, done=False, meta=metadata))
+    return operation_dict(operation_id, False, metadata)
+
+
+async def update_operation(db: AsyncSession, operation_id: str, **values):
+    """Update an operation's metadata, done, error or response, as part of the caller's mutation."""
+    if "metadata" in values:
+        values["meta"] = values.pop("metadata")
+    await db.execute(
+        update(DBOperation).where(DBOperation.id == operation_id).values(**values),
+        execution_options={"synchronize_session": False},
+    )
+
+
+async def run_operation(writer, operation_id: str, work: Callable[[], Awaitable[None]]) -> Optional[dict]:
+    """Run an operation's work, failing the operation if the work raises.
+
+    work is responsible for marking the operation done when it succeeds, in
+    the same transaction as its last write. Returns the operation's error,
+    if any.
+    """
+    try:
+        await work()
+        return None
+    except OperationFailed as e:
+        error = {"type": "aep.example.com/operation-error", "title": "Operation failed", "status": e.status, "detail": e.detail}
+    except Exception as e:
+        logger.exception("Operation %s failed", operation_id)
+        error = {"type": "aep.example.com/operation-error", "title": "Operation failed", "status": 500, "detail": str(e)}
+
+    async def fail(db: AsyncSession):
+        await update_operation(db, operation_id, done=True, error=error)
+
+    await writer.run(fail)
+    return error
@@ -0,0 +1,40 @@
+import asyncio
+
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from aep_example.db import Base, DBOperation
+from aep_example.operations import create_operation, run_operation, update_operation
+from aep_example.writer import SessionFactoryWriter
+
+
+def test_run_operation(tmp_path):
+    async def check():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'operations.db'}")
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        session_factory = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+        writer = SessionFactoryWriter(session_factory)
+
+        ok = await writer.run(lambda db: create_operation(db, {"step": 0}))
+        failing = await writer.run(lambda db: create_operation(db))
+        ok_id, failing_id = ok["path"].split("/")[1], failing["path"].split("/")[1]
+
+        async def work():
+            await writer.run(lambda db: update_operation(db, ok_id, metadata={"step": 1}, done=True, response={}))
+
+        async def broken():
+            raise RuntimeError("disk on fire")
+
+        await run_operation(writer, ok_id, work)
+        await run_operation(writer, failing_id, broken)
+
+        async with session_factory() as db:
+            done = await db.get(DBOperation, ok_id)
+            assert (done.done, done.meta, done.error, done.response) == (True, {"step": 1}, None, {})
+            failed = await db.get(DBOperation, failing_id)
+            assert failed.done
+            assert failed.error["detail"] == "disk on fire"
+        await engine.dispose()
+
+    asyncio.run(check())
@@ -0,0 +1,49 @@
+import base64
+import hashlib
+import hmac
+import json
+
+from .config import settings
+
+# Page tokens are opaque to clients: a base64 JSON payload holding the last
+# key returned and the request scope (parent, filter, ...) that produced it,
+# followed by an HMAC so clients cannot forge a position or reuse a token
+# against a different query.
+
+
+class InvalidPageToken(ValueError):
+    pass
+
+
+def _sign(payload: bytes) -> str:
+    digest = hmac.new(settings.page_token_secret.encode(), payload, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:16]).decode().rstrip("=")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def encode_page_token(last_key: str, scope: dict) -> str:
+    payload = json.dumps({"k": last_key, "s": scope}, separators=(",", ":"), sort_keys=True).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=") + "." + _sign(payload)
+
+
+def decode_page_token(token: str, scope: dict) -> str:
+    """Return the last key encoded in token, checking it was issued for scope."""
+    try:
+        data, signature = token.split(".")
+        payload = _b64decode(data)
+    except ValueError:
+        raise InvalidPageToken("Malformed page token")
+    # Compared as bytes: compare_digest refuses str with non-ASCII characters.
+    if not hmac.compare_digest(signature.encode(), _sign(payload).encode()):
+        raise InvalidPageToken("Invalid page token signature")
+    try:
+        decoded = json.loads(payload)
+        key, token_scope = decoded["k"], decoded["s"]
+    except (ValueError, TypeError, KeyError):
+        raise InvalidPageToken("Malformed page token")
+    if token_scope != scope:
+        raise InvalidPageToken("Page token does not match the request")
+    return key
@@ -0,0 +1,25 @@
+from typing import Optional, Sequence, Tuple
+
+# Response fields of each resource, in the order they are serialized.
+SHELF_FIELDS = ("path", "theme")
+BOOK_FIELDS = ("path", "title", "author")
+
+ALL_FIELDS = "*"
+
+
+class InvalidReadMask(ValueError):
+    pass
+
+
+def parse_read_mask(read_mask: Optional[str], fields: Sequence[str]) -> Tuple[str, ...]:
+    """The fields selected by a comma separated read mask, in resource order.
+
+    A missing or empty mask, or "*", selects every field.
+    """
+    if not read_mask or read_mask.strip() == ALL_FIELDS:
+        return tuple(fields)
+    requested = {f.strip() for f in read_mask.split(",")} - {""}
+    unknown = sorted(requested - set(fields))
+    if unknown:
+        raise InvalidReadMask(f"Unknown field in read_mask: {unknown[0]}")
+    return tuple(f for f in fields if f in requested)
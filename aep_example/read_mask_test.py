@@ -0,0 +1,15 @@
+import pytest
+
+from .read_mask import BOOK_FIELDS, InvalidReadMask, parse_read_mask
+
+
+def test_parse_read_mask():
+    assert parse_read_mask(None, BOOK_FIELDS) == BOOK_FIELDS
+    assert parse_read_mask("", BOOK_FIELDS) == BOOK_FIELDS
+    assert parse_read_mask("*", BOOK_FIELDS) == BOOK_FIELDS
+    # Fields come back in resource order, whatever order they were asked in
+    assert parse_read_mask("title, path", BOOK_FIELDS) == ("path", "title")
+    assert parse_read_mask("author,author,", BOOK_FIELDS) == ("author",)
+
+    with pytest.raises(InvalidReadMask):
+        parse_read_mask("title,theme", BOOK_FIELDS)
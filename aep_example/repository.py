@@ -0,0 +1,683 @@
+import asyncio
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, Awaitable, Callable, Iterable, List, Optional, Tuple
+
+from fastapi import Depends, HTTPException, status
+from sqlalchemy import and_, delete, insert, literal_column, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy.sql import column, table
+
+from .cache import ResourceCache
+from .changes import CREATED, DELETED, UPDATED, change, record_changes
+from .config import Settings, settings
+from .db import DBBook, DBShelf
+from .existence import Existence, get_existence
+from .filtering import compile_filter
+from .operations import create_operation, run_operation, update_operation
+from .serialization import book_dict, shelf_dict
+from .shards import Shard, Shards, get_shards, merge, merge_streams
+from .streaming import STREAM_YIELD_PER
+
+# Storage for shelves and books, behind one interface so the API doesn't
+# care what holds them. SQLRepository is the library in SQLite (the
+# default); MemoryRepository, in memory.py, keeps everything in process
+# memory, for load tests and edge caches that can afford to lose it.
+# storage_backend picks one.
+#
+# Methods raise HTTPException for missing resources and conflicts, as the
+# writer's mutations always have. Reads return rows: objects with id, etag
+# and the other fields as attributes. Lists return up to limit rows in id
+# order after the id of a page token, so callers ask for one more row than
+# they show to learn whether there is another page.
+#
+# Change logs, long-running operations, imports and exports are stored in
+# the database alongside the rows they're about, so they need the SQL
+# repository.
+
+# A stream of rows and a function closing it.
+RowStream = Tuple[AsyncIterator, Callable[[], Awaitable[None]]]
+
+
+async def _rows(rows: list) -> AsyncIterator:
+    for row in rows:
+        yield row
+
+
+async def _no_close():
+    pass
+
+
+class Repository(ABC):
+    # Shelves
+
+    @abstractmethod
+    async def get_shelf(self, shelf_id: str, fields: tuple):
+        """The shelf, or None."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def list_shelves(self, after: Optional[str], limit: int, fields: tuple) -> list:
+        raise NotImplementedError
+
+    async def stream_shelves(self, after: Optional[str], limit: int, fields: tuple) -> RowStream:
+        return _rows(await self.list_shelves(after, limit, fields)), _no_close
+
+    @abstractmethod
+    async def create_shelf(self, shelf_id: str, theme: str, etag: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def update_shelf(self, shelf_id: str, values: dict, etag: str, expected: Optional[List[str]]):
+        """Apply values and the new etag, if the current etag is one of expected (or expected is None).
+
+        Returns the shelf after the update.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def delete_shelf(self, shelf_id: str):
+        """Delete a shelf, only if it has no books."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def force_delete_shelf(self, shelf_id: str, cache: ResourceCache) -> Optional[Tuple[dict, Callable[[], Awaitable[None]]]]:
+        """Delete a shelf and its books, invalidating them in cache.
+
+        Returns None once they're deleted, or a long-running operation and
+        the work that completes it, for the caller to run after responding.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def batch_create_shelves(self, rows: List[dict]):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def batch_get_shelves(self, shelf_ids: List[str]) -> dict:
+        """The shelves found, by id."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def batch_delete_shelves(self, shelf_ids: List[str]):
+        raise NotImplementedError
+
+    # Books. shelf_id None lists the books on every shelf, as rows that
+    # also have a shelf_id.
+
+    @abstractmethod
+    async def get_book(self, shelf_id: str, book_id: str, fields: tuple):
+        """The book, or None."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def list_books(self, shelf_id: Optional[str], after: Optional[str], limit: int, fields: tuple, filter: str) -> Optional[list]:
+        """The page, or None if the shelf doesn't exist. Raises InvalidFilter."""
+        raise NotImplementedError
+
+    async def stream_books(self, shelf_id: Optional[str], after: Optional[str], limit: int, fields: tuple, filter: str) -> Optional[RowStream]:
+        rows = await self.list_books(shelf_id, after, limit, fields, filter)
+        if rows is None:
+            return None
+        return _rows(rows), _no_close
+
+    @abstractmethod
+    async def create_book(self, shelf_id: str, book_id: str, title: str, author: str, etag: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def update_book(self, shelf_id: str, book_id: str, values: dict, etag: str, expected: Optional[List[str]]):
+        """Like update_shelf."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def delete_book(self, shelf_id: str, book_id: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def batch_create_books(self, shelf_id: str, rows: List[dict]):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def batch_get_books(self, shelf_id: str, book_ids: List[str]) -> dict:
+        """The books found, by id."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def batch_delete_books(self, shelf_id: str, book_ids: List[str]):
+        raise NotImplementedError
+
+
+def _columns(model, fields) -> list:
+    # id and etag are always read: they make up the path, page tokens and ETags.
+    return [model.id, model.etag] + [getattr(model, f) for f in fields if f != "path"]
+
+
+def _by_id(row):
+    return row.id
+
+
+BOOK_FILTER_FIELDS = {"title": DBBook.title, "author": DBBook.author}
+books_fts = table("books_fts", column("rowid"))
+
+
+def _book_search(field: str, value: str):
+    # The trigram index needs at least three characters to match anything.
+    if len(value) < 3:
+        return BOOK_FILTER_FIELDS[field].contains(value, autoescape=True)
+    phrase = '"' + value.replace('"', '""') + '"'
+    matches = select(books_fts.c.rowid).where(literal_column("books_fts").op("MATCH")(f"{field} : {phrase}"))
+    return literal_column("books.rowid").in_(matches)
+
+
+def _book_conditions(filter: str, after: Optional[str]) -> list:
+    conditions = []
+    condition = compile_filter(filter, BOOK_FILTER_FIELDS, _book_search)
+    if condition is not None:
+        conditions.append(condition)
+    if after is not None:
+        conditions.append(DBBook.id > after)
+    return conditions
+
+
+def _has_books(shelf_id):
+    return select(DBBook.id).where(DBBook.shelf_id == shelf_id).exists()
+
+
+async def _purge_shelf(shard: Shard, shelf_id: str, operation_id: str, cache: ResourceCache):
+    """Delete a shelf's books a chunk per transaction, then the shelf itself.
+
+    The shelf stays visible until its last chunk, which deletes it in the
+    same transaction, so books created meanwhile are deleted too.
+    """
+    chunk_size = settings.operation_chunk_size
+    deleted = 0
+    while True:
+        async def chunk(db: AsyncSession):
+            chunk_ids = select(DBBook.id).where(DBBook.shelf_id == shelf_id).limit(chunk_size)
+            query = delete(DBBook).where(DBBook.shelf_id == shelf_id, DBBook.id.in_(chunk_ids)).returning(DBBook.id)
+            ids = (await db.execute(query, execution_options={"synchronize_session": False})).scalars().all()
+            metadata = {"shelf": f"shelves/{shelf_id}", "books_deleted": deleted + len(ids)}
+            last = len(ids) < chunk_size
+            changes = [change(DELETED, f"shelves/{shelf_id}/books/{i}") for i in ids]
+            if last:
+                await db.execute(delete(DBShelf).where(DBShelf.id == shelf_id))
+                changes.append(change(DELETED, f"shelves/{shelf_id}"))
+            await record_changes(db, changes)
+            await update_operation(db, operation_id, metadata=metadata, done=last)
+            return ids, last
+
+        ids, last = await shard.writer.run(chunk)
+        deleted += len(ids)
+        for i in ids:
+            cache.invalidate(f"shelves/{shelf_id}/books/{i}")
+        shard.feed.notify()
+        if last:
+            cache.invalidate(f"shelves/{shelf_id}")
+            return
+
+
+async def books_on(shards: Iterable[Shard], book_ids: List[str]) -> List[str]:
+    """Which of book_ids are taken on any of shards, sorted."""
+    if not book_ids:
+        return []
+
+    async def run(shard: Shard):
+        async with shard.session_factory() as db:
+            return (await db.execute(select(DBBook.id).where(DBBook.id.in_(book_ids)))).scalars().all()
+
+    results = await asyncio.gather(*(run(shard) for shard in shards))
+    return sorted(i for ids in results for i in ids)
+
+
+class SQLRepository(Repository):
+    """The library in SQLite, spread over shards by shelf.
+
+    Every write goes through its shard's writer and records its changes in
+    the shard's change log, for the watch streams. The existence index
+    skips the queries for ids that were never created.
+    """
+
+    def __init__(self, shards: Shards, existence: Existence):
+        self.shards = shards
+        self.existence = existence
+
+    def _stream(self, query, shards: Optional[List[Shard]] = None) -> RowStream:
+        """Stream query from shards (every shard by default), merged by id.
+
+        Sessions and cursors are only opened once the rows are iterated, so
+        a response that is never sent holds nothing.
+        """
+        async def rows():
+            sessions, streams = [], []
+            try:
+                for shard in shards or self.shards:
+                    sessions.append(shard.session_factory())
+                    streams.append(await sessions[-1].stream(query.execution_options(yield_per=STREAM_YIELD_PER)))
+                async for row in merge_streams(streams, _by_id):
+                    yield row
+            finally:
+                for stream in streams:
+                    await stream.close()
+                for session in sessions:
+                    await session.close()
+
+        stream = rows()
+        return stream, stream.aclose
+
+    async def _check_shards(self, groups: dict, check):
+        """Run a batch's checks on every shard it spans, before writing to any.
+
+        Each shard's mutation checks again, but a batch that fails its checks
+        then isn't left committed on some shards only, short of a race with
+        another write.
+        """
+        if len(groups) < 2:
+            return
+
+        async def run(index: int, ids: list):
+            async with self.shards[index].session_factory() as db:
+                await check(db, ids)
+
+        results = await asyncio.gather(*(run(i, ids) for i, ids in sorted(groups.items())), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    async def _books_elsewhere(self, shelf_id: str, book_ids: List[str]) -> List[str]:
+        """Which of book_ids are taken on shards other than shelf_id's.
+
+        Book ids are unique across shelves, so across shards as well. The
+        shelf's own shard is checked in the write's transaction, the others
+        before it, so creates of one id racing on two shards can both get in.
+        """
+        maybe_existing = [i for i in book_ids if self.existence.books.might_exist(i)]
+        if not maybe_existing or len(self.shards) < 2:
+            return []
+        home = self.shards.for_shelf(shelf_id)
+        return await books_on([shard for shard in self.shards if shard is not home], maybe_existing)
+
+    # Shelves
+
+    async def get_shelf(self, shelf_id: str, fields: tuple):
+        if not self.existence.shelves.might_exist(shelf_id):
+            return None
+        async with self.shards.for_shelf(shelf_id).session_factory() as db:
+            row = (await db.execute(select(*_columns(DBShelf, fields)).where(DBShelf.id == shelf_id))).first()
+        if row is None:
+            self.existence.shelves.record_false_positive()
+        return row
+
+    def _shelves_query(self, after: Optional[str], limit: int, fields: tuple):
+        query = select(*_columns(DBShelf, fields)).order_by(DBShelf.id)
+        if after is not None:
+            query = query.where(DBShelf.id > after)
+        return query.limit(limit)
+
+    async def list_shelves(self, after: Optional[str], limit: int, fields: tuple) -> list:
+        return merge(await self.shards.gather(self._shelves_query(after, limit, fields)), key=_by_id, limit=limit)
+
+    async def stream_shelves(self, after: Optional[str], limit: int, fields: tuple) -> RowStream:
+        return self._stream(self._shelves_query(after, limit, fields))
+
+    async def create_shelf(self, shelf_id: str, theme: str, etag: str):
+        shard = self.shards.for_shelf(shelf_id)
+        existence = self.existence
+
+        async def mutation(db: AsyncSession):
+            # Check if exists, unless it's definitely new
+            if existence.shelves.might_exist(shelf_id):
+                result = await db.execute(select(DBShelf.id).where(DBShelf.id == shelf_id))
+                if result.first():
+                     raise HTTPException(status_code=409, detail="Shelf already exists")
+            await db.execute(insert(DBShelf).values(id=shelf_id, theme=theme, etag=etag))
+            existence.shelves.add([shelf_id])
+            await record_changes(db, [change(CREATED, f"shelves/{shelf_id}", etag, shelf_dict(shelf_id, theme))])
+
+        await shard.writer.run(mutation)
+        existence.shelves.add([shelf_id])
+        shard.feed.notify()
+
+    async def update_shelf(self, shelf_id: str, values: dict, etag: str, expected: Optional[List[str]]):
+        shard = self.shards.for_shelf(shelf_id)
+        # A single conditional UPDATE ... RETURNING applies the patch, checks
+        # If-Match and reads back the result.
+        query = update(DBShelf).where(DBShelf.id == shelf_id)
+        if expected is not None:
+            query = query.where(DBShelf.etag.in_(expected))
+        query = query.values(**values, etag=etag).returning(DBShelf.id, DBShelf.theme, DBShelf.etag)
+
+        async def mutation(db: AsyncSession):
+            updated = (await db.execute(query, execution_options={"synchronize_session": False})).first()
+            if updated is None:
+                exists = (await db.execute(select(DBShelf.id).where(DBShelf.id == shelf_id))).first()
+                if not exists:
+                    raise HTTPException(status_code=404, detail="Shelf not found")
+                raise HTTPException(status_code=412, detail="Shelf etag does not match If-Match")
+            await record_changes(db, [change(UPDATED, f"shelves/{shelf_id}", updated.etag, shelf_dict(shelf_id, updated.theme))])
+            return updated
+
+        updated = await shard.writer.run(mutation)
+        shard.feed.notify()
+        return updated
+
+    async def delete_shelf(self, shelf_id: str):
+        shard = self.shards.for_shelf(shelf_id)
+
+        async def mutation(db: AsyncSession):
+            # Books are never orphaned: only an empty shelf is deleted.
+            result = await db.execute(delete(DBShelf).where(DBShelf.id == shelf_id, ~_has_books(shelf_id)))
+            if result.rowcount == 0:
+                exists = (await db.execute(select(DBShelf.id).where(DBShelf.id == shelf_id))).first()
+                if not exists:
+                    raise HTTPException(status_code=404, detail="Shelf not found")
+                raise HTTPException(status_code=409, detail="Shelf is not empty, delete it with force=true")
+            await record_changes(db, [change(DELETED, f"shelves/{shelf_id}")])
+
+        await shard.writer.run(mutation)
+        shard.feed.notify()
+
+    async def force_delete_shelf(self, shelf_id: str, cache: ResourceCache) -> Optional[Tuple[dict, Callable[[], Awaitable[None]]]]:
+        shard = self.shards.for_shelf(shelf_id)
+
+        async def start(db: AsyncSession):
+            exists = (await db.execute(select(DBShelf.id).where(DBShelf.id == shelf_id))).first()
+            if not exists:
+                raise HTTPException(status_code=404, detail="Shelf not found")
+            return await create_operation(db, {"shelf": f"shelves/{shelf_id}", "books_deleted": 0})
+
+        operation = await shard.writer.run(start)
+        operation_id = operation["path"].split("/")[1]
+
+        async def work():
+            # The shard's writer opens sessions of its own, so it keeps
+            # working once the response is sent.
+            await run_operation(shard.writer, operation_id, lambda: _purge_shelf(shard, shelf_id, operation_id, cache))
+
+        return operation, work
+
+    async def batch_create_shelves(self, rows: List[dict]):
+        existence = self.existence
+        groups = self.shards.group(row["id"] for row in rows)
+
+        async def check(db: AsyncSession, ids: list):
+            maybe_existing = [i for i in ids if existence.shelves.might_exist(i)]
+            if maybe_existing:
+                result = await db.execute(select(DBShelf.id).where(DBShelf.id.in_(maybe_existing)))
+                existing = result.scalars().all()
+                if existing:
+                    raise HTTPException(status_code=409, detail=f"Shelf already exists: shelves/{existing[0]}")
+
+        async def create(shard: Shard, ids: list):
+            members = set(ids)
+            shard_rows = [row for row in rows if row["id"] in members]
+
+            async def mutation(db: AsyncSession):
+                await check(db, ids)
+                await db.execute(insert(DBShelf), shard_rows)
+                existence.shelves.add(ids)
+                await record_changes(db, [change(CREATED, f"shelves/{row['id']}", row["etag"], shelf_dict(row["id"], row["theme"])) for row in shard_rows])
+
+            await shard.writer.run(mutation)
+            existence.shelves.add(ids)
+            shard.feed.notify()
+
+        await self._check_shards(groups, check)
+        await asyncio.gather(*(create(self.shards[i], group) for i, group in groups.items()))
+
+    async def batch_get_shelves(self, shelf_ids: List[str]) -> dict:
+        async def get(shard: Shard, ids: list):
+            async with shard.session_factory() as db:
+                return (await db.execute(select(DBShelf).where(DBShelf.id.in_(ids)))).scalars().all()
+
+        results = await asyncio.gather(*(get(self.shards[i], group) for i, group in self.shards.group(set(shelf_ids)).items()))
+        return {s.id: s for shelves in results for s in shelves}
+
+    async def batch_delete_shelves(self, shelf_ids: List[str]):
+        groups = self.shards.group(set(shelf_ids))
+
+        async def check(db: AsyncSession, ids: list):
+            result = await db.execute(select(DBShelf.id).where(DBShelf.id.in_(ids)))
+            missing = set(ids) - set(result.scalars().all())
+            if missing:
+                raise HTTPException(status_code=404, detail=f"Shelf not found: shelves/{sorted(missing)[0]}")
+            result = await db.execute(select(DBBook.shelf_id).where(DBBook.shelf_id.in_(ids)).limit(1))
+            non_empty = result.scalar()
+            if non_empty is not None:
+                raise HTTPException(status_code=409, detail=f"Shelf is not empty: shelves/{non_empty}")
+
+        async def remove(shard: Shard, ids: list):
+            async def mutation(db: AsyncSession):
+                await check(db, ids)
+                await db.execute(delete(DBShelf).where(DBShelf.id.in_(ids)))
+                await record_changes(db, [change(DELETED, f"shelves/{i}") for i in sorted(ids)])
+
+            await shard.writer.run(mutation)
+            shard.feed.notify()
+
+        await self._check_shards(groups, check)
+        await asyncio.gather(*(remove(self.shards[i], group) for i, group in groups.items()))
+
+    # Books
+
+    async def get_book(self, shelf_id: str, book_id: str, fields: tuple):
+        if not self.existence.books.might_exist(book_id):
+            return None
+        query = select(*_columns(DBBook, fields)).where(DBBook.id == book_id, DBBook.shelf_id == shelf_id)
+        async with self.shards.for_shelf(shelf_id).session_factory() as db:
+            row = (await db.execute(query)).first()
+        if row is None:
+            self.existence.books.record_false_positive()
+        return row
+
+    def _books_query(self, shelf_id: Optional[str], after: Optional[str], limit: int, fields: tuple, filter: str):
+        conditions = _book_conditions(filter, after)
+        if shelf_id is None:
+            # Books on every shelf (AEP-159): one keyset scan over all books in
+            # id order, which book ids being unique across shelves makes a
+            # total order, on each shard, merged. There is no parent to check.
+            return (
+                select(DBBook.shelf_id, *_columns(DBBook, fields))
+                .where(*conditions)
+                .order_by(DBBook.id)
+                .limit(limit)
+            )
+        join_on = and_(DBBook.shelf_id == DBShelf.id, *conditions)
+        # The parent check and the page share one query: no row at all means the
+        # shelf is missing, a single row with no book means the page is empty.
+        return (
+            select(DBShelf.id.label("parent_id"), *_columns(DBBook, fields))
+            .select_from(DBShelf)
+            .outerjoin(DBBook, join_on)
+            .where(DBShelf.id == shelf_id)
+            .order_by(DBBook.id)
+            .limit(limit)
+        )
+
+    async def list_books(self, shelf_id: Optional[str], after: Optional[str], limit: int, fields: tuple, filter: str) -> Optional[list]:
+        query = self._books_query(shelf_id, after, limit, fields, filter)
+        if shelf_id is None:
+            return merge(await self.shards.gather(query), key=_by_id, limit=limit)
+        if not self.existence.shelves.might_exist(shelf_id):
+            return None
+        async with self.shards.for_shelf(shelf_id).session_factory() as db:
+            rows = (await db.execute(query)).all()
+        if not rows:
+            self.existence.shelves.record_false_positive()
+            return None
+        return [row for row in rows if row.id is not None]
+
+    async def stream_books(self, shelf_id: Optional[str], after: Optional[str], limit: int, fields: tuple, filter: str) -> Optional[RowStream]:
+        query = self._books_query(shelf_id, after, limit, fields, filter)
+        if shelf_id is None:
+            return self._stream(query)
+        # The parent check is settled before any bytes are sent, the page
+        # itself read once the body is.
+        if await self.get_shelf(shelf_id, ()) is None:
+            return None
+        rows, close = self._stream(query, [self.shards.for_shelf(shelf_id)])
+
+        async def books():
+            # An empty shelf comes back as a single row without a book.
+            async for row in rows:
+                if row.id is not None:
+                    yield row
+
+        return books(), close
+
+    async def create_book(self, shelf_id: str, book_id: str, title: str, author: str, etag: str):
+        existence = self.existence
+        if not existence.shelves.might_exist(shelf_id):
+            raise HTTPException(status_code=404, detail="Parent shelf not found")
+        shard = self.shards.for_shelf(shelf_id)
+        if await self._books_elsewhere(shelf_id, [book_id]):
+            raise HTTPException(status_code=409, detail="Book already exists")
+
+        async def mutation(db: AsyncSession):
+            # Verify parent exists
+            s_result = await db.execute(select(DBShelf.id).where(DBShelf.id == shelf_id))
+            if not s_result.first():
+                 raise HTTPException(status_code=404, detail="Parent shelf not found")
+
+            if existence.books.might_exist(book_id):
+                result = await db.execute(select(DBBook.id).where(DBBook.id == book_id))
+                if result.first():
+                     raise HTTPException(status_code=409, detail="Book already exists")
+
+            await db.execute(insert(DBBook).values(id=book_id, title=title, author=author, shelf_id=shelf_id, etag=etag))
+            existence.books.add([book_id])
+            path = f"shelves/{shelf_id}/books/{book_id}"
+            await record_changes(db, [change(CREATED, path, etag, book_dict(shelf_id, book_id, title, author))])
+
+        await shard.writer.run(mutation)
+        existence.books.add([book_id])
+        shard.feed.notify()
+
+    async def update_book(self, shelf_id: str, book_id: str, values: dict, etag: str, expected: Optional[List[str]]):
+        shard = self.shards.for_shelf(shelf_id)
+        # The URL's shelf is part of the condition: a book on another shelf
+        # doesn't exist at this path.
+        query = update(DBBook).where(DBBook.id == book_id, DBBook.shelf_id == shelf_id)
+        if expected is not None:
+            query = query.where(DBBook.etag.in_(expected))
+        query = query.values(**values, etag=etag).returning(DBBook.id, DBBook.title, DBBook.author, DBBook.etag)
+
+        async def mutation(db: AsyncSession):
+            updated = (await db.execute(query, execution_options={"synchronize_session": False})).first()
+            if updated is None:
+                exists = (await db.execute(select(DBBook.id).where(DBBook.id == book_id, DBBook.shelf_id == shelf_id))).first()
+                if not exists:
+                    raise HTTPException(status_code=404, detail="Book not found")
+                raise HTTPException(status_code=412, detail="Book etag does not match If-Match")
+            resource = book_dict(shelf_id, book_id, updated.title, updated.author)
+            await record_changes(db, [change(UPDATED, f"shelves/{shelf_id}/books/{book_id}", updated.etag, resource)])
+            return updated
+
+        updated = await shard.writer.run(mutation)
+        shard.feed.notify()
+        return updated
+
+    async def delete_book(self, shelf_id: str, book_id: str):
+        shard = self.shards.for_shelf(shelf_id)
+
+        async def mutation(db: AsyncSession):
+            result = await db.execute(delete(DBBook).where(DBBook.id == book_id, DBBook.shelf_id == shelf_id))
+            if result.rowcount == 0:
+                raise HTTPException(status_code=404, detail="Book not found")
+            await record_changes(db, [change(DELETED, f"shelves/{shelf_id}/books/{book_id}")])
+
+        await shard.writer.run(mutation)
+        shard.feed.notify()
+
+    async def batch_create_books(self, shelf_id: str, rows: List[dict]):
+        existence = self.existence
+        if not existence.shelves.might_exist(shelf_id):
+            raise HTTPException(status_code=404, detail="Parent shelf not found")
+        shard = self.shards.for_shelf(shelf_id)
+        ids = [row["id"] for row in rows]
+        existing = await self._books_elsewhere(shelf_id, ids)
+        if existing:
+            raise HTTPException(status_code=409, detail=f"Book already exists: {existing[0]}")
+
+        async def mutation(db: AsyncSession):
+            # Verify parent exists
+            s_result = await db.execute(select(DBShelf.id).where(DBShelf.id == shelf_id))
+            if not s_result.first():
+                 raise HTTPException(status_code=404, detail="Parent shelf not found")
+
+            maybe_existing = [i for i in ids if existence.books.might_exist(i)]
+            if maybe_existing:
+                result = await db.execute(select(DBBook.id).where(DBBook.id.in_(maybe_existing)))
+                existing = result.scalars().all()
+                if existing:
+                    raise HTTPException(status_code=409, detail=f"Book already exists: {existing[0]}")
+            if rows:
+                await db.execute(insert(DBBook), [{**row, "shelf_id": shelf_id} for row in rows])
+            existence.books.add(ids)
+            await record_changes(db, [
+                change(CREATED, f"shelves/{shelf_id}/books/{row['id']}", row["etag"], book_dict(shelf_id, row["id"], row["title"], row["author"]))
+                for row in rows
+            ])
+
+        await shard.writer.run(mutation)
+        existence.books.add(ids)
+        shard.feed.notify()
+
+    async def batch_get_books(self, shelf_id: str, book_ids: List[str]) -> dict:
+        async with self.shards.for_shelf(shelf_id).session_factory() as db:
+            result = await db.execute(select(DBBook).where(DBBook.shelf_id == shelf_id, DBBook.id.in_(book_ids)))
+            return {b.id: b for b in result.scalars().all()}
+
+    async def batch_delete_books(self, shelf_id: str, book_ids: List[str]):
+        shard = self.shards.for_shelf(shelf_id)
+        ids = set(book_ids)
+
+        async def mutation(db: AsyncSession):
+            result = await db.execute(select(DBBook.id).where(DBBook.shelf_id == shelf_id, DBBook.id.in_(ids)))
+            missing = ids - set(result.scalars().all())
+            if missing:
+                raise HTTPException(status_code=404, detail=f"Book not found: shelves/{shelf_id}/books/{sorted(missing)[0]}")
+            if ids:
+                await db.execute(delete(DBBook).where(DBBook.shelf_id == shelf_id, DBBook.id.in_(ids)))
+            await record_changes(db, [change(DELETED, f"shelves/{shelf_id}/books/{i}") for i in sorted(ids)])
+
+        await shard.writer.run(mutation)
+        shard.feed.notify()
+
+
+STORAGE_BACKENDS = ("sqlalchemy", "memory")
+
+
+def check_storage_backend(settings: Settings):
+    if settings.storage_backend not in STORAGE_BACKENDS:
+        raise ValueError(f"Unknown storage_backend {settings.storage_backend!r}, expected one of {', '.join(STORAGE_BACKENDS)}")
+
+
+def build_repository(settings: Settings) -> Optional[Repository]:
+    """The repository storage_backend names, or None for the SQL one, which is built per request."""
+    check_storage_backend(settings)
+    if settings.storage_backend == "memory":
+        from .memory import MemoryRepository
+        return MemoryRepository()
+    return None
+
+
+# The repository of a backend other than SQL, built on first use rather
+# than when the module is imported.
+_repository: Optional[Repository] = None
+
+
+def get_repository(shards: Shards = Depends(get_shards), existence: Existence = Depends(get_existence)) -> Repository:
+    global _repository
+    if settings.storage_backend == "sqlalchemy":
+        return SQLRepository(shards, existence)
+    if _repository is None:
+        _repository = build_repository(settings)
+    return _repository
+
+
+def get_database(repository: Repository = Depends(get_repository)) -> Shards:
+    """The shards of the SQL repository, for the methods only it supports."""
+    if not isinstance(repository, SQLRepository):
+        raise HTTPException(status_code=status.HTTP_501_NOT_IMPLEMENTED, detail="This method needs the sqlalchemy storage backend")
+    return repository.shards
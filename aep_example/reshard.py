@@ -0,0 +1,133 @@
+import asyncio
+import dataclasses
+import os
+import sys
+from typing import Dict, List
+
+from sqlalchemy import func, insert, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+
+from .config import Settings, settings
+from .db import DBBook, DBOperation, DBShelf
+from .shards import Shards, build_shards, shard_url, shards
+from .streaming import STREAM_YIELD_PER
+
+# Offline resharding: copies the library from the shards settings describe
+# to a new set of shard files, with the server stopped. Each row goes to
+# the shard of its shelf (operations to the shard of the shelf in their
+# metadata, or the first shard), keeping ids and ETags, so conditional
+# requests made against the old layout still work. Rows are copied in
+# batches of RESHARD_BATCH_SIZE, a transaction each.
+#
+# The change logs are not copied: revisions are per shard, so they can't
+# carry over, and watches resuming from before the reshard get a 410 and
+# list again. The source files are left as they were; once the copy is
+# verified, set AEP_DATABASE_SHARDS to the new count and delete them.
+
+RESHARD_BATCH_SIZE = 1000
+
+TABLES = [DBShelf.__table__, DBBook.__table__, DBOperation.__table__]
+
+
+def _shelf_id(table, row) -> str:
+    if table is DBShelf.__table__:
+        return row.id
+    if table is DBBook.__table__:
+        return row.shelf_id
+    shelf = (row._mapping["metadata"] or {}).get("shelf", "")
+    return shelf[len("shelves/"):] if shelf.startswith("shelves/") else ""
+
+
+async def _count(shards: Shards, table) -> int:
+    rows = await shards.gather(select(func.count()).select_from(table))
+    return sum(row[0][0] for row in rows)
+
+
+async def copy_library(source: Shards, target: Shards, batch_size: int = RESHARD_BATCH_SIZE) -> Dict[str, int]:
+    """Copy every shelf, book and operation from source to the shard of target it belongs on."""
+    counts = {}
+    for table in TABLES:
+        for shard in source:
+            batches: Dict[int, List[dict]] = {}
+
+            async def flush(index: int):
+                async with target[index].session_factory() as db:
+                    await db.execute(insert(table), batches.pop(index))
+                    await db.commit()
+
+            async with shard.session_factory() as db:
+                rows = await db.stream(select(table).execution_options(yield_per=STREAM_YIELD_PER))
+                async for row in rows:
+                    # Operations without a shelf go to the first shard.
+                    shelf_id = _shelf_id(table, row)
+                    index = target.index(shelf_id) if shelf_id else 0
+                    batches.setdefault(index, []).append(dict(row._mapping))
+                    if len(batches[index]) >= batch_size:
+                        await flush(index)
+            for index in list(batches):
+                await flush(index)
+        counts[table.name] = await _count(source, table)
+        copied = await _count(target, table)
+        if copied != counts[table.name]:
+            raise RuntimeError(f"Copied {copied} of {counts[table.name]} rows of {table.name}")
+    return counts
+
+
+def shard_files(settings: Settings) -> List[str]:
+    count = max(settings.database_shards, 1)
+    return [make_url(shard_url(settings.database_url, i, count)).database for i in range(count)]
+
+
+async def reshard(source: Shards, target_settings: Settings) -> Dict[str, int]:
+    """Copy the library from source to new shard files, as target_settings describe.
+
+    Refuses to touch existing files, and removes the new ones if the copy fails.
+    """
+    files = shard_files(target_settings)
+    existing = [path for path in files if os.path.exists(path)]
+    if existing:
+        raise FileExistsError(f"{existing[0]} already exists")
+    target = build_shards(target_settings)
+    try:
+        await target.init()
+        counts = await copy_library(source, target)
+    except BaseException:
+        await target.dispose()
+        for path in files:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+        raise
+    await target.dispose()
+    return counts
+
+
+async def _reshard(count: int) -> Dict[str, int]:
+    try:
+        await shards.init()
+        return await reshard(shards, dataclasses.replace(settings, database_shards=count))
+    finally:
+        await shards.dispose()
+
+
+def main(args) -> int:
+    if args.shards < 1:
+        print("error: --shards must be at least 1", file=sys.stderr)
+        return 2
+    if args.shards == max(settings.database_shards, 1):
+        print(f"error: the library already has {args.shards} shard(s)", file=sys.stderr)
+        return 2
+    try:
+        counts = asyncio.run(_reshard(args.shards))
+    except (FileExistsError, ValueError, RuntimeError) as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    except IntegrityError as e:
+        # Two shards holding the same id, e.g. books created on different
+        # shards before ids were checked across them.
+        print(f"error: duplicate rows across shards, nothing was copied: {e.orig}", file=sys.stderr)
+        return 1
+    print(f"copied {counts['shelves']} shelves, {counts['books']} books and {counts['operations']} operations to {args.shards} shard(s)")
+    print(f"set AEP_DATABASE_SHARDS={args.shards} to use them, then remove the old files")
+    return 0
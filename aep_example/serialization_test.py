@@ -0,0 +1,22 @@
+import json
+
+from .models import Book, Shelf
+from .serialization import TrustedJSONResponse, book_dict, shelf_dict
+
+
+def test_dicts_match_models():
+    shelf = shelf_dict("s1", "Fiction")
+    assert Shelf.model_validate(shelf).model_dump() == shelf
+    book = book_dict("s1", "b1", "Dune", "Frank Herbert")
+    assert Book.model_validate(book).model_dump() == book
+
+
+def test_trusted_response():
+    resp = TrustedJSONResponse({"shelves": [shelf_dict("s1", "Fiction")], "next_page_token": ""}, status_code=201, headers={"ETag": '"x"'})
+    assert resp.status_code == 201
+    assert resp.headers["content-type"] == "application/json"
+    assert resp.headers["etag"] == '"x"'
+    assert json.loads(resp.body) == {"shelves": [{"path": "shelves/s1", "theme": "Fiction"}], "next_page_token": ""}
+
+    # Pre-encoded bodies are sent as is
+    assert TrustedJSONResponse(b'{"a":1}').body == b'{"a":1}'
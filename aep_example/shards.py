@@ -0,0 +1,196 @@
+import asyncio
+import dataclasses
+import hashlib
+import heapq
+import itertools
+import os
+from typing import AsyncIterator, Callable, Iterable, List, Optional
+
+from fastapi import Depends
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from .changes import ChangeFeed, change_feed
+from .config import Settings, settings
+from .db import AsyncSessionLocal, build_engine, engine, get_session_factory, migrate
+from .writer import SessionFactoryWriter, WriteCoalescer, write_coalescer
+
+# Sharded storage. SQLite has a single writer per database file, so with
+# database_shards > 1 the library is spread over that many files, each
+# with its own engine, pool, write coalescer and change log, and writes to
+# different shards proceed in parallel.
+#
+# A shelf and all of its books (and the operations and changes about them)
+# live on the shard picked by hashing the shelf id, so everything under
+# one shelf, parent checks included, is still a single transaction on a
+# single database. Methods across shelves (ListShelves, ListBooks on "-",
+# the export) query every shard and merge the results in id order, which
+# keeps page tokens working as they do on one database: each shard just
+# continues after the token's id. Batch methods on shelves commit one
+# transaction per shard they touch.
+#
+# The shard of a shelf depends on the number of shards, so changing it
+# takes `aep-server reshard`, with the server stopped.
+
+
+def shard_index(shelf_id: str, count: int) -> int:
+    # A stable hash: Python's hash() of a str differs between processes.
+    digest = hashlib.blake2b(shelf_id.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little") % count
+
+
+def shard_path(path: str, index: int, count: int) -> str:
+    """The file of one of count shards: library.db becomes library-0-of-4.db and so on.
+
+    Naming the count keeps the files of different shard counts apart, so
+    resharding never overwrites its source.
+    """
+    if count <= 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}-{index}-of-{count}{ext}"
+
+
+def shard_url(database_url: str, index: int, count: int) -> str:
+    if count <= 1:
+        return database_url
+    url = make_url(database_url)
+    if url.database in (None, "", ":memory:"):
+        raise ValueError("Sharding needs a database file, not an in-memory database")
+    return url.set(database=shard_path(url.database, index, count)).render_as_string(hide_password=False)
+
+
+class Shard:
+    """One database, with the writer and change feed in front of it."""
+
+    def __init__(self, session_factory, coalescer: Optional[WriteCoalescer] = None, feed: Optional[ChangeFeed] = None, engine: Optional[AsyncEngine] = None):
+        self.session_factory = session_factory
+        self.coalescer = coalescer
+        self.feed = feed or change_feed
+        self.engine = engine
+
+    @property
+    def writer(self):
+        """The coalescer while it is running, otherwise direct writes."""
+        if self.coalescer is not None and self.coalescer.running:
+            return self.coalescer
+        return SessionFactoryWriter(self.session_factory)
+
+
+class Shards:
+    def __init__(self, shards: List[Shard]):
+        self.shards = shards
+
+    def __len__(self) -> int:
+        return len(self.shards)
+
+    def __iter__(self):
+        return iter(self.shards)
+
+    def __getitem__(self, index: int) -> Shard:
+        return self.shards[index]
+
+    def index(self, shelf_id: str) -> int:
+        return shard_index(shelf_id, len(self.shards)) if len(self.shards) > 1 else 0
+
+    def for_shelf(self, shelf_id: str) -> Shard:
+        return self.shards[self.index(shelf_id)]
+
+    def group(self, shelf_ids: Iterable[str]) -> dict:
+        """shelf_ids by the index of their shard."""
+        groups = {}
+        for shelf_id in shelf_ids:
+            groups.setdefault(self.index(shelf_id), []).append(shelf_id)
+        return groups
+
+    async def init(self):
+        for shard in self.shards:
+            async with shard.engine.begin() as conn:
+                await conn.run_sync(migrate)
+
+    def start(self, coalescing: bool):
+        for shard in self.shards:
+            if coalescing and shard.coalescer is not None:
+                shard.coalescer.start()
+            shard.feed.start(shard.session_factory)
+
+    async def stop(self):
+        # Queued writes first: they may still record changes.
+        for shard in self.shards:
+            if shard.coalescer is not None:
+                await shard.coalescer.stop()
+        for shard in self.shards:
+            await shard.feed.stop()
+
+    async def dispose(self):
+        for shard in self.shards:
+            await shard.engine.dispose()
+
+    async def gather(self, query) -> List[list]:
+        """The rows of query on every shard, run concurrently, a list per shard."""
+        async def run(shard: Shard):
+            async with shard.session_factory() as db:
+                return (await db.execute(query)).all()
+
+        return await asyncio.gather(*(run(shard) for shard in self.shards))
+
+
+def build_shards(settings: Settings) -> Shards:
+    """Shards with engines, coalescers and change feeds of their own, as settings describe."""
+    count = max(settings.database_shards, 1)
+    shards = []
+    for i in range(count):
+        shard_settings = dataclasses.replace(settings, database_url=shard_url(settings.database_url, i, count))
+        shard_engine = build_engine(shard_settings)
+        session_factory = sessionmaker(shard_engine, class_=AsyncSession, expire_on_commit=False)
+        coalescer = WriteCoalescer(session_factory, settings.write_batch_window_ms / 1000, settings.write_batch_max_size)
+        feed = ChangeFeed(settings.change_buffer_size, settings.change_poll_interval_ms / 1000, settings.watch_heartbeat_seconds)
+        shards.append(Shard(session_factory, coalescer, feed, shard_engine))
+    return Shards(shards)
+
+
+# Unsharded, the one shard is the database, coalescer and feed the rest of
+# the app already uses.
+if settings.database_shards > 1:
+    shards = build_shards(settings)
+else:
+    shards = Shards([Shard(AsyncSessionLocal, write_coalescer, change_feed, engine)])
+
+
+def get_shards(session_factory=Depends(get_session_factory)) -> Shards:
+    # Unsharded, the database is whatever get_session_factory gives, so
+    # overriding that still redirects every method.
+    if len(shards) == 1 and session_factory is not shards[0].session_factory:
+        return Shards([Shard(session_factory)])
+    return shards
+
+
+def merge(row_lists: List[list], key: Callable, limit: Optional[int] = None) -> list:
+    """Rows already sorted by key on each shard, merged into one sorted list."""
+    rows = row_lists[0] if len(row_lists) == 1 else heapq.merge(*row_lists, key=key)
+    return list(itertools.islice(rows, limit))
+
+
+async def merge_streams(streams: List[AsyncIterator], key: Callable) -> AsyncIterator:
+    """Rows already sorted by key on each stream, merged into one sorted stream."""
+    if len(streams) == 1:
+        async for row in streams[0]:
+            yield row
+        return
+    heap = []
+
+    async def push(i: int):
+        try:
+            row = await streams[i].__anext__()
+        except StopAsyncIteration:
+            return
+        # The index breaks ties, so rows themselves are never compared.
+        heapq.heappush(heap, (key(row), i, row))
+
+    for i in range(len(streams)):
+        await push(i)
+    while heap:
+        _, i, row = heapq.heappop(heap)
+        yield row
+        await push(i)
@@ -0,0 +1,197 @@
+import asyncio
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
+
+from aep_example.config import Settings
+from aep_example.db import DBBook, DBShelf
+from aep_example.main import app
+from aep_example.repository import SQLRepository
+from aep_example.existence import existence
+from aep_example.reshard import reshard
+from aep_example.shards import build_shards, get_shards, merge, merge_streams, shard_index, shard_path, shard_url
+
+
+def test_shard_index():
+    # Stable across processes and releases: moving shelves takes a reshard.
+    assert [shard_index(f"s{i}", 4) for i in range(8)] == [shard_index(f"s{i}", 4) for i in range(8)]
+    assert shard_index("s1", 1) == 0
+    assert {shard_index(f"s{i}", 4) for i in range(100)} == {0, 1, 2, 3}
+
+
+def test_shard_path():
+    assert shard_path("/data/library.db", 0, 1) == "/data/library.db"
+    assert shard_path("/data/library.db", 2, 4) == "/data/library-2-of-4.db"
+    assert shard_url("sqlite+aiosqlite:///./library.db", 1, 2) == "sqlite+aiosqlite:///./library-1-of-2.db"
+    with pytest.raises(ValueError):
+        shard_url("sqlite+aiosqlite:///:memory:", 0, 2)
+
+
+def test_merge():
+    rows = [[1, 4, 7], [2, 5], [3, 6, 8, 9]]
+    assert merge(rows, key=lambda row: row) == list(range(1, 10))
+    assert merge(rows, key=lambda row: row, limit=4) == [1, 2, 3, 4]
+
+    async def stream(values):
+        for value in values:
+            yield value
+
+    async def merged():
+        return [row async for row in merge_streams([stream(values) for values in rows], key=lambda row: row)]
+
+    assert asyncio.run(merged()) == list(range(1, 10))
+
+
+@pytest.fixture
+def sharded(tmp_path):
+    shards = build_shards(Settings(database_url=f"sqlite+aiosqlite:///{tmp_path / 'library.db'}", database_shards=3))
+    asyncio.run(shards.init())
+    app.dependency_overrides[get_shards] = lambda: shards
+    yield shards
+    app.dependency_overrides.pop(get_shards, None)
+    asyncio.run(shards.dispose())
+
+
+def test_sharded_api(sharded):
+    client = TestClient(app)
+    ids = [f"shelf-{i:02d}" for i in range(12)]
+    resp = client.post("/shelves:batchCreate", json={"requests": [{"id": shelf_id, "shelf": {"theme": "T"}} for shelf_id in ids]})
+    assert resp.status_code == 200
+    # Spread over every shard.
+    assert len({sharded.index(shelf_id) for shelf_id in ids}) == 3
+    for shelf_id in ids[:4]:
+        assert client.post(f"/shelves/{shelf_id}/books", params={"id": f"{shelf_id}-book"}, json={"title": "T", "author": "A"}).status_code == 201
+
+    # Pages merged from every shard, in id order.
+    listed, token = [], None
+    while True:
+        page = client.get("/shelves", params={"max_page_size": 5, **({"page_token": token} if token else {})}).json()
+        listed += [shelf["path"] for shelf in page["shelves"]]
+        token = page.get("next_page_token")
+        if not token:
+            break
+    assert listed == [f"shelves/{shelf_id}" for shelf_id in ids]
+
+    books = client.get("/shelves/-/books", params={"max_page_size": 3}).json()
+    assert [book["path"] for book in books["books"]] == [f"shelves/{shelf_id}/books/{shelf_id}-book" for shelf_id in ids[:3]]
+
+    resp = client.get("/shelves:batchGet", params={"paths": [f"shelves/{shelf_id}" for shelf_id in ids[::4]]})
+    assert [shelf["path"] for shelf in resp.json()["results"]] == [f"shelves/{shelf_id}" for shelf_id in ids[::4]]
+
+    lines = [json.loads(line) for line in client.get("/shelves:export").content.splitlines()]
+    assert lines[-1] == {"export": {"shelves": 12, "books": 4}}
+    assert client.get("/shelves:export", params={"format": "sqlite"}).status_code == 400
+
+    # Operations live on the shard of their shelf, but are found from any.
+    operation = client.delete(f"/shelves/{ids[0]}", params={"force": True}).json()
+    assert client.get(f"/{operation['path']}").status_code == 200
+
+    assert client.post("/shelves:batchDelete", json={"paths": [f"shelves/{shelf_id}" for shelf_id in ids[4:]]}).status_code == 204
+    assert [shelf["path"] for shelf in client.get("/shelves").json()["shelves"]] == [f"shelves/{shelf_id}" for shelf_id in ids[1:4]]
+
+    # A Last-Event-ID carries a revision per shard.
+    assert client.get("/shelves:watch", headers={"Last-Event-ID": "1"}).status_code == 410
+
+
+def test_streams_open_cursors_when_read(sharded):
+    repository = SQLRepository(sharded, existence)
+
+    def checked_out():
+        return sum(shard.engine.pool.checkedout() for shard in sharded)
+
+    async def check():
+        await repository.create_shelf("s1", "T", "e")
+        await repository.create_book("s1", "b1", "T", "A", "e")
+        # Nothing is held by a response that is never sent.
+        rows, close = await repository.stream_shelves(None, 10, ())
+        books, close_books = await repository.stream_books("s1", None, 10, (), "")
+        assert checked_out() == 0
+        assert [row.id async for row in rows] == ["s1"]
+        assert [row.id async for row in books] == ["b1"]
+        await close()
+        await close_books()
+        assert checked_out() == 0
+        assert await repository.stream_books("missing", None, 10, (), "") is None
+        # Nor by a body that stops part way.
+        rows, close = await repository.stream_shelves(None, 10, ())
+        await rows.__anext__()
+        assert checked_out() > 0
+        await close()
+        assert checked_out() == 0
+
+    asyncio.run(check())
+
+
+def test_book_ids_unique_across_shards(sharded, tmp_path):
+    client = TestClient(app)
+    first, second = "shelf-a", next(f"shelf-{i}" for i in range(100) if sharded.index(f"shelf-{i}") != sharded.index("shelf-a"))
+    for shelf_id in (first, second):
+        client.post("/shelves", params={"id": shelf_id}, json={"theme": "T"})
+
+    assert client.post(f"/shelves/{first}/books", params={"id": "x"}, json={"title": "T", "author": "A"}).status_code == 201
+    # Taken on the other shard.
+    assert client.post(f"/shelves/{second}/books", params={"id": "x"}, json={"title": "T", "author": "A"}).status_code == 409
+    resp = client.post(f"/shelves/{second}/books:batchCreate", json={"requests": [{"id": "y", "book": {"title": "T", "author": "A"}}, {"id": "x", "book": {"title": "T", "author": "A"}}]})
+    assert resp.status_code == 409
+    operation = client.post(f"/shelves/{second}:importBooks", content='{"id": "x", "title": "T", "author": "A"}\n', headers={"Content-Type": "application/x-ndjson"}).json()
+    assert operation["response"] == {"books_imported": 0, "rows_failed": 1}
+
+    books = client.get("/shelves/-/books", params={"max_page_size": 10}).json()
+    assert [book["path"] for book in books["books"]] == [f"shelves/{first}/books/x"]
+
+    # Duplicates from before ids were checked across shards stop a reshard
+    # to fewer shards, which leaves nothing behind.
+    async def duplicate():
+        async with sharded.for_shelf(second).session_factory() as db:
+            await db.execute(insert(DBBook).values(id="x", shelf_id=second, title="T", author="A", etag="e"))
+            await db.commit()
+        target = Settings(database_url=f"sqlite+aiosqlite:///{tmp_path / 'merged.db'}")
+        with pytest.raises(IntegrityError):
+            await reshard(sharded, target)
+
+    asyncio.run(duplicate())
+    assert not (tmp_path / "merged.db").exists()
+
+
+def test_reshard(tmp_path):
+    def settings(count):
+        return Settings(database_url=f"sqlite+aiosqlite:///{tmp_path / 'library.db'}", database_shards=count)
+
+    async def copy(previous, count):
+        source = build_shards(settings(previous))
+        try:
+            assert await reshard(source, settings(count)) == {"shelves": 20, "books": 20, "operations": 0}
+            # The new files exist now, and are never overwritten.
+            with pytest.raises(FileExistsError):
+                await reshard(source, settings(count))
+        finally:
+            await source.dispose()
+
+    client = TestClient(app)
+    shards = build_shards(settings(1))
+    asyncio.run(shards.init())
+    app.dependency_overrides[get_shards] = lambda: shards
+    try:
+        for i in range(20):
+            client.post("/shelves", params={"id": f"s{i}"}, json={"theme": f"t{i}"})
+            client.post(f"/shelves/s{i}/books", params={"id": f"b{i}"}, json={"title": "T", "author": "A"})
+        etag = client.get("/shelves/s3").headers["etag"]
+        asyncio.run(shards.dispose())
+
+        asyncio.run(copy(1, 3))
+        asyncio.run(copy(3, 2))
+
+        shards = build_shards(settings(2))
+        rows = asyncio.run(shards.gather(select(DBShelf.id)))
+        # Every shelf is on the shard it hashes to.
+        assert sorted(row.id for shard_rows in rows for row in shard_rows) == sorted(f"s{i}" for i in range(20))
+        assert all(shards.index(row.id) == i for i, shard_rows in enumerate(rows) for row in shard_rows)
+        # ETags are kept.
+        assert client.get("/shelves/s3").headers["etag"] == etag
+        assert len(client.get("/shelves/-/books", params={"max_page_size": 100}).json()["books"]) == 20
+    finally:
+        app.dependency_overrides.pop(get_shards, None)
+        asyncio.run(shards.dispose())
@@ -0,0 +1,63 @@
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+from fastapi.responses import StreamingResponse
+
+from .pagination import encode_page_token
+from .serialization import to_json
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+# Rows fetched from the database cursor per round trip while streaming.
+STREAM_YIELD_PER = 500
+
+# Documents the streaming variant of a List method in the OpenAPI schema.
+NDJSON_LIST_RESPONSE = {
+    200: {
+        "content": {
+            NDJSON_MEDIA_TYPE: {
+                "schema": {
+                    "type": "string",
+                    "description": "One resource per line, followed by a trailer line holding next_page_token.",
+                }
+            }
+        }
+    }
+}
+
+
+def wants_ndjson(accept: Optional[str]) -> bool:
+    return accept is not None and NDJSON_MEDIA_TYPE in accept
+
+
+def ndjson_page(
+    rows: AsyncIterator,
+    max_page_size: int,
+    scope: dict,
+    to_dict: Callable[[object], dict],
+    close: Callable[[], Awaitable[None]],
+) -> StreamingResponse:
+    """Stream up to max_page_size (at least 1) rows as NDJSON, one resource per line.
+
+    rows must yield at most max_page_size + 1 rows, the extra one only
+    signalling that another page exists. The final line is always
+    {"next_page_token": ...}, so clients can tell a complete page from a
+    dropped connection. close is only called once the body has started, so
+    rows should open their cursors on the first read, not before.
+    """
+    async def body():
+        count = 0
+        last_id = None
+        next_token = ""
+        try:
+            async for row in rows:
+                if count == max_page_size:
+                    next_token = encode_page_token(last_id, scope)
+                    break
+                yield to_json(to_dict(row)) + b"\n"
+                last_id = row.id
+                count += 1
+        finally:
+            await close()
+        yield to_json({"next_page_token": next_token}) + b"\n"
+
+    return StreamingResponse(body(), media_type=NDJSON_MEDIA_TYPE)
@@ -0,0 +1,185 @@
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, List, Optional, Tuple, TypeVar
+
+from fastapi import HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .config import settings
+from .db import AsyncSessionLocal
+from .metrics import record_write_wait
+
+T = TypeVar("T")
+
+# A mutation receives a session inside an open transaction and must not
+# commit it. It may raise HTTPException (404, 409, 412, ...) to reject the
+# request at any point: the coalescer runs each mutation in a savepoint of
+# the shared transaction and rolls back the writes of those that raise.
+Mutation = Callable[[AsyncSession], Awaitable[T]]
+
+
+class SessionWriter:
+    """Applies a mutation on the request's own session and commits it."""
+
+    def __init__(self, db: AsyncSession):
+        self.db = db
+
+    async def run(self, mutation: Mutation[T]) -> T:
+        result = await mutation(self.db)
+        await self.db.commit()
+        return result
+
+
+class SessionFactoryWriter:
+    """Applies each mutation in a session of its own and commits it."""
+
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+
+    async def run(self, mutation: Mutation[T]) -> T:
+        async with self.session_factory() as db:
+            return await SessionWriter(db).run(mutation)
+
+
+class WriteCoalescer:
+    """Group-commits mutations from concurrent requests.
+
+    SQLite has a single writer, so rather than having every request contend
+    for the write lock and pay for its own commit, requests enqueue their
+    mutation and a single writer task applies everything queued within
+    window_seconds (up to max_batch_size mutations) in one transaction.
+
+    Each request's future resolves with its own mutation's result or
+    HTTPException. If the shared transaction fails for any other reason, it
+    is rolled back and its mutations are replayed one transaction each, so
+    a single bad mutation cannot fail its neighbours.
+    """
+
+    def __init__(self, session_factory, window_seconds: float, max_batch_size: int):
+        self.session_factory = session_factory
+        self.window_seconds = window_seconds
+        self.max_batch_size = max_batch_size
+        self.batches = 0
+        self.mutations = 0
+        self._pending: Deque[Tuple[Mutation, asyncio.Future]] = deque()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop accepting work once everything already queued has been applied."""
+        if not self.running:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+
+    async def run(self, mutation: Mutation[T]) -> T:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((mutation, future))
+        self._wakeup.set()
+        start = time.perf_counter()
+        try:
+            return await future
+        finally:
+            record_write_wait(time.perf_counter() - start)
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            if not self._pending:
+                self._wakeup.clear()
+                if self._stopping:
+                    return
+                continue
+            if self.window_seconds > 0 and len(self._pending) < self.max_batch_size and not self._stopping:
+                await asyncio.sleep(self.window_seconds)
+
+            batch = []
+            while self._pending and len(batch) < self.max_batch_size:
+                batch.append(self._pending.popleft())
+            await self._apply(batch)
+
+    async def _apply(self, batch: List[Tuple[Mutation, asyncio.Future]]):
+        # Requests cancelled while queued have been told nothing happened,
+        # so their writes must not be made.
+        batch = [(mutation, future) for mutation, future in batch if not future.done()]
+        if not batch:
+            return
+        self.batches += 1
+        self.mutations += len(batch)
+        outcomes = []
+        try:
+            async with self.session_factory() as session:
+                await _begin(session)
+                for mutation, _ in batch:
+                    savepoint = await session.begin_nested()
+                    try:
+                        result = await mutation(session)
+                    except HTTPException as e:
+                        await savepoint.rollback()
+                        outcomes.append((False, e))
+                    else:
+                        await savepoint.commit()
+                        outcomes.append((True, result))
+                await session.commit()
+        except Exception:
+            await self._apply_individually(batch)
+            return
+
+        for (_, future), (ok, value) in zip(batch, outcomes):
+            _resolve(future, ok, value)
+
+    async def _apply_individually(self, batch: List[Tuple[Mutation, asyncio.Future]]):
+        for mutation, future in batch:
+            if future.done():
+                continue
+            try:
+                async with self.session_factory() as session:
+                    result = await mutation(session)
+                    await session.commit()
+            except Exception as e:
+                _resolve(future, False, e)
+            else:
+                _resolve(future, True, result)
+
+
+async def _begin(session: AsyncSession):
+    """Open the session's transaction for writing, so savepoints nest inside it.
+
+    SQLite's driver only sends BEGIN before the first write statement, and
+    a SAVEPOINT sent outside a transaction starts one of its own, which its
+    RELEASE then commits. With the driver left out of it (AUTOCOMMIT) the
+    transaction is begun here instead, taking the write lock up front.
+    """
+    connection = await session.connection(execution_options={"isolation_level": "AUTOCOMMIT"})
+    await connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+def _resolve(future: asyncio.Future, ok: bool, value):
+    # The request may have been cancelled (e.g. the client disconnected) while queued.
+    if future.done():
+        return
+    if ok:
+        future.set_result(value)
+    else:
+        future.set_exception(value)
+
+
+write_coalescer = WriteCoalescer(
+    AsyncSessionLocal,
+    window_seconds=settings.write_batch_window_ms / 1000,
+    max_batch_size=settings.write_batch_max_size,
+)
+
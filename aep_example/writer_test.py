@@ -0,0 +1,126 @@
+import asyncio
+
+from fastapi import HTTPException
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from aep_example.db import Base, DBShelf
+from aep_example.writer import WriteCoalescer
+
+
+def create_shelf(shelf_id: str):
+    async def mutation(db: AsyncSession):
+        if (await db.execute(select(DBShelf.id).where(DBShelf.id == shelf_id))).first():
+            raise HTTPException(status_code=409, detail="Shelf already exists")
+        await db.execute(insert(DBShelf).values(id=shelf_id, theme="t", etag="e"))
+        return shelf_id
+    return mutation
+
+
+async def with_coalescer(tmp_path, fn, **kwargs):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'writer.db'}")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    session_factory = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    coalescer = WriteCoalescer(session_factory, **{"window_seconds": 0.01, "max_batch_size": 64, **kwargs})
+    coalescer.start()
+    try:
+        await fn(coalescer, session_factory)
+    finally:
+        await coalescer.stop()
+        await engine.dispose()
+
+
+def test_concurrent_writes_share_a_transaction(tmp_path):
+    async def check(coalescer, session_factory):
+        results = await asyncio.gather(
+            *(coalescer.run(create_shelf(f"s{i}")) for i in range(10)),
+            coalescer.run(create_shelf("s0")),
+            return_exceptions=True,
+        )
+        assert results[:10] == [f"s{i}" for i in range(10)]
+        # Later mutations in a batch see the earlier ones
+        assert isinstance(results[10], HTTPException) and results[10].status_code == 409
+        assert coalescer.batches == 1
+        async with session_factory() as db:
+            assert len((await db.execute(select(DBShelf.id))).all()) == 10
+
+    asyncio.run(with_coalescer(tmp_path, check))
+
+
+def test_max_batch_size(tmp_path):
+    async def check(coalescer, session_factory):
+        await asyncio.gather(*(coalescer.run(create_shelf(f"s{i}")) for i in range(10)))
+        assert coalescer.batches == 4
+
+    asyncio.run(with_coalescer(tmp_path, check, max_batch_size=3))
+
+
+def test_failed_batch_is_replayed_individually(tmp_path):
+    async def broken(db: AsyncSession):
+        await db.execute(insert(DBShelf).values(id="broken", theme="t", etag="e"))
+        raise RuntimeError("boom")
+
+    async def check(coalescer, session_factory):
+        results = await asyncio.gather(
+            coalescer.run(create_shelf("a")),
+            coalescer.run(broken),
+            coalescer.run(create_shelf("b")),
+            return_exceptions=True,
+        )
+        assert results[0] == "a" and results[2] == "b"
+        assert isinstance(results[1], RuntimeError)
+        async with session_factory() as db:
+            ids = set((await db.execute(select(DBShelf.id))).scalars().all())
+        assert ids == {"a", "b"}
+
+    asyncio.run(with_coalescer(tmp_path, check))
+
+
+def test_stop_drains_pending_writes(tmp_path):
+    async def check(coalescer, session_factory):
+        pending = [asyncio.ensure_future(coalescer.run(create_shelf(f"s{i}"))) for i in range(3)]
+        await asyncio.sleep(0)
+        await coalescer.stop()
+        assert [p.result() for p in pending] == ["s0", "s1", "s2"]
+
+    asyncio.run(with_coalescer(tmp_path, check, window_seconds=1))
+
+
+def test_rejected_mutations_are_rolled_back(tmp_path):
+    async def half_done(db: AsyncSession):
+        await db.execute(insert(DBShelf).values(id="partial", theme="t", etag="e"))
+        raise HTTPException(status_code=409, detail="Conflict")
+
+    async def check(coalescer, session_factory):
+        results = await asyncio.gather(
+            coalescer.run(create_shelf("a")),
+            coalescer.run(half_done),
+            coalescer.run(create_shelf("b")),
+            return_exceptions=True,
+        )
+        assert results[0] == "a" and results[2] == "b"
+        assert results[1].status_code == 409
+        assert coalescer.batches == 1
+        async with session_factory() as db:
+            assert set((await db.execute(select(DBShelf.id))).scalars().all()) == {"a", "b"}
+            # Connections go back to the pool with the driver's own transactions.
+            await db.execute(insert(DBShelf).values(id="rolled-back", theme="t", etag="e"))
+            await db.rollback()
+            assert "rolled-back" not in set((await db.execute(select(DBShelf.id))).scalars().all())
+
+    asyncio.run(with_coalescer(tmp_path, check))
+
+
+def test_cancelled_requests_are_not_applied(tmp_path):
+    async def check(coalescer, session_factory):
+        cancelled = asyncio.ensure_future(coalescer.run(create_shelf("cancelled")))
+        kept = asyncio.ensure_future(coalescer.run(create_shelf("kept")))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        assert await kept == "kept"
+        async with session_factory() as db:
+            assert set((await db.execute(select(DBShelf.id))).scalars().all()) == {"kept"}
+
+    asyncio.run(with_coalescer(tmp_path, check, window_seconds=0.05))
@@ -0,0 +1,28 @@
+"""Compare N CreateBook calls against a single BatchCreateBooks call.
+
+Usage: uv run python benchmarks/batch_create.py [N]
+"""
+import asyncio
+import sys
+
+from common import bench_client, timer
+
+
+async def main(n: int):
+    async with bench_client() as client:
+        shelf = (await client.post("/shelves", json={"theme": "bench"})).json()
+        books_url = f"/{shelf['path']}/books"
+
+        with timer(f"{n} x CreateBook", n):
+            for i in range(n):
+                resp = await client.post(books_url, json={"title": f"single {i}", "author": "bench"})
+                resp.raise_for_status()
+
+        body = {"requests": [{"book": {"title": f"batch {i}", "author": "bench"}} for i in range(n)]}
+        with timer(f"1 x BatchCreateBooks ({n} books)", n):
+            resp = await client.post(f"{books_url}:batchCreate", json=body)
+            resp.raise_for_status()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000))
@@ -0,0 +1,3 @@
+# Shared helpers for the scripts in this directory. They live in the package
+# so the `aep-server benchmark` command can use them too.
+from aep_example.bench import bench_client, timer  # noqa: F401
@@ -0,0 +1,80 @@
+"""Compare throughput with SQLite's defaults against the tuned pragma profile.
+
+Each profile runs against a fresh database file and measures:
+
+- commits: concurrent single-row INSERT + COMMIT transactions on the engine,
+  which isolates the cost of the journal mode and fsync policy.
+- requests: the same concurrency driving a CreateBook/ListBooks mix through
+  the ASGI app, which adds the HTTP and ORM overhead on top.
+
+Usage: uv run python benchmarks/db_profiles.py [CLIENTS] [OPERATIONS_PER_CLIENT]
+"""
+import asyncio
+import dataclasses
+import os
+import sys
+import tempfile
+import time
+
+from sqlalchemy import insert
+
+from common import bench_client
+
+from aep_example.config import Settings
+from aep_example.db import Base, DBShelf, build_engine
+
+PROFILES = {
+    "default": Settings(sqlite_tuning=False, cache_enabled=False),
+    "tuned": Settings(cache_enabled=False),
+}
+
+
+def report(profile: str, label: str, total: int, elapsed: float):
+    print(f"{profile:<10} {label:<10} {total:6d} in {elapsed:6.2f}s {total / elapsed:10.1f}/s")
+
+
+async def bench_commits(profile: str, settings: Settings, clients: int, n: int):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        settings = dataclasses.replace(settings, database_url=f"sqlite+aiosqlite:///{os.path.join(tmpdir, 'bench.db')}")
+        engine = build_engine(settings)
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+
+        async def worker(c: int):
+            for i in range(n):
+                async with engine.begin() as conn:
+                    await conn.execute(insert(DBShelf).values(id=f"{c}-{i}", theme="bench", etag="bench"))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(c) for c in range(clients)))
+        report(profile, "commits", clients * n, time.perf_counter() - start)
+        await engine.dispose()
+
+
+async def bench_requests(profile: str, settings: Settings, clients: int, n: int):
+    async with bench_client(settings) as client:
+        shelf = (await client.post("/shelves", json={"theme": "bench"})).json()
+        books_url = f"/{shelf['path']}/books"
+
+        async def worker():
+            for i in range(n):
+                if i % 4 == 3:
+                    resp = await client.get(books_url, params={"max_page_size": 20})
+                else:
+                    resp = await client.post(books_url, json={"title": f"book {i}", "author": "bench"})
+                resp.raise_for_status()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(clients)))
+        report(profile, "requests", clients * n, time.perf_counter() - start)
+
+
+async def main(clients: int, n: int):
+    for profile, settings in PROFILES.items():
+        await bench_commits(profile, settings, clients, n)
+        await bench_requests(profile, settings, clients, n)
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    asyncio.run(main(*(args + [8, 200][len(args):])))
@@ -0,0 +1,48 @@
+"""Import N books through ImportBooks as a streamed NDJSON upload.
+
+Reports throughput and the peak memory allocated while importing, which
+should stay flat as N grows.
+
+Usage: uv run python benchmarks/import_books.py [N]
+"""
+import asyncio
+import json
+import sys
+import time
+import tracemalloc
+
+from common import bench_client
+
+UPLOAD_CHUNK_ROWS = 1000
+
+
+async def upload(n: int):
+    for start in range(0, n, UPLOAD_CHUNK_ROWS):
+        lines = (
+            json.dumps({"id": f"book-{i:09d}", "title": f"title {i}", "author": f"author {i % 1000}"})
+            for i in range(start, min(start + UPLOAD_CHUNK_ROWS, n))
+        )
+        yield ("\n".join(lines) + "\n").encode()
+
+
+async def main(n: int):
+    async with bench_client() as client:
+        await client.post("/shelves", params={"id": "import"}, json={"theme": "bench"})
+        tracemalloc.start()
+        start = time.perf_counter()
+        resp = await client.post(
+            "/shelves/import:importBooks",
+            content=upload(n),
+            headers={"Content-Type": "application/x-ndjson"},
+            timeout=None,
+        )
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        resp.raise_for_status()
+        print(resp.json()["response"])
+        print(f"{n} rows in {elapsed:.1f} s, {n / elapsed:.0f} rows/s, peak {peak / 2**20:.1f} MiB allocated")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000))
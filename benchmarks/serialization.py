@@ -0,0 +1,68 @@
+"""Compare the CPU cost of serializing a ListBooks page, per item.
+
+- models: what handlers used to do. Build a Book model per row, then have
+  FastAPI validate the result against the route's response_model,
+  jsonable_encoder it and render a JSONResponse.
+- trusted: what handlers do now. Build plain dicts and render a
+  TrustedJSONResponse, which encodes them in one pydantic-core pass.
+
+Usage: uv run python benchmarks/serialization.py [ROUNDS]
+"""
+import asyncio
+import sys
+import time
+from types import SimpleNamespace
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+
+from aep_example.main import app
+from aep_example.models import Book, ListBooksResponse
+from aep_example.serialization import TrustedJSONResponse, book_dict
+
+PAGE_SIZES = (10, 100, 1000)
+SHELF_ID = "shelf-00000"
+
+
+def list_books_field():
+    for route in app.routes:
+        if getattr(route, "operation_id", None) == "ListBooks":
+            return route.response_field
+    raise LookupError("ListBooks route not found")
+
+
+async def models(rows, field) -> bytes:
+    content = ListBooksResponse(
+        books=[Book(path=f"shelves/{SHELF_ID}/books/{b.id}", title=b.title, author=b.author) for b in rows],
+        next_page_token="",
+    )
+    return JSONResponse(await serialize_response(field=field, response_content=content)).body
+
+
+async def trusted(rows, field) -> bytes:
+    content = {"books": [book_dict(SHELF_ID, b.id, b.title, b.author) for b in rows], "next_page_token": ""}
+    return TrustedJSONResponse(content).body
+
+
+async def measure(path, rows, field, rounds: int) -> float:
+    await path(rows, field)  # warm up
+    start = time.process_time()
+    for _ in range(rounds):
+        await path(rows, field)
+    return (time.process_time() - start) / rounds / len(rows)
+
+
+async def main(rounds: int):
+    field = list_books_field()
+    print(f"{'page size':>9} {'models us/item':>15} {'trusted us/item':>16} {'saved us/item':>14}")
+    for size in PAGE_SIZES:
+        rows = [SimpleNamespace(id=f"book-{i:07d}", title=f"title {i}", author=f"author {i % 100}") for i in range(size)]
+        # Keep the total work per page size roughly constant.
+        n = max(1, rounds * 100 // size)
+        before = await measure(models, rows, field, n)
+        after = await measure(trusted, rows, field, n)
+        print(f"{size:>9} {before * 1e6:>15.2f} {after * 1e6:>16.2f} {(before - after) * 1e6:>14.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 200))
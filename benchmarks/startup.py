@@ -0,0 +1,78 @@
+"""Measure how long a worker takes to become ready.
+
+Reports, as the median of N runs each:
+  - importing aep_example.main in a fresh interpreter, which is what each
+    uvicorn worker does first,
+  - the first GET /openapi.json with the schema built in-process, and with
+    it read from a precomputed openapi.json (AEP_OPENAPI_FILE),
+  - starting `aep-server serve --production` until it answers a request.
+
+Usage: uv run python benchmarks/startup.py [N]
+"""
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+PORT = 8765
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+FIRST_OPENAPI = """
+import time
+start = time.perf_counter()
+from fastapi.testclient import TestClient
+from aep_example.main import app
+imported = time.perf_counter()
+TestClient(app).get("/openapi.json").raise_for_status()
+print(imported - start, time.perf_counter() - imported)
+"""
+
+
+def python(code: str, env: dict) -> str:
+    return subprocess.run([sys.executable, "-c", code], env=env, cwd=ROOT, check=True, capture_output=True, text=True).stdout
+
+
+def serve_until_ready(env: dict) -> float:
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "aep_example.main", "serve", "--production", "--port", str(PORT)],
+        env=env, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        while True:
+            try:
+                urllib.request.urlopen(f"http://127.0.0.1:{PORT}/shelves", timeout=1).read()
+                return time.perf_counter() - start
+            except OSError:
+                if server.poll() is not None:
+                    raise RuntimeError("the server exited before it was ready")
+                time.sleep(0.01)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main(n: int):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        env = {**os.environ, "AEP_DATABASE_URL": f"sqlite+aiosqlite:///{os.path.join(tmpdir, 'startup.db')}"}
+        precomputed = {**env, "AEP_OPENAPI_FILE": os.path.join(ROOT, "openapi.json")}
+
+        imports, built, loaded = [], [], []
+        for _ in range(n):
+            imported, first = map(float, python(FIRST_OPENAPI, env).split())
+            imports.append(imported)
+            built.append(first)
+            loaded.append(float(python(FIRST_OPENAPI, precomputed).split()[1]))
+        ready = [serve_until_ready(precomputed) for _ in range(n)]
+
+    print(f"import aep_example.main        {statistics.median(imports) * 1000:7.1f} ms")
+    print(f"first /openapi.json, built     {statistics.median(built) * 1000:7.1f} ms")
+    print(f"first /openapi.json, from file {statistics.median(loaded) * 1000:7.1f} ms")
+    print(f"serve --production until ready {statistics.median(ready) * 1000:7.1f} ms")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)